@@ -13,24 +13,457 @@ from datetime import datetime, timedelta
 import numpy as np
 import math
 import csv
-import itertools
-import statistics
 import random
 from flask import Flask, request, jsonify
 import threading
+import multiprocessing
+import queue
 import logging
+import logging.handlers
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import hashlib
+import hmac
+import socket
+import gzip
+import re
+import tempfile
 # --- MÓDULO BINANCE TRADER (MEJORADO) ---
 from binance.client import Client
-from binance.exceptions import BinanceAPIException
+from binance.exceptions import BinanceAPIException, BinanceRequestException
+from websockets.sync.client import connect as ws_connect
 logger_binance = logging.getLogger("BinanceTrader")
+logger_escaneo = logging.getLogger("bot.escaneo")
+logger_ordenes = logging.getLogger("bot.ordenes")
+logger_telegram = logging.getLogger("bot.telegram")
+logger_optimizador = logging.getLogger("bot.optimizador")
+logger_coordinador = logging.getLogger("bot.coordinador")
+logger_estado = logging.getLogger("bot.estado")
+# ---------------------------
+# REGISTRO ESTRUCTURADO (LOGGING NO BLOQUEANTE)
+# ---------------------------
+CAMPOS_LOG_ESTRUCTURADO = ('cuenta', 'simbolo', 'etapa', 'suprimidos')
+class FormateadorJSON(logging.Formatter):
+    """Una línea JSON por registro con categoría (logger), símbolo y etapa"""
+    def format(self, record):
+        registro = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'categoria': record.name,
+            'mensaje': record.getMessage()
+        }
+        for campo in CAMPOS_LOG_ESTRUCTURADO:
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                registro[campo] = valor
+        if record.exc_info:
+            registro['excepcion'] = self.formatException(record.exc_info)
+        return json.dumps(registro, ensure_ascii=False, default=str)
+class FiltroFrecuencia(logging.Filter):
+    """Deja pasar los primeros `rafaga` registros de cada plantilla por ventana y luego 1 de cada `muestreo`.
+    Los descartados se cuentan en el campo `suprimidos` del siguiente que pasa."""
+    def __init__(self, ventana_segundos=60, rafaga=20, muestreo=50):
+        super().__init__()
+        self.ventana_segundos = ventana_segundos
+        self.rafaga = rafaga
+        self.muestreo = muestreo
+        self.contadores = {}
+        self.lock = threading.Lock()
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        clave = (record.name, record.levelno, record.msg)
+        ahora = time.time()
+        with self.lock:
+            inicio, vistos, suprimidos = self.contadores.get(clave, (ahora, 0, 0))
+            if ahora - inicio >= self.ventana_segundos:
+                inicio, vistos = ahora, 0
+            vistos += 1
+            pasa = vistos <= self.rafaga or (vistos - self.rafaga) % self.muestreo == 0
+            if pasa:
+                if suprimidos:
+                    record.suprimidos = suprimidos
+                suprimidos = 0
+            else:
+                suprimidos += 1
+            self.contadores[clave] = (inicio, vistos, suprimidos)
+            if len(self.contadores) > 5000:
+                self.contadores = {
+                    k: v for k, v in self.contadores.items() if ahora - v[0] < self.ventana_segundos
+                }
+        return pasa
+def configurar_logging(config):
+    """Los hilos del bot solo encolan registros; un QueueListener hace la E/S a stdout"""
+    cola_log = queue.SimpleQueue()
+    manejador_cola = logging.handlers.QueueHandler(cola_log)
+    manejador_cola.addFilter(FiltroFrecuencia(
+        ventana_segundos=config.get('log_ventana_segundos', 60),
+        rafaga=config.get('log_rafaga', 20),
+        muestreo=config.get('log_muestreo', 50)
+    ))
+    salida = logging.StreamHandler(sys.stdout)
+    if config.get('log_formato', 'json') == 'json':
+        salida.setFormatter(FormateadorJSON())
+    else:
+        salida.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    listener = logging.handlers.QueueListener(cola_log, salida, respect_handler_level=False)
+    for nombre in ('bot', 'BinanceTrader'):
+        logger = logging.getLogger(nombre)
+        logger.handlers = [manejador_cola]
+        logger.setLevel(config.get('log_nivel', 'INFO'))
+        logger.propagate = False
+    for categoria, nivel in config.get('log_niveles_categoria', {}).items():
+        logging.getLogger(categoria).setLevel(nivel)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+# ---------------------------
+# GRABACIÓN Y REPRODUCCIÓN DE SESIONES
+# ---------------------------
+class RelojSesion:
+    """Sustituye al módulo time al reproducir: arranca en el instante grabado y, en modo rápido, solo avanza con los eventos"""
+    def __init__(self, inicio, acelerado):
+        self._time = time
+        self.inicio = inicio
+        self.acelerado = acelerado
+        self._real0 = time.time()
+        self.avance = 0.0
+        self.lock = threading.Lock()
+    def __getattr__(self, nombre):
+        return getattr(self._time, nombre)
+    def transcurrido(self):
+        return self.avance if self.acelerado else self._time.time() - self._real0
+    def time(self):
+        return self.inicio + self.transcurrido()
+    def monotonic(self):
+        return self.transcurrido() if self.acelerado else self._time.monotonic()
+    def sleep(self, segundos):
+        if self.acelerado:
+            with self.lock:
+                self.avance += max(0.0, segundos)
+        else:
+            self._time.sleep(segundos)
+    def avanzar_hasta(self, transcurrido):
+        with self.lock:
+            self.avance = max(self.avance, transcurrido)
+    def consumir(self, evento):
+        """Modo rápido: salta al final del evento; modo real: reproduce su latencia"""
+        if self.acelerado:
+            self.avanzar_hasta(evento['t'] + evento['d'] / 1000)
+        else:
+            self._time.sleep(evento['d'] / 1000)
+class RespuestaGrabada:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+    @property
+    def ok(self):
+        return self.status_code < 400
+    def json(self):
+        return json.loads(self.text)
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} (sesión grabada)")
+class SesionGrabada:
+    """Archivo gzip de líneas JSON: cabecera + un evento por respuesta externa (REST, cliente Binance, websocket, Telegram)"""
+    def __init__(self, archivo, modo, velocidad='real', estado_inicial=None):
+        self.archivo = archivo
+        self.modo = modo
+        self.lock = threading.Lock()
+        self.fallos = 0
+        self.eventos_servidos = 0
+        self._salida = None
+        self.reloj = None
+        if modo == 'grabar':
+            self._inicio = time.time()
+            self._salida = gzip.open(archivo, 'wt', encoding='utf-8')
+            self._escribir({'version': 1, 'inicio': self._inicio, 'estado': estado_inicial})
+            atexit.register(self.cerrar)
+        else:
+            self._cargar(velocidad == 'rapida')
+    def _cargar(self, acelerado):
+        self.eventos = []
+        self.colas = {}
+        with gzip.open(self.archivo, 'rt', encoding='utf-8') as f:
+            self.cabecera = json.loads(next(f))
+            for linea in f:
+                evento = json.loads(linea)
+                for clave in {evento['k'], evento['l']}:
+                    self.colas.setdefault(clave, deque()).append(len(self.eventos))
+                self.eventos.append(evento)
+        self.consumidos = bytearray(len(self.eventos))
+        self.fin = self.eventos[-1]['t'] if self.eventos else 0.0
+        self.reloj = RelojSesion(self.cabecera['inicio'], acelerado)
+    def _escribir(self, evento):
+        linea = json.dumps(evento, separators=(',', ':'), default=str)
+        with self.lock:
+            if self._salida is not None:
+                self._salida.write(linea + '\n')
+    def cerrar(self):
+        with self.lock:
+            if self._salida is not None:
+                self._salida.close()
+                self._salida = None
+    def agotada(self):
+        return self.eventos_servidos >= len(self.eventos) or self.reloj.transcurrido() > self.fin
+    def registrar(self, canal, clave, laxa, inicio, duracion, respuesta=None, estado=None, error=None):
+        evento = {
+            't': round(inicio - self._inicio, 4), 'd': round(duracion * 1000, 1),
+            'c': canal, 'k': clave, 'l': laxa, 'r': respuesta
+        }
+        if estado is not None:
+            evento['s'] = estado
+        if error is not None:
+            evento['e'] = {'tipo': type(error).__name__, 'msg': str(error)}
+            if isinstance(error, BinanceAPIException):
+                evento['e'].update(code=error.code, msg=error.message, status=error.status_code)
+        self._escribir(evento)
+    def _tomar(self, clave, hasta=None):
+        cola = self.colas.get(clave)
+        while cola:
+            indice = cola[0]
+            if self.consumidos[indice]:
+                cola.popleft()
+                continue
+            if hasta is not None and self.eventos[indice]['t'] > hasta:
+                return None
+            cola.popleft()
+            self.consumidos[indice] = 1
+            self.eventos_servidos += 1
+            return self.eventos[indice]
+        return None
+    def siguiente(self, clave, laxa):
+        """Respuesta grabada para la petición: primero por clave exacta, si no la siguiente del mismo endpoint y símbolo"""
+        with self.lock:
+            evento = self._tomar(clave) or self._tomar(laxa)
+            if evento is None:
+                self.fallos += 1
+        if evento is None:
+            raise ConnectionError(f"Sin respuesta grabada para {clave}")
+        self.reloj.consumir(evento)
+        error = evento.get('e')
+        if error is None:
+            return evento
+        if error['tipo'] == 'BinanceAPIException':
+            raise BinanceAPIException(None, error.get('status'), json.dumps({'code': error['code'], 'msg': error['msg']}))
+        tipo = getattr(requests.exceptions, error['tipo'], None)
+        if isinstance(tipo, type) and issubclass(tipo, Exception):
+            raise tipo(error['msg'])
+        raise ConnectionError(error['msg'])
+    def siguiente_ws(self, clave):
+        """Mensaje de websocket cuyo instante grabado ya se alcanzó (None si todavía no toca)"""
+        with self.lock:
+            evento = self._tomar(clave, hasta=self.reloj.transcurrido())
+        return evento['r'] if evento else None
+    def peticion_http(self, modulo, metodo, url, params, kwargs):
+        url_clave = re.sub(r'/bot[^/]+/', '/bot***/', url)
+        simbolo = params.get('symbol', '') if isinstance(params, dict) else ''
+        clave = f"{metodo} {url_clave} {json.dumps(params, sort_keys=True, default=str)}"
+        laxa = f"{metodo} {url_clave.split('?')[0]} {simbolo}"
+        if self.modo == 'reproducir':
+            evento = self.siguiente(clave, laxa)
+            return RespuestaGrabada(evento.get('s', 200), evento['r'])
+        inicio = time.time()
+        try:
+            respuesta = getattr(modulo, metodo.lower())(url, params=params, **kwargs)
+        except Exception as e:
+            self.registrar('http', clave, laxa, inicio, time.time() - inicio, error=e)
+            raise
+        self.registrar('http', clave, laxa, inicio, time.time() - inicio, respuesta.text, respuesta.status_code)
+        return respuesta
+    def llamada_binance(self, etiqueta, metodo, funcion, args, kwargs):
+        clave = f"{etiqueta}.{metodo} {json.dumps([args, kwargs], sort_keys=True, default=str)}"
+        laxa = f"{etiqueta}.{metodo} {kwargs.get('symbol', '')}"
+        if self.modo == 'reproducir':
+            return self.siguiente(clave, laxa)['r']
+        inicio = time.time()
+        try:
+            resultado = funcion(*args, **kwargs)
+        except Exception as e:
+            self.registrar('binance', clave, laxa, inicio, time.time() - inicio, error=e)
+            raise
+        self.registrar('binance', clave, laxa, inicio, time.time() - inicio, resultado)
+        return resultado
+    def conector_ws(self, conectar):
+        def conectar_sesion(url, **kwargs):
+            if self.modo == 'reproducir':
+                return ConexionWsGrabada(self, url)
+            return ConexionWsGrabada(self, url, conectar(url, **kwargs))
+        return conectar_sesion
+class HttpGrabado:
+    """Sustituto del módulo requests: get/post pasan por la sesión, el resto (excepciones, etc.) es el módulo real"""
+    def __init__(self, sesion, modulo):
+        self._sesion = sesion
+        self._modulo = modulo
+    def __getattr__(self, nombre):
+        return getattr(self._modulo, nombre)
+    def get(self, url, params=None, **kwargs):
+        return self._sesion.peticion_http(self._modulo, 'GET', url, params, kwargs)
+    def post(self, url, params=None, **kwargs):
+        return self._sesion.peticion_http(self._modulo, 'POST', url, params, kwargs)
+class ClienteBinanceGrabado:
+    """Envuelve el Client de python-binance; al reproducir no existe cliente real y todo sale de la sesión"""
+    def __init__(self, sesion, api_key, cliente=None):
+        self._sesion = sesion
+        self._cliente = cliente
+        self._etiqueta = hashlib.sha256((api_key or '').encode()).hexdigest()[:8]
+    def __getattr__(self, nombre):
+        funcion = None
+        if self._cliente is not None:
+            funcion = getattr(self._cliente, nombre)
+            if not callable(funcion):
+                return funcion
+        def llamada_grabada(*args, **kwargs):
+            return self._sesion.llamada_binance(self._etiqueta, nombre, funcion, args, kwargs)
+        return llamada_grabada
+class ConexionWsGrabada:
+    """Conexión websocket que graba cada mensaje recibido o, sin conexión real, los entrega en su instante grabado"""
+    def __init__(self, sesion, url, conexion=None):
+        self._sesion = sesion
+        self._url = url
+        self._conexion = conexion
+        self._pausa = threading.Event()
+    def __enter__(self):
+        if self._conexion is not None:
+            self._conexion.__enter__()
+        return self
+    def __exit__(self, *exc):
+        if self._conexion is not None:
+            return self._conexion.__exit__(*exc)
+        return False
+    def send(self, mensaje):
+        if self._conexion is not None:
+            self._conexion.send(mensaje)
+    def recv(self, timeout=None):
+        clave = f"WS {self._url}"
+        if self._conexion is not None:
+            mensaje = self._conexion.recv(timeout=timeout)
+            self._sesion.registrar('ws', clave, clave, time.time(), 0.0, mensaje)
+            return mensaje
+        limite = time.perf_counter() + (timeout or 1)
+        while True:
+            mensaje = self._sesion.siguiente_ws(clave)
+            if mensaje is not None:
+                return mensaje
+            if time.perf_counter() >= limite:
+                raise TimeoutError()
+            self._pausa.wait(0.05)
+def activar_sesion(config):
+    """SESION_MODO=grabar|reproducir: sustituye requests, ws_connect y el cliente de Binance; al reproducir también el reloj"""
+    global requests, ws_connect, time
+    modo = config.get('sesion_modo')
+    if modo not in ('grabar', 'reproducir'):
+        return None
+    archivo = config['sesion_archivo']
+    config['archivo_velas_activo'] = False
+    if modo == 'grabar':
+        estado_inicial = None
+        if os.path.exists(config['estado_file']):
+            with open(config['estado_file'], 'r', encoding='utf-8') as f:
+                estado_inicial = json.load(f)
+        sesion = SesionGrabada(archivo, modo, estado_inicial=estado_inicial)
+    else:
+        sesion = SesionGrabada(archivo, modo, config.get('sesion_velocidad', 'real'))
+        directorio = tempfile.mkdtemp(prefix='reproduccion_')
+        config['estado_file'] = os.path.join(directorio, 'estado.json')
+        config['log_path'] = os.path.join(directorio, 'operaciones_log.csv')
+        if sesion.cabecera.get('estado') is not None:
+            with open(config['estado_file'], 'w', encoding='utf-8') as f:
+                json.dump(sesion.cabecera['estado'], f)
+        time = sesion.reloj
+    requests = HttpGrabado(sesion, requests)
+    ws_connect = sesion.conector_ws(ws_connect)
+    logger_estado.info("📼 Sesión en modo %s: %s", modo, archivo, extra={'etapa': 'sesion'})
+    return sesion
+def reproducir_sesion(bot, sesion):
+    """Ejecuta ciclos del bot contra la sesión hasta agotarla y devuelve tiempos de la corrida"""
+    tiempos = []
+    senales = 0
+    inicio = time.perf_counter()
+    while not sesion.agotada():
+        t0 = time.perf_counter()
+        senales += bot.ejecutar_ciclo_programado() or 0
+        tiempos.append((time.perf_counter() - t0) * 1000)
+        if sesion.reloj.acelerado:
+            sesion.reloj.sleep(bot.segundos_hasta_proximo_ciclo())
+        else:
+            bot.esperar_proximo_ciclo()
+    return {
+        'ciclos': len(tiempos),
+        'senales': senales,
+        'segundos_totales': round(time.perf_counter() - inicio, 3),
+        'ms_ciclo_p50': round(float(np.percentile(tiempos, 50)), 1) if tiempos else None,
+        'ms_ciclo_p95': round(float(np.percentile(tiempos, 95)), 1) if tiempos else None,
+        'ms_ciclo_max': round(max(tiempos), 1) if tiempos else None,
+        'eventos_servidos': sesion.eventos_servidos,
+        'eventos_grabados': len(sesion.eventos),
+        'peticiones_sin_grabacion': sesion.fallos
+    }
+# ---------------------------
+# LIBRO LOCAL DE ÓRDENES (IDS DE CLIENTE IDEMPOTENTES)
+# ---------------------------
+# Errores de Binance tras los que la orden pudo haber llegado igual (timeout, desconexión, respuesta rota)
+CODIGOS_ESTADO_DESCONOCIDO = {-1000, -1001, -1006, -1007}
+CODIGO_ID_CLIENTE_DUPLICADO = -4116
+CODIGO_ORDEN_INEXISTENTE = -2013
+# Una orden en estos estados no quedó en el libro del exchange: su ID de cliente se puede volver a usar
+ESTADOS_ORDEN_SIN_EFECTO = {'CANCELED', 'EXPIRED', 'REJECTED'}
+class LibroOrdenes:
+    """Registro de las órdenes enviadas por newClientOrderId: estado, orderId e intentos de cada una"""
+    def __init__(self, maximo=2000):
+        self.maximo = maximo
+        self.ordenes = {}
+        self.lock = threading.Lock()
+    @staticmethod
+    def id_cliente(*partes):
+        """Base determinista de 26 caracteres para newClientOrderId; cada orden le agrega su rol (E, S, T, X)
+        y las recolocaciones además su ronda (R1S, R2T...)"""
+        return 'cb' + hashlib.sha1('|'.join(str(p) for p in partes).encode()).hexdigest()[:24]
+    def registrar(self, id_cliente, symbol, params):
+        with self.lock:
+            entrada = self.ordenes.pop(id_cliente, None) or {'symbol': symbol, 'intentos': 0, 'orderId': None}
+            entrada.update(params=params, estado='ENVIANDO', ts=time.time())
+            entrada['intentos'] += 1
+            self.ordenes[id_cliente] = entrada
+            while len(self.ordenes) > self.maximo:
+                del self.ordenes[next(iter(self.ordenes))]
+    def marcar(self, id_cliente, estado, order=None):
+        with self.lock:
+            entrada = self.ordenes.get(id_cliente)
+            if entrada is None:
+                return
+            entrada['estado'] = estado
+            if order is not None:
+                entrada['orderId'] = order.get('orderId')
+                entrada['order'] = order
+    def confirmada(self, id_cliente):
+        """Orden ya aceptada por el exchange con este ID, o None"""
+        with self.lock:
+            entrada = self.ordenes.get(id_cliente)
+            return entrada.get('order') if entrada and entrada['estado'] == 'CONFIRMADA' else None
+# ---------------------------
+# BINANCE TRADER
+# ---------------------------
 class BinanceTrader:
-    def __init__(self, api_key, secret_key, testnet=True):
-        if testnet:
+    def __init__(self, api_key, secret_key, testnet=True, ttl_exchange_info=3600, sesion=None):
+        self.ttl_exchange_info = ttl_exchange_info
+        self._simbolos_info = {}
+        self._exchange_info_ts = 0
+        self._lock_exchange_info = threading.Lock()
+        self.libro_ordenes = LibroOrdenes()
+        if sesion is not None and sesion.modo == 'reproducir':
+            self.client = ClienteBinanceGrabado(sesion, api_key)
+            logger_binance.info("📼 BinanceTrader reproduciendo sesión grabada.")
+        elif testnet:
             self.client = Client(api_key, secret_key, tld='com', testnet=True)
             logger_binance.info("🧪 BinanceTrader inicializado en MODO TESTNET.")
         else:
             self.client = Client(api_key, secret_key, tld='com')
             logger_binance.warning("🚨 BinanceTrader inicializado en MODO REAL. 🚨")
+        if sesion is not None and sesion.modo == 'grabar':
+            self.client = ClienteBinanceGrabado(sesion, api_key, self.client)
     def check_connection(self):
         try:
             self.client.ping()
@@ -74,25 +507,39 @@ class BinanceTrader:
         except Exception as e:
             logger_binance.error(f"❌ Error al obtener info de cuenta: {e}")
             return None
-    def get_symbol_info(self, symbol):
+    def obtener_precio_fill(self, symbol, order):
+        """Precio medio de ejecución de una orden MARKET (de la respuesta RESULT o consultando la orden)"""
         try:
-            exchange_info = self.client.futures_exchange_info()
-            for s in exchange_info['symbols']:
-                if s['symbol'] == symbol:
-                    return s
+            precio = float(order.get('avgPrice') or 0)
+            if precio <= 0:
+                order = self.client.futures_get_order(symbol=symbol, orderId=order['orderId'])
+                precio = float(order.get('avgPrice') or 0)
+            return precio if precio > 0 else None
+        except Exception as e:
+            logger_binance.error(f"❌ Error obteniendo precio de ejecución en {symbol}: {e}")
             return None
+    def obtener_simbolos_info(self):
+        """exchangeInfo indexado por símbolo, cacheado durante ttl_exchange_info segundos"""
+        with self._lock_exchange_info:
+            if not self._simbolos_info or time.time() - self._exchange_info_ts >= self.ttl_exchange_info:
+                exchange_info = self.client.futures_exchange_info()
+                self._simbolos_info = {s['symbol']: s for s in exchange_info['symbols']}
+                self._exchange_info_ts = time.time()
+            return self._simbolos_info
+    def get_symbol_info(self, symbol):
+        try:
+            return self.obtener_simbolos_info().get(symbol)
         except Exception as e:
             logger_binance.error(f"❌ Error al obtener info del símbolo {symbol}: {e}")
             return None
     def get_price_precision(self, symbol):
         try:
-            info = self.client.futures_exchange_info()
-            for s in info['symbols']:
-                if s['symbol'] == symbol:
-                    for f in s['filters']:
-                        if f['filterType'] == 'PRICE_FILTER':
-                            min_price = float(f['minPrice'])
-                            return int(-math.log10(min_price))
+            s = self.get_symbol_info(symbol)
+            if s:
+                for f in s['filters']:
+                    if f['filterType'] == 'PRICE_FILTER':
+                        min_price = float(f['minPrice'])
+                        return int(-math.log10(min_price))
             return 8
         except Exception as e:
             logger_binance.error(f"Error obteniendo precisión para {symbol}: {e}")
@@ -100,21 +547,85 @@ class BinanceTrader:
     def get_quantity_precision(self, symbol):
         """Obtiene la precisión de cantidad para un símbolo"""
         try:
-            info = self.client.futures_exchange_info()
-            for s in info['symbols']:
-                if s['symbol'] == symbol:
-                    for f in s['filters']:
-                        if f['filterType'] == 'LOT_SIZE':
-                            step_size = float(f['stepSize'])
-                            if step_size < 1.0:
-                                return int(-math.log10(step_size))
-                            else:
-                                return 0
+            s = self.get_symbol_info(symbol)
+            if s:
+                for f in s['filters']:
+                    if f['filterType'] == 'LOT_SIZE':
+                        step_size = float(f['stepSize'])
+                        if step_size < 1.0:
+                            return int(-math.log10(step_size))
+                        else:
+                            return 0
             return 8
         except Exception as e:
             logger_binance.error(f"Error obteniendo precisión de cantidad para {symbol}: {e}")
             return 8
-    def place_market_order(self, symbol, side, quantity):
+    def consultar_orden_cliente(self, symbol, client_order_id):
+        """Estado de una orden por su newClientOrderId en una sola consulta: None si el exchange no la tiene
+        (-2013); cualquier otro error se propaga porque no permite saber si la orden llegó"""
+        try:
+            return self.client.futures_get_order(symbol=symbol, origClientOrderId=client_order_id)
+        except BinanceAPIException as e:
+            if e.code == CODIGO_ORDEN_INEXISTENTE:
+                return None
+            raise
+    def enviar_orden(self, symbol, client_order_id, reintentos=2, **params):
+        """futures_create_order con newClientOrderId. Ante timeout o estado desconocido, SL/TP (que quedan
+        abiertas) se reenvían de inmediato con el mismo ID y el exchange rechaza el duplicado; una MARKET sin
+        reduceOnly ya no está abierta si se ejecutó, así que antes de reenviarla se consulta por su ID y solo
+        se reenvía si el exchange no la tiene"""
+        self.libro_ordenes.registrar(client_order_id, symbol, params)
+        consultar_antes = params.get('type') == 'MARKET' and str(params.get('reduceOnly', '')).lower() != 'true'
+        error = None
+        for intento in range(reintentos + 1):
+            try:
+                order = self.client.futures_create_order(symbol=symbol, newClientOrderId=client_order_id, **params)
+                self.libro_ordenes.marcar(client_order_id, 'CONFIRMADA', order)
+                return order
+            except BinanceAPIException as e:
+                if e.code == CODIGO_ID_CLIENTE_DUPLICADO:
+                    error = e
+                    break
+                if e.code not in CODIGOS_ESTADO_DESCONOCIDO:
+                    self.libro_ordenes.marcar(client_order_id, 'RECHAZADA')
+                    raise
+                error = e
+            except (requests.exceptions.RequestException, BinanceRequestException) as e:
+                error = e
+            if intento == reintentos:
+                break
+            if consultar_antes:
+                order = self._confirmar_por_id_cliente(symbol, client_order_id)
+                if order is not False:
+                    return order
+            logger_binance.warning(f"⏳ Orden {client_order_id} en {symbol} sin respuesta ({error}), reenviando ({intento + 1}/{reintentos})")
+        order = self._confirmar_por_id_cliente(symbol, client_order_id)
+        if order is not False:
+            return order
+        self.libro_ordenes.marcar(client_order_id, 'DESCONOCIDA')
+        raise error
+    def _confirmar_por_id_cliente(self, symbol, client_order_id):
+        """Orden confirmada si el exchange la tiene; False si no existe o terminó sin efecto (CANCELED, EXPIRED,
+        REJECTED: se puede reenviar con el mismo ID). Si la consulta falla el estado sigue desconocido y no se reenvía"""
+        try:
+            order = self.consultar_orden_cliente(symbol, client_order_id)
+        except Exception as e:
+            logger_binance.error(f"❌ Error consultando la orden {client_order_id} en {symbol}: {e}")
+            self.libro_ordenes.marcar(client_order_id, 'DESCONOCIDA')
+            raise
+        if not order:
+            return False
+        if order.get('status') in ESTADOS_ORDEN_SIN_EFECTO:
+            logger_binance.warning(f"⚠️ Orden {client_order_id} en {symbol} figura como {order['status']}: no cuenta como colocada")
+            return False
+        logger_binance.info(f"🔁 Orden {client_order_id} confirmada por ID de cliente. ID: {order['orderId']}")
+        self.libro_ordenes.marcar(client_order_id, 'CONFIRMADA', order)
+        return order
+    def place_market_order(self, symbol, side, quantity, client_order_id):
+        previa = self.libro_ordenes.confirmada(client_order_id)
+        if previa:
+            logger_binance.info(f"♻️ Orden {client_order_id} ya ejecutada en {symbol}, no se reenvía. ID: {previa['orderId']}")
+            return previa
         try:
             symbol_info = self.get_symbol_info(symbol)
             if symbol_info:
@@ -133,11 +644,13 @@ class BinanceTrader:
                             return None
                         break
             logger_binance.info(f"📈 Enviando orden MARKET: {side} {quantity} {symbol}")
-            order = self.client.futures_create_order(
-                symbol=symbol,
+            order = self.enviar_orden(
+                symbol,
+                client_order_id,
                 side=side,
                 type='MARKET',
-                quantity=quantity
+                quantity=quantity,
+                newOrderRespType='RESULT'
             )
             logger_binance.info(f"✅ Orden enviada. ID: {order['orderId']}")
             return order
@@ -147,20 +660,21 @@ class BinanceTrader:
                 if quantity > 0.001:
                     new_quantity = quantity * 0.95
                     logger_binance.info(f"🔄 Reintentando con cantidad reducida: {new_quantity}")
-                    return self.place_market_order(symbol, side, new_quantity)
+                    return self.place_market_order(symbol, side, new_quantity, client_order_id)
             else:
                 logger_binance.error(f"❌ Error al colocar orden: {e}")
             return None
         except Exception as e:
             logger_binance.error(f"❌ Error al colocar orden: {e}")
             return None
-    def place_stop_loss_order(self, symbol, side, stop_price):
+    def place_stop_loss_order(self, symbol, side, stop_price, client_order_id):
         try:
             precision = self.get_price_precision(symbol)
             stop_price = round(stop_price, precision)
             logger_binance.info(f"🛑 Colocando STOP_MARKET: {side} en {symbol} a {stop_price} (precisión: {precision})")
-            order = self.client.futures_create_order(
-                symbol=symbol,
+            order = self.enviar_orden(
+                symbol,
+                client_order_id,
                 side=side,
                 type='STOP_MARKET',
                 stopPrice=stop_price,
@@ -171,13 +685,14 @@ class BinanceTrader:
         except Exception as e:
             logger_binance.error(f"❌ Error al colocar Stop-Loss: {e}")
             return None
-    def place_take_profit_order(self, symbol, side, take_profit_price):
+    def place_take_profit_order(self, symbol, side, take_profit_price, client_order_id):
         try:
             precision = self.get_price_precision(symbol)
             take_profit_price = round(take_profit_price, precision)
             logger_binance.info(f"🎯 Colocando TAKE_PROFIT_MARKET: {side} en {symbol} a {take_profit_price} (precisión: {precision})")
-            order = self.client.futures_create_order(
-                symbol=symbol,
+            order = self.enviar_orden(
+                symbol,
+                client_order_id,
                 side=side,
                 type='TAKE_PROFIT_MARKET',
                 stopPrice=take_profit_price,
@@ -248,18 +763,31 @@ class BinanceTrader:
         except Exception as e:
             logger_binance.error(f"❌ Error verificando distancia órdenes: {e}")
             return sl_price, tp_price
-    def cancelar_ordenes_cierre(self, symbol):
+    def ordenes_cierre_abiertas(self):
+        """SL/TP abiertos de toda la cuenta agrupados por símbolo, en una sola consulta (None si falla)"""
+        try:
+            por_simbolo = {}
+            for order in self.client.futures_get_open_orders():
+                if order['type'] in ['STOP_MARKET', 'TAKE_PROFIT_MARKET']:
+                    por_simbolo.setdefault(order['symbol'], []).append(order)
+            return por_simbolo
+        except Exception as e:
+            logger_binance.error(f"❌ Error obteniendo órdenes abiertas de la cuenta: {e}")
+            return None
+    def cancelar_ordenes_cierre(self, symbol, open_orders=None):
         try:
-            open_orders = self.client.futures_get_open_orders(symbol=symbol)
+            if open_orders is None:
+                open_orders = self.client.futures_get_open_orders(symbol=symbol)
             for order in open_orders:
                 if order['type'] in ['STOP_MARKET', 'TAKE_PROFIT_MARKET']:
                     self.client.futures_cancel_order(symbol=symbol, orderId=order['orderId'])
                     logger_binance.info(f"🧹 Orden cancelada: {order['type']} ID {order['orderId']} en {symbol}")
         except Exception as e:
             logger_binance.error(f"❌ Error al cancelar órdenes de cierre en {symbol}: {e}")
-    def verificar_ordenes_cierre_activas(self, symbol):
+    def verificar_ordenes_cierre_activas(self, symbol, open_orders=None):
         try:
-            open_orders = self.client.futures_get_open_orders(symbol=symbol)
+            if open_orders is None:
+                open_orders = self.client.futures_get_open_orders(symbol=symbol)
             sl_active = any(order['type'] == 'STOP_MARKET' for order in open_orders)
             tp_active = any(order['type'] == 'TAKE_PROFIT_MARKET' for order in open_orders)
             logger_binance.info(f"🔍 Verificando órdenes {symbol}: SL={sl_active}, TP={tp_active}")
@@ -267,18 +795,20 @@ class BinanceTrader:
         except Exception as e:
             logger_binance.error(f"❌ Error verificando órdenes activas en {symbol}: {e}")
             return False, False
-    def recolocar_ordenes_cierre(self, symbol, side, sl_price, tp_price):
+    def recolocar_ordenes_cierre(self, symbol, side, sl_price, tp_price, open_orders=None, id_senal=None):
+        # Posiciones sin señal registrada (estado anterior a los IDs de cliente): ID derivado de los argumentos
+        id_senal = id_senal or LibroOrdenes.id_cliente(symbol, side, sl_price, tp_price)
         try:
-            sl_active, tp_active = self.verificar_ordenes_cierre_activas(symbol)
+            sl_active, tp_active = self.verificar_ordenes_cierre_activas(symbol, open_orders)
             if not sl_active:
                 logger_binance.warning(f"⚠️ Stop Loss no encontrado en {symbol}, recolocando...")
-                sl_order = self.place_stop_loss_order(symbol, side, sl_price)
+                sl_order = self.place_stop_loss_order(symbol, side, sl_price, f"{id_senal}S")
                 if not sl_order:
                     logger_binance.error(f"❌ Error crítico: No se pudo recolocar SL en {symbol}")
                     return False
             if not tp_active:
                 logger_binance.warning(f"⚠️ Take Profit no encontrado en {symbol}, recolocando...")
-                tp_order = self.place_take_profit_order(symbol, side, tp_price)
+                tp_order = self.place_take_profit_order(symbol, side, tp_price, f"{id_senal}T")
                 if not tp_order:
                     logger_binance.error(f"❌ Error crítico: No se pudo recolocar TP en {symbol}")
                     return False
@@ -287,15 +817,385 @@ class BinanceTrader:
             logger_binance.error(f"❌ Error recolocando órdenes en {symbol}: {e}")
             return False
 # ---------------------------
+# ESTADO DE CUENTA EN CACHÉ
+# ---------------------------
+class EstadoCuenta:
+    """Saldo y posiciones de la última foto de futures_account, con margen reservado para órdenes en curso"""
+    def __init__(self, max_edad_segundos=300):
+        self.max_edad_segundos = max_edad_segundos
+        self.balance_disponible = 0.0
+        self.posiciones = {}
+        self.reservas = {}
+        self.actualizado = 0
+        self.lock = threading.Lock()
+    def actualizar(self, info_cuenta, pedido_en=None):
+        """Aplica una foto de la cuenta. Las reservas anteriores al pedido ya están reflejadas en el saldo."""
+        pedido_en = pedido_en if pedido_en is not None else time.time()
+        with self.lock:
+            self.balance_disponible = float(info_cuenta['availableBalance'])
+            self.posiciones = {
+                p['symbol']: float(p['positionAmt']) for p in info_cuenta.get('positions', [])
+            }
+            self.reservas = {s: r for s, r in self.reservas.items() if r[1] >= pedido_en}
+            self.actualizado = time.time()
+    def vigente(self):
+        return self.actualizado and time.time() - self.actualizado < self.max_edad_segundos
+    def disponible(self):
+        with self.lock:
+            return self.balance_disponible - sum(monto for monto, _ in self.reservas.values())
+    def reservar(self, simbolo, margen):
+        with self.lock:
+            libre = self.balance_disponible - sum(monto for monto, _ in self.reservas.values())
+            if margen > libre:
+                return False
+            self.reservas[simbolo] = (margen, time.time())
+            return True
+    def liberar(self, simbolo):
+        with self.lock:
+            self.reservas.pop(simbolo, None)
+# ---------------------------
+# EJECUCIÓN MULTICUENTA
+# ---------------------------
+class LimitadorTasa:
+    """Token bucket: `tasa` peticiones por segundo con ráfagas de hasta `capacidad`"""
+    def __init__(self, tasa=5.0, capacidad=10):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = float(capacidad)
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+    def adquirir(self):
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+                self.ultimo = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                espera = (1 - self.tokens) / self.tasa
+            time.sleep(espera)
+class ClienteLimitado:
+    """Envuelve el Client de python-binance: cada llamada a la API consume un token del limitador de la cuenta"""
+    def __init__(self, cliente, limitador):
+        self._cliente = cliente
+        self._limitador = limitador
+    def __getattr__(self, nombre):
+        atributo = getattr(self._cliente, nombre)
+        if not callable(atributo):
+            return atributo
+        def llamada_limitada(*args, **kwargs):
+            self._limitador.adquirir()
+            return atributo(*args, **kwargs)
+        return llamada_limitada
+class EjecutorCuenta:
+    """Ejecución de una cuenta: dimensionado con su propio saldo, apertura con SL/TP y vigilancia de protección.
+    El análisis de mercado es único y compartido; cada cuenta solo recibe las señales."""
+    def __init__(self, nombre, trader, config, fraccion_balance=0.03):
+        self.nombre = nombre
+        self.trader = trader
+        self.config = config
+        self.fraccion_balance = fraccion_balance
+        self.estado_cuenta = EstadoCuenta(config.get('max_edad_estado_cuenta_segundos', 300))
+        self.operaciones = {}
+        self.pool = ThreadPoolExecutor(
+            max_workers=config.get('workers_posiciones', 4), thread_name_prefix=f'posiciones-{nombre}'
+        )
+        if trader:
+            trader.client = ClienteLimitado(trader.client, LimitadorTasa(
+                config.get('limite_peticiones_cuenta_por_segundo', 5.0),
+                config.get('rafaga_peticiones_cuenta', 10)
+            ))
+    def calcular_tamaño_posicion(self, symbol, precio_entrada):
+        if not self.trader:
+            return None
+        try:
+            if not self.estado_cuenta.vigente() and not self.refrescar_estado_cuenta():
+                return None
+            balance = self.estado_cuenta.disponible()
+            monto_usdt_deseado = balance * self.fraccion_balance
+            notional_minimo = 5.0
+            if monto_usdt_deseado < notional_minimo:
+                if balance < notional_minimo:
+                    logger_binance.warning(f"⚠️ Saldo insuficiente ({balance:.2f} USDT) para abrir posición en {symbol} (mínimo: {notional_minimo} USDT)")
+                    return None
+                monto_usdt = notional_minimo
+            else:
+                monto_usdt = monto_usdt_deseado
+            symbol_info = self.trader.get_symbol_info(symbol)
+            if not symbol_info:
+                return None
+            step_size = None
+            min_qty = None
+            max_qty = None
+            for f in symbol_info['filters']:
+                if f['filterType'] == 'LOT_SIZE':
+                    step_size = float(f['stepSize'])
+                    min_qty = float(f['minQty'])
+                    max_qty = float(f['maxQty']) if 'maxQty' in f else None
+                    break
+            if step_size is None:
+                logger_binance.error(f"❌ No se pudo obtener LOT_SIZE para {symbol}")
+                return None
+            cantidad_base = monto_usdt / precio_entrada
+            if step_size < 1.0:
+                precision = int(round(-math.log10(step_size), 0))
+                cantidad_ajustada = math.floor(cantidad_base / step_size) * step_size
+                cantidad_ajustada = round(cantidad_ajustada, precision)
+            else:
+                cantidad_ajustada = math.floor(cantidad_base)
+            if min_qty and cantidad_ajustada < min_qty:
+                cantidad_ajustada = min_qty
+            if max_qty and cantidad_ajustada > max_qty:
+                cantidad_ajustada = max_qty
+            notional_final = cantidad_ajustada * precio_entrada
+            if notional_final < notional_minimo:
+                cantidad_minima_necesaria = notional_minimo / precio_entrada
+                if step_size < 1.0:
+                    precision = int(round(-math.log10(step_size), 0))
+                    cantidad_minima_ajustada = math.ceil(cantidad_minima_necesaria / step_size) * step_size
+                    cantidad_minima_ajustada = round(cantidad_minima_ajustada, precision)
+                else:
+                    cantidad_minima_ajustada = math.ceil(cantidad_minima_necesaria)
+                if cantidad_minima_ajustada * precio_entrada > balance:
+                    logger_binance.warning(f"⚠️ Saldo insuficiente para cumplir notional mínimo en {symbol}")
+                    return None
+                if max_qty and cantidad_minima_ajustada > max_qty:
+                    logger_binance.warning(f"⚠️ Cantidad mínima requerida excede maxQty en {symbol}")
+                    return None
+                cantidad_ajustada = cantidad_minima_ajustada
+            if cantidad_ajustada <= 0:
+                logger_binance.error(f"❌ Cantidad ajustada es 0 o negativa para {symbol}")
+                return None
+            margen = cantidad_ajustada * precio_entrada / self.config.get('apalancamiento', 10)
+            if not self.estado_cuenta.reservar(symbol, margen):
+                logger_binance.warning(f"⚠️ Margen comprometido por órdenes en curso: sin saldo libre para {symbol}")
+                return None
+            logger_binance.info(f"✅ Tamaño posición calculado: {cantidad_ajustada} {symbol} (Notional: {cantidad_ajustada * precio_entrada:.2f} USDT)")
+            return cantidad_ajustada
+        except Exception as e:
+            logger_binance.error(f"❌ Error calculando tamaño posición para {symbol}: {e}")
+            return None
+    def refrescar_estado_cuenta(self):
+        """Una foto de futures_account por ciclo: saldo disponible y posiciones"""
+        if not self.trader:
+            return False
+        pedido_en = time.time()
+        info_cuenta = self.trader.get_account_info()
+        if not info_cuenta:
+            return False
+        self.estado_cuenta.actualizar(info_cuenta, pedido_en)
+        return True
+    def abrir_operacion(self, simbolo, tipo_operacion, precio_entrada, sl, tp, t_senal=None):
+        """Abre y protege la posición; devuelve cantidad, IDs de SL/TP, precio de fill y latencias por etapa
+        (ms desde la señal), o None si no quedó abierta"""
+        ejecucion = self._abrir_operacion(simbolo, tipo_operacion, precio_entrada, sl, tp, t_senal or time.time())
+        if not ejecucion and self.trader:
+            self.estado_cuenta.liberar(simbolo)
+        return ejecucion
+    def _abrir_operacion(self, simbolo, tipo_operacion, precio_entrada, sl, tp, t_senal):
+        if not self.trader:
+            logger_ordenes.error("❌ Trader no disponible. Operación omitida.", extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'apertura'})
+            return None
+        orden_principal = None
+        posicion_abierta = False
+        sl_order = None
+        tp_order = None
+        id_senal = LibroOrdenes.id_cliente(self.nombre, simbolo, tipo_operacion, f"{t_senal:.3f}")
+        try:
+            apalancamiento = self.config.get('apalancamiento', 10)
+            if not self.trader.set_leverage(simbolo, apalancamiento):
+                logger_ordenes.error("❌ Falló al establecer apalancamiento %sx para %s", apalancamiento, simbolo, extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'apertura'})
+                return None
+            if not self.trader.set_margin_isolated(simbolo):
+                logger_ordenes.error("❌ Falló al configurar margen AISLADO para %s", simbolo, extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'apertura'})
+                return None
+            latencias = {'ms_config': (time.time() - t_senal) * 1000}
+            cantidad = self.calcular_tamaño_posicion(simbolo, precio_entrada)
+            if not cantidad:
+                logger_ordenes.error("❌ No se pudo calcular cantidad válida para %s", simbolo, extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'dimensionado'})
+                return None
+            side = 'BUY' if tipo_operacion == 'LONG' else 'SELL'
+            sl_side = 'SELL' if tipo_operacion == 'LONG' else 'BUY'
+            ticker = self.trader.client.futures_symbol_ticker(symbol=simbolo)
+            precio_actual = float(ticker['price'])
+            sl_ajustado, tp_ajustado = self.trader.validar_niveles_sl_tp(simbolo, sl_side, sl, tp)
+            sl_ajustado, tp_ajustado = self.trader.verificar_distancia_ordenes(
+                simbolo, precio_actual, sl_ajustado, tp_ajustado, sl_side
+            )
+            orden_principal = self.trader.place_market_order(simbolo, side, cantidad, f"{id_senal}E")
+            if not orden_principal:
+                logger_ordenes.error("❌ Falló al abrir posición %s en %s", tipo_operacion, simbolo, extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'apertura'})
+                return None
+            posicion_abierta = True
+            latencias['ms_orden'] = (time.time() - t_senal) * 1000
+            precio_fill = self.trader.obtener_precio_fill(simbolo, orden_principal)
+            latencias['ms_fill'] = (time.time() - t_senal) * 1000
+            slippage_bps = None
+            if precio_fill:
+                desvio = (precio_fill - precio_entrada) if tipo_operacion == 'LONG' else (precio_entrada - precio_fill)
+                slippage_bps = desvio / precio_entrada * 10000
+            time.sleep(1.5)
+            max_retries = 3
+            for attempt in range(max_retries):
+                if not sl_order:
+                    sl_order = self.trader.place_stop_loss_order(simbolo, sl_side, sl_ajustado, f"{id_senal}S")
+                    latencias['ms_sl'] = (time.time() - t_senal) * 1000
+                if not tp_order:
+                    tp_order = self.trader.place_take_profit_order(simbolo, sl_side, tp_ajustado, f"{id_senal}T")
+                    latencias['ms_tp'] = (time.time() - t_senal) * 1000
+                if sl_order and tp_order:
+                    logger_ordenes.info("✅ Operación %s en %s completamente protegida (SL + TP)", tipo_operacion, simbolo, extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'proteccion'})
+                    return dict(
+                        latencias,
+                        cantidad=cantidad,
+                        orden_sl_id=sl_order.get('orderId'),
+                        orden_tp_id=tp_order.get('orderId'),
+                        id_senal=id_senal,
+                        precio_fill_entrada=precio_fill,
+                        slippage_entrada_bps=slippage_bps
+                    )
+                if attempt < max_retries - 1:
+                    logger_binance.warning(f"🔄 Reintentando órdenes de cierre ({attempt + 1}/{max_retries}) en {simbolo}")
+                    if tipo_operacion == 'LONG':
+                        sl_ajustado *= 0.995
+                        tp_ajustado *= 1.005
+                    else:
+                        sl_ajustado *= 1.005
+                        tp_ajustado *= 0.995
+                    time.sleep(2)
+                else:
+                    logger_binance.error(f"❌ No se pudieron colocar ambas órdenes de cierre en {simbolo} tras {max_retries} intentos")
+            logger_ordenes.error("⚠️ Cancelando posición en %s por falta de protección (SL/TP)", simbolo, extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'proteccion'})
+            self.trader.enviar_orden(
+                simbolo,
+                f"{id_senal}X",
+                side='SELL' if side == 'BUY' else 'BUY',
+                type='MARKET',
+                quantity=cantidad,
+                reduceOnly='true'
+            )
+            logger_binance.info(f"CloseOperation: Posición cerrada por falta de SL/TP en {simbolo}")
+            return None
+        except Exception as e:
+            logger_binance.error(f"❌ Error crítico en ejecutar_operacion_binance({simbolo}): {e}")
+            if posicion_abierta:
+                try:
+                    logger_binance.warning(f"CloseOperation tras error: cerrando posición en {simbolo}")
+                    self.trader.enviar_orden(
+                        simbolo,
+                        f"{id_senal}X",
+                        side='SELL' if tipo_operacion == 'LONG' else 'BUY',
+                        type='MARKET',
+                        quantity=cantidad,
+                        reduceOnly='true'
+                    )
+                except Exception as close_err:
+                    logger_binance.error(f"❌ Error al cerrar posición tras fallo: {close_err}")
+            return None
+    def monitorear(self, operaciones, abiertas=None):
+        """Una consulta de órdenes abiertas para toda la cuenta; solo las posiciones sin SL o TP se
+        recolocan, en paralelo. Devuelve el mapa de órdenes para reutilizarlo en el ciclo."""
+        if not self.trader or not operaciones:
+            return None
+        if abiertas is None:
+            abiertas = self.trader.ordenes_cierre_abiertas()
+        pendientes = []
+        for simbolo, operacion in list(operaciones.items()):
+            if self.estado_cuenta.vigente() and self.estado_cuenta.posiciones.get(simbolo, 0.0) == 0.0:
+                continue
+            if abiertas is not None:
+                tipos = {orden['type'] for orden in abiertas.get(simbolo, [])}
+                if {'STOP_MARKET', 'TAKE_PROFIT_MARKET'} <= tipos:
+                    continue
+            pendientes.append((simbolo, operacion))
+        for simbolo, futuro in [(simbolo, self.pool.submit(self._proteger, simbolo, operacion, abiertas))
+                                for simbolo, operacion in pendientes]:
+            try:
+                if not futuro.result():
+                    logger_binance.error(f"🚨 CRÍTICO: No se pudieron mantener órdenes de cierre en {simbolo}")
+            except Exception as e:
+                logger_ordenes.warning("⚠️ Error monitoreando órdenes para %s: %s", simbolo, e, extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'monitoreo'})
+        return abiertas
+    def _proteger(self, simbolo, operacion, abiertas):
+        side_cierre = 'SELL' if operacion['tipo'] == 'LONG' else 'BUY'
+        id_senal = operacion.get('id_senal') or LibroOrdenes.id_cliente(
+            simbolo, side_cierre, operacion['stop_loss'], operacion['take_profit']
+        )
+        # Cada ronda usa IDs propios: el SL/TP original sigue consultable como CANCELED/EXPIRED con su ID
+        operacion['recolocaciones'] = operacion.get('recolocaciones', 0) + 1
+        return self.trader.recolocar_ordenes_cierre(
+            simbolo,
+            side_cierre,
+            operacion['stop_loss'],
+            operacion['take_profit'],
+            abiertas.get(simbolo, []) if abiertas is not None else None,
+            f"{id_senal}R{operacion['recolocaciones']}"
+        )
+    def cancelar_huerfanas(self, simbolos, abiertas=None):
+        """Cancela en paralelo los SL/TP que quedaron de posiciones ya cerradas"""
+        if not self.trader or not simbolos:
+            return
+        if abiertas is None:
+            abiertas = self.trader.ordenes_cierre_abiertas()
+        if abiertas is not None:
+            simbolos = [s for s in simbolos if abiertas.get(s)]
+        futuros = [
+            self.pool.submit(self.trader.cancelar_ordenes_cierre, simbolo, abiertas.get(simbolo) if abiertas is not None else None)
+            for simbolo in simbolos
+        ]
+        for futuro in futuros:
+            futuro.result()
+    def verificar_cierres(self, abiertas=None):
+        """Cuentas secundarias: libera las operaciones cuya posición ya no existe en el exchange"""
+        cerradas = []
+        simbolos = [s for s in self.operaciones if self.estado_cuenta.posiciones.get(s, 0.0) == 0.0]
+        try:
+            self.cancelar_huerfanas(simbolos, abiertas)
+        except Exception as e:
+            logger_ordenes.warning("⚠️ Error cancelando órdenes huérfanas de %s: %s", ', '.join(simbolos), e,
+                                   extra={'cuenta': self.nombre, 'etapa': 'cierre'})
+        for simbolo in simbolos:
+            del self.operaciones[simbolo]
+            cerradas.append(simbolo)
+            logger_ordenes.info("📊 %s cerrada en la cuenta %s", simbolo, self.nombre,
+                                extra={'cuenta': self.nombre, 'simbolo': simbolo, 'etapa': 'cierre'})
+        return cerradas
+    def ciclo(self):
+        """Mantenimiento por ciclo de una cuenta secundaria: foto de cuenta, cierres y protección"""
+        if not self.trader or not self.refrescar_estado_cuenta():
+            return []
+        abiertas = self.trader.ordenes_cierre_abiertas() if self.operaciones else None
+        cerradas = self.verificar_cierres(abiertas)
+        self.monitorear(self.operaciones, abiertas)
+        return cerradas
+# ---------------------------
 # Optimizador IA
 # ---------------------------
+ESPACIO_OPTIMIZACION = {
+    'min_trend_strength_degrees': [3, 5, 8, 10, 12, 15, 18, 20, 25, 30, 35, 40],
+    'min_pearson': [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+    'min_r2': [0.3, 0.4, 0.5, 0.6, 0.7, 0.8],
+    'min_channel_width_percent': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0, 10.0],
+    'stoch_sobreventa': [10, 15, 20, 25, 30, 35],
+    'stoch_sobrecompra': [65, 70, 75, 80, 85, 90]
+}
 class OptimizadorIA:
-    def __init__(self, log_path="operaciones_log.csv", min_samples=15):
+    def __init__(self, log_path="operaciones_log.csv", min_samples=15, reinicios=16, max_rondas=5, pliegues=4,
+                 min_operaciones_pliegue=5):
         self.log_path = log_path
         self.min_samples = min_samples
-        self.datos = self.cargar_datos()
+        self.reinicios = reinicios
+        self.max_rondas = max_rondas
+        self.pliegues = pliegues
+        self.min_operaciones_pliegue = min_operaciones_pliegue
+        self.datos = sorted(self.cargar_datos(), key=lambda op: op['timestamp'])
+        self.columnas = self.armar_columnas()
     def cargar_datos(self):
         datos = []
+        def leer(row, campo):
+            valor = row.get(campo)
+            return float(valor) if valor not in (None, '') else float('nan')
         try:
             with open(self.log_path, 'r', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
@@ -313,122 +1213,1475 @@ class OptimizadorIA:
                             'pearson': pearson, 
                             'r2': r2,
                             'ancho_relativo': ancho_relativo,
-                            'nivel_fuerza': nivel_fuerza
+                            'nivel_fuerza': nivel_fuerza,
+                            'timestamp': row.get('timestamp', ''),
+                            'tipo': row.get('tipo', ''),
+                            'ancho_porcentual': leer(row, 'ancho_canal_porcentual'),
+                            'stoch_k': leer(row, 'stoch_k'),
+                            'stoch_d': leer(row, 'stoch_d')
                         })
                     except Exception:
                         continue
         except FileNotFoundError:
-            print("⚠ No se encontró operaciones_log.csv (optimizador)")
+            logger_optimizador.warning("⚠️ No se encontró operaciones_log.csv (optimizador)", extra={'etapa': 'datos'})
         return datos
-    def evaluar_configuracion(self, trend_threshold, min_strength, entry_margin):
-        if not self.datos:
-            return -99999
-        filtradas = [
-            op for op in self.datos
-            if abs(op['angulo']) >= trend_threshold
-            and abs(op['angulo']) >= min_strength
-            and abs(op['pearson']) >= 0.4
-            and op.get('nivel_fuerza', 1) >= 2
-            and op.get('r2', 0) >= 0.4
-        ]
-        n = len(filtradas)
-        if n < max(8, int(0.15 * len(self.datos))):
+    def armar_columnas(self):
+        columnas = {
+            campo: np.array([op[campo] for op in self.datos], dtype=float)
+            for campo in ('pnl', 'angulo', 'pearson', 'r2', 'nivel_fuerza', 'ancho_porcentual', 'stoch_k', 'stoch_d')
+        }
+        columnas['long'] = np.array([op['tipo'] == 'LONG' for op in self.datos], dtype=bool)
+        columnas['short'] = np.array([op['tipo'] == 'SHORT' for op in self.datos], dtype=bool)
+        return columnas
+    def mascara_dimension(self, dimension, valor):
+        """Operaciones del log que habrían pasado el filtro `dimension >= / <= valor` (NaN = sin dato, pasa)"""
+        c = self.columnas
+        with np.errstate(invalid='ignore'):
+            if dimension == 'min_trend_strength_degrees':
+                return np.abs(c['angulo']) >= valor
+            if dimension == 'min_pearson':
+                return np.abs(c['pearson']) >= valor
+            if dimension == 'min_r2':
+                return c['r2'] >= valor
+            if dimension == 'min_channel_width_percent':
+                return np.isnan(c['ancho_porcentual']) | (c['ancho_porcentual'] >= valor)
+            sin_stoch = np.isnan(c['stoch_k']) | np.isnan(c['stoch_d'])
+            if dimension == 'stoch_sobreventa':
+                return ~c['long'] | sin_stoch | ((c['stoch_k'] <= valor) & (c['stoch_d'] <= valor))
+            if dimension == 'stoch_sobrecompra':
+                return ~c['short'] | sin_stoch | ((c['stoch_k'] >= valor) & (c['stoch_d'] >= valor))
+        raise ValueError(f"Dimensión desconocida: {dimension}")
+    def mascara_base(self):
+        return self.columnas['nivel_fuerza'] >= 2
+    def puntuar_mascara(self, mascara, total=None):
+        n = int(mascara.sum())
+        if n < max(8, int(0.15 * (total or len(self.datos)))):
             return -10000 - n
-        pnls = [op['pnl'] for op in filtradas]
-        pnl_mean = statistics.mean(pnls) if filtradas else 0
-        pnl_std = statistics.stdev(pnls) if len(pnls) > 1 else 0
-        winrate = sum(1 for op in filtradas if op['pnl'] > 0) / n if n > 0 else 0
+        pnls = self.columnas['pnl'][mascara]
+        pnl_mean = float(pnls.mean())
+        pnl_std = float(pnls.std(ddof=1)) if n > 1 else 0
+        winrate = float((pnls > 0).mean())
         score = (pnl_mean - 0.5 * pnl_std) * winrate * math.sqrt(n)
-        ops_calidad = [op for op in filtradas if op.get('r2', 0) >= 0.6 and op.get('nivel_fuerza', 1) >= 3]
-        if ops_calidad:
+        calidad = (self.columnas['r2'] >= 0.6) & (self.columnas['nivel_fuerza'] >= 3)
+        if np.any(calidad[mascara]):
             score *= 1.2
         return score
-    def buscar_mejores_parametros(self):
-        if not self.datos or len(self.datos) < self.min_samples:
-            print(f"ℹ️ No hay suficientes datos para optimizar (se requieren {self.min_samples}, hay {len(self.datos)})")
-            return None
+    def evaluar_configuracion(self, parametros):
+        if not self.datos:
+            return -99999
+        return self.puntuar_mascara(self.mascara_parametros(parametros))
+    def preparar_opciones(self, parametros_actuales):
+        """Por dimensión, agrupa los valores que filtran exactamente las mismas operaciones.
+        De cada grupo queda el valor más cercano al actual: el log no distingue entre ellos."""
+        opciones = {}
+        for dimension, valores in ESPACIO_OPTIMIZACION.items():
+            actual = parametros_actuales.get(dimension, valores[len(valores) // 2])
+            grupos = {}
+            for valor in valores:
+                mascara = self.mascara_dimension(dimension, valor)
+                grupos.setdefault(np.packbits(mascara).tobytes(), []).append((valor, mascara))
+            opciones[dimension] = [
+                min(grupo, key=lambda vm: abs(vm[0] - actual)) for grupo in grupos.values()
+            ]
+            opciones[dimension].sort(key=lambda vm: vm[0])
+        return opciones
+    def _buscar(self, opciones, parametros_actuales, filas=None):
+        """Descenso por coordenadas con reinicios; `filas` restringe la búsqueda a un subconjunto del log"""
+        dimensiones = [d for d, ops in opciones.items() if len(ops) > 1]
+        base = self.mascara_base()
+        total_filas = len(self.datos)
+        if filas is not None:
+            base = base & filas
+            total_filas = int(filas.sum())
+        memo = {}
+        def puntuar(seleccion):
+            mascara = base.copy()
+            for dimension, indice in seleccion.items():
+                mascara &= opciones[dimension][indice][1]
+            clave = np.packbits(mascara).tobytes()
+            if clave not in memo:
+                memo[clave] = self.puntuar_mascara(mascara, total_filas)
+            return memo[clave]
+        def indice_mas_cercano(dimension):
+            valores = [vm[0] for vm in opciones[dimension]]
+            actual = parametros_actuales.get(dimension, valores[len(valores) // 2])
+            return min(range(len(valores)), key=lambda i: abs(valores[i] - actual))
+        inicios = [{d: indice_mas_cercano(d) for d in opciones}]
+        rng = random.Random(total_filas)
+        for _ in range(self.reinicios):
+            inicios.append({d: rng.randrange(len(ops)) for d, ops in opciones.items()})
         mejor_score = -1e9
-        mejores_param = None
-        trend_values = [3, 5, 8, 10, 12, 15, 18, 20, 25, 30, 35, 40]
-        strength_values = [3, 5, 8, 10, 12, 15, 18, 20, 25, 30]
-        margin_values = [0.0005, 0.001, 0.0015, 0.002, 0.0025, 0.003, 0.004, 0.005, 0.008, 0.01]
-        combos = list(itertools.product(trend_values, strength_values, margin_values))
-        total = len(combos)
-        print(f"🔎 Optimizador: probando {total} combinaciones...")
-        for idx, (t, s, m) in enumerate(combos, start=1):
-            score = self.evaluar_configuracion(t, s, m)
+        mejor_seleccion = None
+        evaluaciones = 0
+        for seleccion in inicios:
+            score = puntuar(seleccion)
+            for _ in range(self.max_rondas):
+                mejoro = False
+                for dimension in dimensiones:
+                    for indice in range(len(opciones[dimension])):
+                        if indice == seleccion[dimension]:
+                            continue
+                        candidata = dict(seleccion, **{dimension: indice})
+                        evaluaciones += 1
+                        score_candidata = puntuar(candidata)
+                        if score_candidata > score:
+                            seleccion, score, mejoro = candidata, score_candidata, True
+                if not mejoro:
+                    break
             if score > mejor_score:
                 mejor_score = score
-                mejores_param = {
-                    'trend_threshold_degrees': t,
-                    'min_trend_strength_degrees': s,
-                    'entry_margin': m,
-                    'score': score,
-                    'evaluated_samples': len(self.datos),
-                    'total_combinations': total
-                }
-        if mejores_param:
-            print("✅ Optimizador: mejores parámetros encontrados:", mejores_param)
-            try:
-                with open("mejores_parametros.json", "w", encoding='utf-8') as f:
-                    json.dump(mejores_param, f, indent=2)
-            except Exception as e:
-                print("⚠ Error guardando mejores_parametros.json:", e)
+                mejor_seleccion = seleccion
+        parametros = {d: opciones[d][i][0] for d, i in mejor_seleccion.items()}
+        return parametros, mejor_score, evaluaciones, len(memo)
+    def mascara_parametros(self, parametros):
+        mascara = self.mascara_base()
+        for dimension, valor in parametros.items():
+            if dimension in ESPACIO_OPTIMIZACION:
+                mascara = mascara & self.mascara_dimension(dimension, valor)
+        return mascara
+    def armar_pliegues(self):
+        """Pliegues cronológicos: la segunda mitad del log se parte en bloques de prueba y cada uno
+        se entrena con la ventana móvil (de media historia) inmediatamente anterior"""
+        n = len(self.datos)
+        ventana = n // 2
+        cortes = np.linspace(ventana, n, self.pliegues + 1).astype(int)
+        indices = np.arange(n)
+        entrenamiento = np.zeros((self.pliegues, n), dtype=bool)
+        prueba = np.zeros((self.pliegues, n), dtype=bool)
+        for i in range(self.pliegues):
+            inicio, fin = cortes[i], cortes[i + 1]
+            entrenamiento[i] = (indices >= inicio - ventana) & (indices < inicio)
+            prueba[i] = (indices >= inicio) & (indices < fin)
+        return entrenamiento, prueba
+    def puntuar_pliegues(self, mascaras, prueba):
+        """Score fuera de muestra de todos los pliegues a la vez (una máscara de filtro por pliegue).
+        Un bloque con menos de `min_operaciones_pliegue` operaciones puntúa -10000, como en puntuar_mascara:
+        si no operar puntuara 0, unos filtros que lo descartan todo le ganarían a cualquier score negativo."""
+        seleccion = (mascaras & prueba).astype(float)
+        pnl = self.columnas['pnl']
+        n = seleccion.sum(axis=1)
+        suma = seleccion @ pnl
+        suma_cuadrados = seleccion @ (pnl * pnl)
+        ganadoras = seleccion @ (pnl > 0).astype(float)
+        calidad = (self.columnas['r2'] >= 0.6) & (self.columnas['nivel_fuerza'] >= 3)
+        con_calidad = (seleccion @ calidad.astype(float)) > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            media = np.where(n > 0, suma / n, 0.0)
+            varianza = np.where(n > 1, (suma_cuadrados - n * media * media) / (n - 1), 0.0)
+            winrate = np.where(n > 0, ganadoras / n, 0.0)
+        std = np.sqrt(np.maximum(varianza, 0.0))
+        scores = (media - 0.5 * std) * winrate * np.sqrt(n)
+        scores = np.where(con_calidad, scores * 1.2, scores)
+        return np.where(n >= self.min_operaciones_pliegue, scores, -10000.0)
+    def validar_walk_forward(self, opciones, parametros_actuales):
+        """Re-optimiza en cada ventana de entrenamiento y compara, en los bloques de prueba siguientes,
+        contra la configuración actual. Devuelve (score_oos_optimizado, score_oos_actual)."""
+        entrenamiento, prueba = self.armar_pliegues()
+        mascaras_optimizadas = np.array([
+            self.mascara_parametros(self._buscar(opciones, parametros_actuales, filas)[0])
+            for filas in entrenamiento
+        ])
+        mascara_actual = self.mascara_parametros(parametros_actuales)
+        oos_optimizado = self.puntuar_pliegues(mascaras_optimizadas, prueba)
+        oos_actual = self.puntuar_pliegues(mascara_actual[np.newaxis, :], prueba)
+        return float(oos_optimizado.mean()), float(oos_actual.mean())
+    def buscar_mejores_parametros(self, parametros_actuales=None):
+        if not self.datos or len(self.datos) < self.min_samples:
+            logger_optimizador.info("ℹ️ No hay suficientes datos para optimizar (se requieren %s, hay %s)", self.min_samples, len(self.datos), extra={'etapa': 'datos'})
+            return None
+        parametros_actuales = parametros_actuales or {}
+        opciones = self.preparar_opciones(parametros_actuales)
+        dimensiones = [d for d, ops in opciones.items() if len(ops) > 1]
+        total = int(np.prod([len(valores) for valores in ESPACIO_OPTIMIZACION.values()]))
+        logger_optimizador.info("🔎 Optimizador: búsqueda por coordenadas en %s dimensiones activas (espacio de %s combinaciones)",
+                                len(dimensiones), total, extra={'etapa': 'busqueda'})
+        parametros, score, evaluaciones, filtros = self._buscar(opciones, parametros_actuales)
+        if score <= -10000:
+            logger_optimizador.info("⚠️ No se encontró una configuración mejor", extra={'etapa': 'busqueda'})
+            return None
+        if parametros_actuales:
+            minimo_walk_forward = self.pliegues * self.min_operaciones_pliegue * 2
+            if len(self.datos) < minimo_walk_forward:
+                logger_optimizador.info("ℹ️ Walk-forward omitido: se requieren %s operaciones para %s pliegues de %s, hay %s; se descartan los parámetros",
+                                        minimo_walk_forward, self.pliegues, self.min_operaciones_pliegue, len(self.datos), extra={'etapa': 'walk_forward'})
+                return None
+            oos_optimizado, oos_actual = self.validar_walk_forward(opciones, parametros_actuales)
+            logger_optimizador.info("🧪 Walk-forward (%s pliegues): fuera de muestra %.3f vs configuración actual %.3f",
+                                    self.pliegues, oos_optimizado, oos_actual, extra={'etapa': 'walk_forward'})
+            if oos_optimizado <= oos_actual:
+                logger_optimizador.info("⚠️ Optimizador: los parámetros no superan a la configuración actual fuera de muestra; se descartan", extra={'etapa': 'walk_forward'})
+                return None
         else:
-            print("⚠ No se encontró una configuración mejor")
+            oos_optimizado = oos_actual = None
+        mejores_param = dict(parametros)
+        mejores_param.update({
+            'score': score,
+            'score_oos': oos_optimizado,
+            'score_oos_actual': oos_actual,
+            'evaluated_samples': len(self.datos),
+            'total_combinations': total,
+            'evaluaciones': evaluaciones,
+            'filtros_distintos': filtros
+        })
+        logger_optimizador.info("✅ Optimizador: mejores parámetros encontrados: %s", mejores_param, extra={'etapa': 'busqueda'})
+        try:
+            with open("mejores_parametros.json", "w", encoding='utf-8') as f:
+                json.dump(mejores_param, f, indent=2)
+        except Exception as e:
+            logger_optimizador.error("❌ Error guardando mejores_parametros.json: %s", e, extra={'etapa': 'busqueda'})
         return mejores_param
+def _ejecutar_optimizador(log_path, min_samples, min_operaciones_pliegue, parametros_actuales, cola):
+    # Proceso hijo: sin esto sus registros no tendrían manejador
+    configurar_logging(config)
+    try:
+        ia = OptimizadorIA(log_path=log_path, min_samples=min_samples, min_operaciones_pliegue=min_operaciones_pliegue)
+        cola.put(ia.buscar_mejores_parametros(parametros_actuales))
+    except Exception as e:
+        logger_optimizador.error("❌ Error en proceso optimizador: %s", e, extra={'etapa': 'proceso'})
+        cola.put(None)
+class ProcesoOptimizador:
+    """Corre OptimizadorIA en un proceso aparte para no bloquear el hilo de trading"""
+    def __init__(self, timeout_segundos=600, espera_reintento_segundos=1800, min_operaciones_pliegue=5):
+        self.timeout_segundos = timeout_segundos
+        self.espera_reintento_segundos = espera_reintento_segundos
+        self.min_operaciones_pliegue = min_operaciones_pliegue
+        self.contexto = multiprocessing.get_context('spawn')
+        self.proceso = None
+        self.cola = None
+        self.inicio = None
+        self.fin = None
+    def en_curso(self):
+        return self.proceso is not None
+    def lanzar(self, log_path, min_samples, parametros_actuales=None):
+        if self.proceso is not None:
+            return False
+        if self.fin is not None and time.time() - self.fin < self.espera_reintento_segundos:
+            return False
+        self.cola = self.contexto.Queue(maxsize=1)
+        self.proceso = self.contexto.Process(
+            target=_ejecutar_optimizador,
+            args=(log_path, min_samples, self.min_operaciones_pliegue, parametros_actuales, self.cola),
+            name='optimizador-ia', daemon=True
+        )
+        self.proceso.start()
+        self.inicio = time.time()
+        return True
+    def recoger(self):
+        """Devuelve (terminado, parametros) sin bloquear; cancela el proceso si supera el timeout"""
+        if self.proceso is None:
+            return False, None
+        parametros = None
+        try:
+            parametros = self.cola.get_nowait()
+        except queue.Empty:
+            if self.proceso.is_alive():
+                if time.time() - self.inicio < self.timeout_segundos:
+                    return False, None
+                logger_optimizador.warning("⏱️ Optimizador cancelado tras %ss", self.timeout_segundos, extra={'etapa': 'proceso'})
+                self.proceso.terminate()
+            else:
+                try:
+                    parametros = self.cola.get(timeout=1)
+                except queue.Empty:
+                    logger_optimizador.warning("⚠️ El proceso optimizador terminó sin resultado", extra={'etapa': 'proceso'})
+        self.proceso.join(timeout=5)
+        self.cola.close()
+        self.proceso = None
+        self.cola = None
+        self.fin = time.time()
+        return True, parametros
+    def detener(self):
+        if self.proceso is not None and self.proceso.is_alive():
+            self.proceso.terminate()
 # ---------------------------
-# BOT PRINCIPAL - BREAKOUT + REENTRY (MEJORADO)
+# COORDINACIÓN DE SHARDS (VARIAS INSTANCIAS)
 # ---------------------------
-class TradingBot:
-    def __init__(self, config):
-        self.config = config
-        self.log_path = config.get('log_path', 'operaciones_log.csv')
-        self.auto_optimize = config.get('auto_optimize', True)
-        self.ultima_optimizacion = datetime.now()
-        self.operaciones_desde_optimizacion = 0
-        self.total_operaciones = 0
-        self.breakout_history = {}
-        self.config_optima_por_simbolo = {}
-        self.ultima_busqueda_config = {}
-        self.breakouts_detectados = {}
-        self.esperando_reentry = {}
-        self.estado_file = config.get('estado_file', 'estado_bot.json')
-        self.cargar_estado()
-        self.trader = BinanceTrader(
-            api_key=config['binance_api_key'],
-            secret_key=config['binance_secret_key'],
-            testnet=config.get('binance_testnet', True)
-        )
-        if not self.trader.check_connection():
-            print("❌ No se pudo conectar a Binance. El bot no operará.")
-            self.trader = None
-        if self.auto_optimize:
-            try:
-                ia = OptimizadorIA(log_path=self.log_path, min_samples=config.get('min_samples_optimizacion', 15))
-                parametros_optimizados = ia.buscar_mejores_parametros()
-                if parametros_optimizados:
-                    self.config['trend_threshold_degrees'] = parametros_optimizados.get('trend_threshold_degrees', self.config.get('trend_threshold_degrees', 13))
-                    self.config['min_trend_strength_degrees'] = parametros_optimizados.get('min_trend_strength_degrees', self.config.get('min_trend_strength_degrees', 16))
-                    self.config['entry_margin'] = parametros_optimizados.get('entry_margin', self.config.get('entry_margin', 0.001))
-            except Exception as e:
-                print("⚠ Error en optimización automática:", e)
-        self.ultimos_datos = {}
-        self.operaciones_activas = {}
-        self.senales_enviadas = set()
-        self.archivo_log = self.log_path
-        self.inicializar_log()
-        self.indice_simbolo_actual = getattr(self, 'indice_simbolo_actual', 0)
-    def cargar_estado(self):
+class CoordinadorShards:
+    """Reparte los símbolos entre instancias vivas (rendezvous hashing) usando un SQLite compartido"""
+    def __init__(self, db_path, instancia_id, lease_segundos=90, max_posiciones_globales=5):
+        self.db_path = db_path
+        self.instancia_id = instancia_id
+        self.lease_segundos = lease_segundos
+        self.max_posiciones_globales = max_posiciones_globales
+        self._detener = threading.Event()
+        self._hilo_latido = None
+        conn = self._conectar()
         try:
-            if os.path.exists(self.estado_file):
-                with open(self.estado_file, 'r', encoding='utf-8') as f:
-                    estado = json.load(f)
-                if 'ultima_optimizacion' in estado:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS instancias ("
+                "instancia_id TEXT PRIMARY KEY, ultimo_latido REAL NOT NULL, host TEXT, pid INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS posiciones ("
+                "simbolo TEXT PRIMARY KEY, instancia_id TEXT NOT NULL, timestamp REAL NOT NULL, datos TEXT)"
+            )
+        finally:
+            conn.close()
+        self.latido()
+    def _conectar(self):
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+    def latido(self):
+        try:
+            conn = self._conectar()
+            try:
+                conn.execute(
+                    "INSERT INTO instancias (instancia_id, ultimo_latido, host, pid) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(instancia_id) DO UPDATE SET ultimo_latido=excluded.ultimo_latido, "
+                    "host=excluded.host, pid=excluded.pid",
+                    (self.instancia_id, time.time(), socket.gethostname(), os.getpid())
+                )
+            finally:
+                conn.close()
+            return True
+        except Exception as e:
+            logger_coordinador.error("❌ Error registrando latido de la instancia %s: %s", self.instancia_id, e, extra={'etapa': 'latido'})
+            return False
+    def iniciar_latidos(self):
+        if self._hilo_latido and self._hilo_latido.is_alive():
+            return
+        def _bucle():
+            intervalo = max(5, self.lease_segundos / 3)
+            while not self._detener.wait(intervalo):
+                self.latido()
+        self._hilo_latido = threading.Thread(target=_bucle, daemon=True)
+        self._hilo_latido.start()
+    def retirar(self):
+        self._detener.set()
+        try:
+            conn = self._conectar()
+            try:
+                conn.execute("DELETE FROM instancias WHERE instancia_id = ?", (self.instancia_id,))
+            finally:
+                conn.close()
+        except Exception as e:
+            logger_coordinador.error("❌ Error retirando la instancia %s: %s", self.instancia_id, e, extra={'etapa': 'retiro'})
+    def instancias_vivas(self):
+        limite = time.time() - self.lease_segundos
+        try:
+            conn = self._conectar()
+            try:
+                filas = conn.execute(
+                    "SELECT instancia_id FROM instancias WHERE ultimo_latido >= ?", (limite,)
+                ).fetchall()
+            finally:
+                conn.close()
+            vivas = {fila[0] for fila in filas}
+        except Exception as e:
+            logger_coordinador.error("❌ Error leyendo instancias vivas: %s", e, extra={'etapa': 'latido'})
+            vivas = set()
+        vivas.add(self.instancia_id)
+        return sorted(vivas)
+    @staticmethod
+    def _peso(instancia_id, simbolo):
+        digest = hashlib.sha1(f"{instancia_id}:{simbolo}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+    def propietario(self, simbolo, vivas=None):
+        vivas = vivas or self.instancias_vivas()
+        return max(vivas, key=lambda instancia: self._peso(instancia, simbolo))
+    def filtrar_simbolos(self, simbolos):
+        vivas = self.instancias_vivas()
+        return [s for s in simbolos if self.propietario(s, vivas) == self.instancia_id]
+    def reservar_posicion(self, simbolo):
+        """Reserva un hueco del límite global de posiciones; False si el límite está completo"""
+        try:
+            conn = self._conectar()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                fila = conn.execute(
+                    "SELECT instancia_id FROM posiciones WHERE simbolo = ?", (simbolo,)
+                ).fetchone()
+                if fila:
+                    conn.execute("ROLLBACK")
+                    return fila[0] == self.instancia_id
+                total = conn.execute("SELECT COUNT(*) FROM posiciones").fetchone()[0]
+                if total >= self.max_posiciones_globales:
+                    conn.execute("ROLLBACK")
+                    return False
+                conn.execute(
+                    "INSERT INTO posiciones (simbolo, instancia_id, timestamp, datos) VALUES (?, ?, ?, NULL)",
+                    (simbolo, self.instancia_id, time.time())
+                )
+                conn.execute("COMMIT")
+                return True
+            finally:
+                conn.close()
+        except Exception as e:
+            logger_coordinador.error("❌ Error reservando posición global para %s: %s", simbolo, e, extra={'simbolo': simbolo, 'etapa': 'reserva'})
+            return False
+    def actualizar_posicion(self, simbolo, operacion):
+        try:
+            conn = self._conectar()
+            try:
+                conn.execute(
+                    "UPDATE posiciones SET datos = ? WHERE simbolo = ? AND instancia_id = ?",
+                    (json.dumps(operacion, ensure_ascii=False), simbolo, self.instancia_id)
+                )
+            finally:
+                conn.close()
+        except Exception as e:
+            logger_coordinador.error("❌ Error actualizando posición global de %s: %s", simbolo, e, extra={'simbolo': simbolo, 'etapa': 'reserva'})
+    def registrar_posiciones(self, operaciones):
+        """Registra al arrancar las posiciones ya abiertas por esta instancia (p. ej. de antes de activar el modo
+        shard) para que cuenten en el límite global aunque lo superen"""
+        if not operaciones:
+            return
+        try:
+            conn = self._conectar()
+            try:
+                conn.executemany(
+                    "INSERT INTO posiciones (simbolo, instancia_id, timestamp, datos) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(simbolo) DO NOTHING",
+                    [(simbolo, self.instancia_id, time.time(), json.dumps(operacion, ensure_ascii=False))
+                     for simbolo, operacion in operaciones.items()]
+                )
+            finally:
+                conn.close()
+        except Exception as e:
+            logger_coordinador.error("❌ Error registrando posiciones abiertas en el coordinador: %s", e, extra={'etapa': 'reserva'})
+    def liberar_posicion(self, simbolo):
+        try:
+            conn = self._conectar()
+            try:
+                conn.execute(
+                    "DELETE FROM posiciones WHERE simbolo = ? AND instancia_id = ?",
+                    (simbolo, self.instancia_id)
+                )
+            finally:
+                conn.close()
+        except Exception as e:
+            logger_coordinador.error("❌ Error liberando posición global de %s: %s", simbolo, e, extra={'simbolo': simbolo, 'etapa': 'liberacion'})
+    def adoptar_posiciones_huerfanas(self, simbolos_propios):
+        """Toma las posiciones de instancias caídas cuyos símbolos ahora pertenecen a esta instancia"""
+        adoptadas = {}
+        if not simbolos_propios:
+            return adoptadas
+        vivas = set(self.instancias_vivas())
+        try:
+            conn = self._conectar()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                filas = conn.execute("SELECT simbolo, instancia_id, datos FROM posiciones").fetchall()
+                for simbolo, instancia_id, datos in filas:
+                    if instancia_id in vivas or simbolo not in simbolos_propios:
+                        continue
+                    conn.execute(
+                        "UPDATE posiciones SET instancia_id = ? WHERE simbolo = ?",
+                        (self.instancia_id, simbolo)
+                    )
+                    adoptadas[simbolo] = json.loads(datos) if datos else None
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+        except Exception as e:
+            logger_coordinador.error("❌ Error adoptando posiciones huérfanas: %s", e, extra={'etapa': 'adopcion'})
+            return {}
+        return adoptadas
+# ---------------------------
+# BUFFERS DE VELAS Y REGISTROS COMPACTOS
+# ---------------------------
+COLUMNAS_VELA = ('apertura', 'open', 'maximo', 'minimo', 'cierre', 'volumen')
+class BufferVelas:
+    """Ring buffer float64 de velas (apertura + OHLCV); las ventanas salen como copia contigua tomada bajo el lock"""
+    def __init__(self, capacidad=512):
+        self.capacidad = capacidad
+        # Cada vela se escribe en p y p + capacidad: cualquier ventana <= capacidad es un slice contiguo
+        self._datos = np.zeros((len(COLUMNAS_VELA), 2 * capacidad), dtype=np.float64)
+        self._cabeza = 0
+        self._largo = 0
+        self.lock = threading.Lock()
+    def __len__(self):
+        return self._largo
+    def ultima_apertura(self):
+        if not self._largo:
+            return None
+        return self._datos[0, (self._cabeza + self._largo - 1) % self.capacidad]
+    def _escribir(self, posicion, fila):
+        self._datos[:, posicion] = fila
+        self._datos[:, posicion + self.capacidad] = fila
+    def agregar(self, filas):
+        """filas: array (k, 6) ordenado por apertura; la vela en curso se sobrescribe, las viejas se ignoran"""
+        with self.lock:
+            for fila in filas:
+                ultima = self.ultima_apertura()
+                if ultima is not None and fila[0] < ultima:
+                    continue
+                if ultima is not None and fila[0] == ultima:
+                    self._escribir((self._cabeza + self._largo - 1) % self.capacidad, fila)
+                elif self._largo < self.capacidad:
+                    self._escribir((self._cabeza + self._largo) % self.capacidad, fila)
+                    self._largo += 1
+                else:
+                    self._escribir(self._cabeza, fila)
+                    self._cabeza = (self._cabeza + 1) % self.capacidad
+    def ventana(self, n):
+        """Copia (6, n) de las últimas n velas: los hilos de configuración óptima siguen agregando al mismo
+        buffer mientras el escaneo calcula, así que una vista podría cambiar a mitad del cálculo"""
+        with self.lock:
+            n = min(n, self._largo)
+            inicio = (self._cabeza + self._largo - n) % self.capacidad
+            return self._datos[:, inicio:inicio + n].copy()
+    @staticmethod
+    def desde_klines(klines):
+        return np.asarray([vela[:6] for vela in klines], dtype=np.float64)
+def resamplear_velas(ventana, segundos_timeframe):
+    """Agrega velas base (6, n) a un timeframe mayor alineado a UTC; la última vela puede estar en curso"""
+    if ventana.shape[1] == 0:
+        return ventana.copy()
+    tf_ms = segundos_timeframe * 1000
+    buckets = (ventana[0] // tf_ms) * tf_ms
+    inicios = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    finales = np.append(inicios[1:], ventana.shape[1]) - 1
+    velas = np.empty((len(COLUMNAS_VELA), len(inicios)), dtype=np.float64)
+    velas[0] = buckets[inicios]
+    velas[1] = ventana[1, inicios]
+    velas[2] = np.maximum.reduceat(ventana[2], inicios)
+    velas[3] = np.minimum.reduceat(ventana[3], inicios)
+    velas[4] = ventana[4, finales]
+    velas[5] = np.add.reduceat(ventana[5], inicios)
+    # La primera vela queda incompleta si la historia base empieza a mitad del bucket
+    if ventana[0, 0] != buckets[0]:
+        velas = velas[:, 1:]
+    return velas
+class ArchivoVelas:
+    """Archivo en disco de velas cerradas: un binario append-only por (símbolo, timeframe) con registros
+    fijos de 6 float64 (apertura + OHLCV), leído con memmap sin copia. Sirve el arranque en caliente y backtests."""
+    ANCHO_REGISTRO = len(COLUMNAS_VELA) * 8
+    def __init__(self, directorio):
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+        self._mapas = {}
+        self._locks = {}
+        self._lock_global = threading.Lock()
+        for nombre in os.listdir(directorio):
+            if nombre.endswith('.bin'):
+                self._recortar_registro_parcial(os.path.join(directorio, nombre))
+    def ruta(self, simbolo, timeframe):
+        return os.path.join(self.directorio, f"{simbolo}_{timeframe}.bin")
+    def _recortar_registro_parcial(self, ruta):
+        """Una escritura cortada a mitad de registro (caída o redeploy) deja bytes sueltos al final: se descartan
+        para que el próximo append no quede desalineado"""
+        try:
+            tamano = os.path.getsize(ruta)
+        except OSError:
+            return
+        sobrante = tamano % self.ANCHO_REGISTRO
+        if sobrante:
+            os.truncate(ruta, tamano - sobrante)
+            logger_escaneo.warning("⚠️ Archivo de velas %s: descartados %s bytes de un registro incompleto", ruta, sobrante, extra={'etapa': 'archivo_velas'})
+    def _lock(self, clave):
+        with self._lock_global:
+            return self._locks.setdefault(clave, threading.Lock())
+    def leer(self, simbolo, timeframe):
+        """Vista memmap (n, 6) de todo el archivo, o None si no existe; se re-mapea solo si el archivo creció"""
+        ruta = self.ruta(simbolo, timeframe)
+        try:
+            tamano = os.path.getsize(ruta)
+        except OSError:
+            return None
+        registros = tamano // self.ANCHO_REGISTRO
+        if registros == 0:
+            return None
+        clave = (simbolo, timeframe)
+        mapa = self._mapas.get(clave)
+        if mapa is None or mapa.shape[0] != registros:
+            mapa = np.memmap(ruta, dtype=np.float64, mode='r', shape=(registros, len(COLUMNAS_VELA)))
+            self._mapas[clave] = mapa
+        return mapa
+    def ultima_apertura(self, simbolo, timeframe):
+        mapa = self.leer(simbolo, timeframe)
+        return None if mapa is None else mapa[-1, 0]
+    def ultimas(self, simbolo, timeframe, n):
+        mapa = self.leer(simbolo, timeframe)
+        return None if mapa is None else mapa[-n:]
+    def rango(self, simbolo, timeframe, desde_ms=None, hasta_ms=None):
+        """Velas con apertura en [desde_ms, hasta_ms) por búsqueda binaria sobre la columna de aperturas"""
+        mapa = self.leer(simbolo, timeframe)
+        if mapa is None:
+            return None
+        aperturas = mapa[:, 0]
+        inicio = 0 if desde_ms is None else int(np.searchsorted(aperturas, desde_ms, side='left'))
+        fin = len(aperturas) if hasta_ms is None else int(np.searchsorted(aperturas, hasta_ms, side='left'))
+        return mapa[inicio:fin]
+    def agregar(self, simbolo, timeframe, filas, ahora_ms=None):
+        """Agrega al final las velas cerradas más nuevas que la última archivada; devuelve cuántas escribió"""
+        if filas is None or len(filas) == 0:
+            return 0
+        tf_ms = INTERVALOS_SEGUNDOS[timeframe] * 1000
+        ahora_ms = ahora_ms if ahora_ms is not None else time.time() * 1000
+        with self._lock((simbolo, timeframe)):
+            ultima = self.ultima_apertura(simbolo, timeframe)
+            filas = np.asarray(filas, dtype=np.float64)
+            seleccion = filas[:, 0] + tf_ms <= ahora_ms
+            if ultima is not None:
+                seleccion &= filas[:, 0] > ultima
+            nuevas = filas[seleccion]
+            if not len(nuevas):
+                return 0
+            self._recortar_registro_parcial(self.ruta(simbolo, timeframe))
+            with open(self.ruta(simbolo, timeframe), 'ab') as f:
+                f.write(np.ascontiguousarray(nuevas).tobytes())
+            return len(nuevas)
+class RegistroSlots:
+    """Registro tipado con __slots__ y acceso estilo dict para el código existente"""
+    __slots__ = ()
+    CAMPOS = ()
+    def __init__(self, **valores):
+        for campo in self.CAMPOS:
+            setattr(self, campo, valores.get(campo))
+    def __getitem__(self, clave):
+        try:
+            return getattr(self, clave)
+        except AttributeError:
+            raise KeyError(clave)
+    def __setitem__(self, clave, valor):
+        setattr(self, clave, valor)
+    def __contains__(self, clave):
+        # Un campo en None equivale a una clave ausente del dict original: 'x' in registro y get() coinciden
+        return getattr(self, clave, None) is not None
+    def get(self, clave, defecto=None):
+        valor = getattr(self, clave, None)
+        return defecto if valor is None else valor
+    def a_dict(self):
+        return {campo: getattr(self, campo) for campo in self.CAMPOS}
+    @classmethod
+    def desde_dict(cls, datos):
+        return cls(**{campo: datos.get(campo) for campo in cls.CAMPOS})
+    def __repr__(self):
+        return f"{type(self).__name__}({self.a_dict()})"
+class CanalInfo(RegistroSlots):
+    CAMPOS = (
+        'resistencia', 'soporte', 'resistencia_media', 'soporte_media', 'linea_tendencia',
+        'pendiente_tendencia', 'precio_actual', 'ancho_canal', 'ancho_canal_porcentual',
+        'angulo_tendencia', 'coeficiente_pearson', 'fuerza_texto', 'nivel_fuerza', 'direccion',
+        'r2_score', 'pendiente_resistencia', 'pendiente_soporte', 'stoch_k', 'stoch_d',
+        'timeframe', 'num_velas'
+    )
+    __slots__ = CAMPOS
+class OperacionActiva(RegistroSlots):
+    CAMPOS = (
+        'tipo', 'precio_entrada', 'take_profit', 'stop_loss', 'timestamp_entrada',
+        'angulo_tendencia', 'pearson', 'r2_score', 'ancho_canal_relativo', 'ancho_canal_porcentual',
+        'nivel_fuerza', 'timeframe_utilizado', 'velas_utilizadas', 'stoch_k', 'stoch_d', 'breakout_usado',
+        'cantidad', 'orden_sl_id', 'orden_tp_id', 'id_senal', 'recolocaciones',
+        'precio_fill_entrada', 'slippage_entrada_bps', 'ms_config', 'ms_orden', 'ms_fill', 'ms_sl', 'ms_tp'
+    )
+    __slots__ = CAMPOS
+# ---------------------------
+# PLANIFICADOR ALINEADO A CIERRE DE VELA
+# ---------------------------
+INTERVALOS_SEGUNDOS = {
+    '1m': 60, '3m': 180, '5m': 300, '15m': 900, '30m': 1800,
+    '1h': 3600, '2h': 7200, '4h': 14400, '6h': 21600, '8h': 28800, '12h': 43200, '1d': 86400
+}
+class PlanificadorVelas:
+    """Decide qué símbolos tienen una vela cerrada sin evaluar según su timeframe óptimo"""
+    def __init__(self, retraso_cierre_segundos=3):
+        self.retraso = retraso_cierre_segundos
+        self.ultima_vela_evaluada = {}
+        self.primera_pendiente = {}
+    def apertura_ultima_vela_cerrada(self, timeframe, ahora=None):
+        segundos = INTERVALOS_SEGUNDOS.get(timeframe)
+        if not segundos:
+            return None
+        ahora = (ahora if ahora is not None else time.time()) - self.retraso
+        return int(ahora // segundos) * segundos - segundos
+    def vela_pendiente(self, simbolo, timeframe, ahora=None):
+        ultima_cerrada = self.apertura_ultima_vela_cerrada(timeframe, ahora)
+        if ultima_cerrada is None:
+            return False
+        return self.ultima_vela_evaluada.get(simbolo, -1) < ultima_cerrada
+    def segundos_esperando(self, simbolo, timeframe, ahora=None):
+        """Segundos desde el cierre de la vela pendiente más antigua del símbolo (0 si no tiene ninguna)"""
+        segundos = INTERVALOS_SEGUNDOS.get(timeframe)
+        ahora = ahora if ahora is not None else time.time()
+        ultima_cerrada = self.apertura_ultima_vela_cerrada(timeframe, ahora)
+        if ultima_cerrada is None:
+            return 0.0
+        evaluada = self.ultima_vela_evaluada.get(simbolo)
+        if evaluada is None:
+            # Nunca evaluado: la espera cuenta desde la primera vela que se le vio pendiente
+            evaluada = self.primera_pendiente.setdefault(simbolo, ultima_cerrada) - segundos
+        if evaluada >= ultima_cerrada:
+            return 0.0
+        return max(0.0, ahora - self.retraso - (evaluada + 2 * segundos))
+    def marcar_evaluado(self, simbolo, timeframe, ahora=None):
+        ultima_cerrada = self.apertura_ultima_vela_cerrada(timeframe, ahora)
+        if ultima_cerrada is not None:
+            self.ultima_vela_evaluada[simbolo] = ultima_cerrada
+            self.primera_pendiente.pop(simbolo, None)
+    def segundos_hasta_proximo_cierre(self, timeframes, ahora=None):
+        ahora = ahora if ahora is not None else time.time()
+        esperas = []
+        for timeframe in timeframes:
+            segundos = INTERVALOS_SEGUNDOS.get(timeframe)
+            if not segundos:
+                continue
+            proximo_cierre = (int((ahora - self.retraso) // segundos) + 1) * segundos + self.retraso
+            esperas.append(proximo_cierre - ahora)
+        return min(esperas) if esperas else None
+# ---------------------------
+# CORRELACIÓN MÓVIL DEL UNIVERSO (RIESGO DE CLUSTER)
+# ---------------------------
+class MatrizCorrelacion:
+    """Correlación de retornos log entre todos los símbolos sobre las últimas `ventana` velas base.
+    Cada vela cerrada aporta una columna y actualiza sumas y productos cruzados con un rank-1 (O(n²) vectorizado)."""
+    def __init__(self, ventana=96, min_muestras=24):
+        self.ventana = ventana
+        self.min_muestras = min_muestras
+        self.indice = {}
+        self.retornos = np.zeros((0, ventana))
+        self.sumas = np.zeros(0)
+        self.productos = np.zeros((0, 0))
+        self.ultimos_precios = np.zeros(0)
+        self.posicion = 0
+        self.muestras = 0
+        self.ultima_apertura = None
+        self.desde_recalculo = 0
+        self.lock = threading.Lock()
+    def _asegurar(self, simbolos):
+        nuevos = [s for s in simbolos if s not in self.indice]
+        if not nuevos:
+            return
+        for simbolo in nuevos:
+            self.indice[simbolo] = len(self.indice)
+        k = len(nuevos)
+        self.retornos = np.vstack([self.retornos, np.zeros((k, self.ventana))])
+        self.sumas = np.concatenate([self.sumas, np.zeros(k)])
+        self.productos = np.pad(self.productos, ((0, k), (0, k)))
+        self.ultimos_precios = np.concatenate([self.ultimos_precios, np.full(k, np.nan)])
+    def agregar_vela(self, apertura, precios):
+        """precios: {simbolo: cierre}. Sin precio (o sin cierre previo) el retorno de la vela cuenta como 0."""
+        with self.lock:
+            if self.ultima_apertura is not None and apertura <= self.ultima_apertura:
+                return False
+            self._asegurar(precios)
+            filas = np.fromiter((self.indice[s] for s in precios), dtype=np.intp, count=len(precios))
+            actuales = self.ultimos_precios.copy()
+            actuales[filas] = np.fromiter(precios.values(), dtype=np.float64, count=len(precios))
+            primera = self.ultima_apertura is None
+            self.ultima_apertura = apertura
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = np.log(actuales / self.ultimos_precios)
+            self.ultimos_precios = actuales
+            if primera:
+                return True
+            x = np.where(np.isfinite(x), x, 0.0)
+            saliente = self.retornos[:, self.posicion].copy()
+            self.retornos[:, self.posicion] = x
+            self.posicion = (self.posicion + 1) % self.ventana
+            self.muestras = min(self.muestras + 1, self.ventana)
+            self.desde_recalculo += 1
+            if self.desde_recalculo >= self.ventana:
+                # Recalculo exacto una vez por ventana para que no se acumule error de redondeo
+                self.productos = self.retornos @ self.retornos.T
+                self.sumas = self.retornos.sum(axis=1)
+                self.desde_recalculo = 0
+            else:
+                self.sumas += x - saliente
+                self.productos += np.outer(x, x) - np.outer(saliente, saliente)
+            return True
+    def correlaciones(self, simbolo, otros):
+        """ρ entre `simbolo` y cada uno de `otros`; 0 mientras no haya historia suficiente"""
+        with self.lock:
+            if self.muestras < self.min_muestras or simbolo not in self.indice:
+                return {otro: 0.0 for otro in otros}
+            presentes = [o for o in otros if o in self.indice]
+            i = self.indice[simbolo]
+            js = np.fromiter((self.indice[o] for o in presentes), dtype=np.intp, count=len(presentes))
+            k = self.muestras
+            media_i = self.sumas[i] / k
+            medias_j = self.sumas[js] / k
+            var_i = self.productos[i, i] / k - media_i ** 2
+            var_j = self.productos[js, js] / k - medias_j ** 2
+            cov = self.productos[i, js] / k - media_i * medias_j
+            denominador = np.sqrt(np.maximum(var_i * var_j, 0.0))
+            rho = np.where(denominador > 1e-18, cov / np.where(denominador > 1e-18, denominador, 1.0), 0.0)
+        resultado = {otro: 0.0 for otro in otros}
+        resultado.update(zip(presentes, np.clip(rho, -1.0, 1.0).tolist()))
+        return resultado
+# ---------------------------
+# PRIORIZACIÓN DE SÍMBOLOS POR CERCANÍA AL BORDE DEL CANAL
+# ---------------------------
+class PriorizadorSimbolos:
+    """Ordena los candidatos del ciclo y garantiza un piso de equidad para que ningún símbolo quede sin evaluar"""
+    def __init__(self, peso_proximidad=3.0, peso_reentry=5.0, peso_antiguedad=1.0, peso_volatilidad=1.0,
+                 espera_maxima_segundos=1800):
+        self.peso_proximidad = peso_proximidad
+        self.peso_reentry = peso_reentry
+        self.peso_antiguedad = peso_antiguedad
+        self.peso_volatilidad = peso_volatilidad
+        self.espera_maxima_segundos = espera_maxima_segundos
+    def puntuar(self, canal, precio, esperando_reentry, segundos_sin_evaluar, segundos_timeframe, volatilidad_pct):
+        if canal and canal['ancho_canal'] > 0 and precio:
+            if canal['soporte'] <= precio <= canal['resistencia']:
+                distancia = min(precio - canal['soporte'], canal['resistencia'] - precio) / canal['ancho_canal']
+            else:
+                distancia = 0.0
+            proximidad = 1.0 - 2 * min(distancia, 0.5)
+        else:
+            proximidad = 1.0
+        antiguedad = min(segundos_sin_evaluar / max(segundos_timeframe, 1), 3.0) / 3.0
+        volatilidad = min(volatilidad_pct, 1.0)
+        return (self.peso_proximidad * proximidad
+                + self.peso_reentry * (1.0 if esperando_reentry else 0.0)
+                + self.peso_antiguedad * antiguedad
+                + self.peso_volatilidad * volatilidad)
+    def seleccionar(self, candidatos, presupuesto):
+        """candidatos: lista de (simbolo, puntaje, segundos_esperando desde el cierre de su vela pendiente)"""
+        hambrientos = [c for c in candidatos if c[2] >= self.espera_maxima_segundos]
+        resto = [c for c in candidatos if c[2] < self.espera_maxima_segundos]
+        hambrientos.sort(key=lambda c: c[2], reverse=True)
+        resto.sort(key=lambda c: c[1], reverse=True)
+        return [c[0] for c in (hambrientos + resto)[:presupuesto]]
+# ---------------------------
+# CRIBA DEL UNIVERSO (TODOS LOS PERPETUOS USDT)
+# ---------------------------
+class CribaUniverso:
+    """Primera etapa: rankea todos los perpetuos USDT con llamadas masivas (exchangeInfo + ticker 24h)
+    y entrega los mejores N al análisis de canales"""
+    def __init__(self, top_n=40, volumen_minimo_usdt=20_000_000, refresco_segundos=3600,
+                 peso_liquidez=1.0, peso_volatilidad=1.0, peso_rango=1.0):
+        self.top_n = top_n
+        self.volumen_minimo_usdt = volumen_minimo_usdt
+        self.refresco_segundos = refresco_segundos
+        self.peso_liquidez = peso_liquidez
+        self.peso_volatilidad = peso_volatilidad
+        self.peso_rango = peso_rango
+        self.seleccion = []
+        self.ultima_actualizacion = 0
+    def vencida(self):
+        return time.time() - self.ultima_actualizacion >= self.refresco_segundos
+    def obtener_perpetuos_usdt(self):
+        respuesta = requests.get("https://fapi.binance.com/fapi/v1/exchangeInfo", timeout=15)
+        respuesta.raise_for_status()
+        return {
+            s['symbol'] for s in respuesta.json().get('symbols', [])
+            if s.get('contractType') == 'PERPETUAL' and s.get('quoteAsset') == 'USDT'
+            and s.get('status') == 'TRADING'
+        }
+    def obtener_simbolos_spot(self):
+        """Las velas se descargan del spot: solo sirven perpetuos con par spot equivalente"""
+        respuesta = requests.get("https://api.binance.com/api/v3/ticker/price", timeout=15)
+        respuesta.raise_for_status()
+        return {t['symbol'] for t in respuesta.json()}
+    def obtener_tickers_24h(self):
+        respuesta = requests.get("https://fapi.binance.com/fapi/v1/ticker/24hr", timeout=15)
+        respuesta.raise_for_status()
+        return respuesta.json()
+    def rankear(self, tickers, elegibles):
+        filas = []
+        for t in tickers:
+            simbolo = t.get('symbol')
+            if simbolo not in elegibles:
+                continue
+            try:
+                volumen = float(t['quoteVolume'])
+                ultimo = float(t['lastPrice'])
+                rango = (float(t['highPrice']) - float(t['lowPrice'])) / ultimo * 100 if ultimo > 0 else 0.0
+                cambio = abs(float(t['priceChangePercent']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if volumen < self.volumen_minimo_usdt or ultimo <= 0:
+                continue
+            filas.append((simbolo, math.log10(volumen), cambio, rango))
+        if not filas:
+            return []
+        metricas = np.array([f[1:] for f in filas], dtype=float)
+        # Percentil de cada métrica para que volumen, volatilidad y rango pesen en la misma escala
+        percentiles = metricas.argsort(axis=0).argsort(axis=0) / max(len(filas) - 1, 1)
+        puntajes = percentiles @ np.array([self.peso_liquidez, self.peso_volatilidad, self.peso_rango])
+        orden = np.argsort(-puntajes, kind='stable')
+        return [filas[i][0] for i in orden]
+    def actualizar(self):
+        elegibles = self.obtener_perpetuos_usdt() & self.obtener_simbolos_spot()
+        ranking = self.rankear(self.obtener_tickers_24h(), elegibles)
+        if ranking:
+            self.seleccion = ranking[:self.top_n]
+        self.ultima_actualizacion = time.time()
+        return self.seleccion
+# ---------------------------
+# SERVICIO DE CONFIGURACIÓN ÓPTIMA (STALE-WHILE-REVALIDATE)
+# ---------------------------
+class ServicioConfigOptima:
+    """Refresca en segundo plano, con concurrencia acotada, las configuraciones óptimas vencidas"""
+    def __init__(self, refrescar_fn, ttl_segundos=7200, jitter=0.2, max_workers=2):
+        self.refrescar_fn = refrescar_fn
+        self.ttl_segundos = ttl_segundos
+        self.jitter = jitter
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='config-optima')
+        self.en_curso = set()
+        self.lock = threading.Lock()
+    def nueva_expiracion(self, desde=None):
+        factor = random.uniform(1 - self.jitter, 1 + self.jitter)
+        return (desde or datetime.now()) + timedelta(seconds=self.ttl_segundos * factor)
+    def solicitar_refresco(self, simbolo):
+        with self.lock:
+            if simbolo in self.en_curso:
+                return False
+            self.en_curso.add(simbolo)
+        self.executor.submit(self._refrescar, simbolo)
+        return True
+    def _refrescar(self, simbolo):
+        try:
+            self.refrescar_fn(simbolo)
+        except Exception as e:
+            logger_escaneo.error("❌ Error refrescando configuración óptima de %s: %s", simbolo, e, extra={'simbolo': simbolo, 'etapa': 'config_optima'})
+        finally:
+            with self.lock:
+                self.en_curso.discard(simbolo)
+# ---------------------------
+# VIGILANTE DE REENTRY EN TIEMPO REAL (WEBSOCKET)
+# ---------------------------
+STREAMS_PRECIO = {
+    'markPrice': ('wss://fstream.binance.com/ws', '{}@markPrice@1s'),
+    'bookTicker': ('wss://fstream.binance.com/ws', '{}@bookTicker')
+}
+class VigilanteReentry:
+    """Mantiene suscripciones de precio solo para los símbolos en espera de reentry"""
+    def __init__(self, on_precio, tipo='markPrice'):
+        self.on_precio = on_precio
+        self.url, self.plantilla = STREAMS_PRECIO.get(tipo, STREAMS_PRECIO['markPrice'])
+        self.deseados = set()
+        self.suscritos = set()
+        self.lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._id_mensaje = 0
+    def sincronizar(self, simbolos):
+        with self.lock:
+            self.deseados = set(simbolos)
+        if self.deseados and not (self._hilo and self._hilo.is_alive()):
+            self._hilo = threading.Thread(target=self._bucle, daemon=True)
+            self._hilo.start()
+    def detener(self):
+        self._detener.set()
+    def _bucle(self):
+        espera = 1
+        while not self._detener.is_set():
+            with self.lock:
+                hay_deseados = bool(self.deseados)
+            if not hay_deseados:
+                self._detener.wait(1)
+                continue
+            try:
+                with ws_connect(self.url, open_timeout=10, close_timeout=2) as ws:
+                    self.suscritos = set()
+                    espera = 1
+                    while not self._detener.is_set():
+                        if not self._actualizar_suscripciones(ws):
+                            break
+                        try:
+                            mensaje = ws.recv(timeout=1)
+                        except TimeoutError:
+                            continue
+                        self._procesar(mensaje)
+            except Exception as e:
+                logger_escaneo.warning("⚠️ Stream de precios desconectado (%s), reintentando en %ss", e, espera, extra={'etapa': 'stream'})
+                self._detener.wait(espera)
+                espera = min(espera * 2, 60)
+    def _actualizar_suscripciones(self, ws):
+        with self.lock:
+            deseados = set(self.deseados)
+        nuevos = deseados - self.suscritos
+        sobrantes = self.suscritos - deseados
+        for metodo, simbolos in (('SUBSCRIBE', nuevos), ('UNSUBSCRIBE', sobrantes)):
+            if simbolos:
+                self._id_mensaje += 1
+                ws.send(json.dumps({
+                    'method': metodo,
+                    'params': [self.plantilla.format(s.lower()) for s in sorted(simbolos)],
+                    'id': self._id_mensaje
+                }))
+        self.suscritos = deseados
+        return bool(deseados)
+    def _procesar(self, mensaje):
+        try:
+            datos = json.loads(mensaje)
+            datos = datos.get('data', datos)
+            simbolo = datos.get('s')
+            if not simbolo:
+                return
+            if 'p' in datos:
+                precio = float(datos['p'])
+            elif 'b' in datos and 'a' in datos:
+                precio = (float(datos['b']) + float(datos['a'])) / 2
+            else:
+                return
+            self.on_precio(simbolo, precio)
+        except Exception as e:
+            logger_escaneo.error("❌ Error procesando tick de precio: %s", e, extra={'etapa': 'stream'})
+# ---------------------------
+# CANAL DE REGRESIÓN INCREMENTAL
+# ---------------------------
+class SumasRegresion:
+    """Sumas Σy, Σi·y y Σy² de una ventana deslizante indexada 0..n-1, centradas en 'referencia'"""
+    __slots__ = ('referencia', 's0', 's1', 's2', 'n')
+    def __init__(self, referencia=0.0):
+        self.referencia = referencia
+        self.s0 = 0.0
+        self.s1 = 0.0
+        self.s2 = 0.0
+        self.n = 0
+    def agregar(self, y):
+        y -= self.referencia
+        self.s1 += self.n * y
+        self.s0 += y
+        self.s2 += y * y
+        self.n += 1
+    def quitar_primero(self, y):
+        y -= self.referencia
+        self.s1 -= self.s0 - y
+        self.s0 -= y
+        self.s2 -= y * y
+        self.n -= 1
+    def regresion(self, parcial):
+        """Pendiente, intercepto, SS residual y SS total incluyendo la vela en curso como último punto"""
+        y = parcial - self.referencia
+        n = self.n + 1
+        sum_x = n * (n - 1) / 2
+        sum_x2 = (n - 1) * n * (2 * n - 1) / 6
+        sum_y = self.s0 + y
+        sum_xy = self.s1 + self.n * y
+        sum_y2 = self.s2 + y * y
+        sxx = sum_x2 - sum_x * sum_x / n
+        sxy = sum_xy - sum_x * sum_y / n
+        syy = max(sum_y2 - sum_y * sum_y / n, 0.0)
+        pendiente = sxy / sxx if sxx else 0
+        intercepto = (sum_y - pendiente * sum_x) / n + self.referencia
+        ss_res = max(syy - pendiente * sxy, 0.0)
+        return pendiente, intercepto, ss_res, syy, sxx, sxy
+class CanalIncremental:
+    """Canal de regresión de una ventana (símbolo, timeframe, velas) actualizado en O(1) por vela"""
+    def __init__(self, num_velas, resync_cada=288):
+        self.num_velas = num_velas
+        self.resync_cada = resync_cada
+        self.velas = deque()
+        self.max_cierres = deque()
+        self.min_cierres = deque()
+        self.indice_global = 0
+        self.actualizaciones = 0
+        self.parcial = None
+        self.apertura_parcial = None
+        self.sumas = None
+    def resincronizar(self, tiempos_apertura, maximos, minimos, cierres):
+        n = self.num_velas
+        cerradas = list(zip(tiempos_apertura[-n:-1], maximos[-n:-1], minimos[-n:-1], cierres[-n:-1]))
+        referencia = float(cierres[-1])
+        self.sumas = {clave: SumasRegresion(referencia) for clave in ('max', 'min', 'cierre')}
+        self.velas = deque()
+        self.max_cierres = deque()
+        self.min_cierres = deque()
+        self.indice_global = 0
+        for vela in cerradas:
+            self._agregar_cerrada(vela)
+        self.parcial = (float(maximos[-1]), float(minimos[-1]), float(cierres[-1]))
+        self.apertura_parcial = tiempos_apertura[-1]
+        self.actualizaciones = 0
+    def _agregar_cerrada(self, vela):
+        apertura, maximo, minimo, cierre = vela[0], float(vela[1]), float(vela[2]), float(vela[3])
+        if len(self.velas) >= self.num_velas - 1:
+            _, max_viejo, min_viejo, cierre_viejo = self.velas.popleft()
+            self.sumas['max'].quitar_primero(max_viejo)
+            self.sumas['min'].quitar_primero(min_viejo)
+            self.sumas['cierre'].quitar_primero(cierre_viejo)
+        self.velas.append((apertura, maximo, minimo, cierre))
+        self.sumas['max'].agregar(maximo)
+        self.sumas['min'].agregar(minimo)
+        self.sumas['cierre'].agregar(cierre)
+        indice = self.indice_global
+        self.indice_global += 1
+        while self.max_cierres and self.max_cierres[-1][1] <= cierre:
+            self.max_cierres.pop()
+        self.max_cierres.append((indice, cierre))
+        while self.min_cierres and self.min_cierres[-1][1] >= cierre:
+            self.min_cierres.pop()
+        self.min_cierres.append((indice, cierre))
+        primero_valido = self.indice_global - len(self.velas)
+        while self.max_cierres[0][0] < primero_valido:
+            self.max_cierres.popleft()
+        while self.min_cierres[0][0] < primero_valido:
+            self.min_cierres.popleft()
+    def actualizar(self, datos_mercado):
+        """Incorpora solo las velas nuevas de datos_mercado; resincroniza si hay huecos o toca control de deriva"""
+        tiempos_apertura = datos_mercado['tiempos_apertura']
+        maximos = datos_mercado['maximos']
+        minimos = datos_mercado['minimos']
+        cierres = datos_mercado['cierres']
+        if len(cierres) < self.num_velas:
+            return False
+        if self.sumas is None or self.actualizaciones >= self.resync_cada:
+            self.resincronizar(tiempos_apertura, maximos, minimos, cierres)
+            return True
+        if tiempos_apertura[-1] != self.apertura_parcial:
+            posicion = None
+            for i in range(len(tiempos_apertura) - 2, -1, -1):
+                if tiempos_apertura[i] == self.apertura_parcial:
+                    posicion = i
+                    break
+                if tiempos_apertura[i] < self.apertura_parcial:
+                    break
+            if posicion is None or len(tiempos_apertura) - 1 - posicion >= self.num_velas:
+                self.resincronizar(tiempos_apertura, maximos, minimos, cierres)
+                return True
+            for i in range(posicion, len(tiempos_apertura) - 1):
+                self._agregar_cerrada((tiempos_apertura[i], maximos[i], minimos[i], cierres[i]))
+            self.apertura_parcial = tiempos_apertura[-1]
+        self.parcial = (float(maximos[-1]), float(minimos[-1]), float(cierres[-1]))
+        self.actualizaciones += 1
+        return True
+    def metricas(self):
+        n = self.num_velas
+        maximo_parcial, minimo_parcial, cierre_parcial = self.parcial
+        pend_max, inter_max, ss_res_max, _, _, _ = self.sumas['max'].regresion(maximo_parcial)
+        pend_min, inter_min, ss_res_min, _, _, _ = self.sumas['min'].regresion(minimo_parcial)
+        pend_cierre, inter_cierre, ss_res_cierre, ss_tot, sxx, sxy = self.sumas['cierre'].regresion(cierre_parcial)
+        rango = max(self.max_cierres[0][1], cierre_parcial) - min(self.min_cierres[0][1], cierre_parcial)
+        denominador = math.sqrt(sxx * ss_tot)
+        if denominador == 0:
+            pearson, angulo = 0, 0
+        else:
+            pearson = sxy / denominador
+            angulo = math.degrees(math.atan(pend_cierre * n / rango if rango != 0 else 0))
+        return {
+            'reg_max': (pend_max, inter_max),
+            'reg_min': (pend_min, inter_min),
+            'reg_close': (pend_cierre, inter_cierre),
+            'tiempo_actual': n - 1,
+            'desviacion_max': math.sqrt(ss_res_max / n),
+            'desviacion_min': math.sqrt(ss_res_min / n),
+            'pearson': pearson,
+            'angulo_tendencia': angulo,
+            'r2': 1 - ss_res_cierre / ss_tot if ss_tot else 0
+        }
+# ---------------------------
+# MOTOR DE INDICADORES POR LOTES (VARIOS SÍMBOLOS A LA VEZ)
+# ---------------------------
+class TablaIndicadores:
+    """Resultado del motor: una columna numpy por métrica y una fila por símbolo"""
+    def __init__(self, simbolos, columnas, timeframes, num_velas):
+        self.simbolos = simbolos
+        self.columnas = columnas
+        self.timeframes = timeframes
+        self.num_velas = num_velas
+        self.indice = {simbolo: i for i, simbolo in enumerate(simbolos)}
+    def __len__(self):
+        return len(self.simbolos)
+    def __contains__(self, simbolo):
+        return simbolo in self.indice
+    def fila(self, simbolo):
+        i = self.indice[simbolo]
+        return {nombre: float(columna[i]) for nombre, columna in self.columnas.items()}
+class MotorIndicadoresLote:
+    """Canal de regresión, Pearson, R², ángulo, estocástico y volatilidad de muchos símbolos: las ventanas de
+    igual longitud se apilan en matrices (símbolos x velas) y cada métrica se resuelve con operaciones por filas"""
+    def __init__(self, periodo_stoch=14, k_stoch=3, d_stoch=3, periodo_volatilidad=20):
+        self.periodo_stoch = periodo_stoch
+        self.k_stoch = k_stoch
+        self.d_stoch = d_stoch
+        self.periodo_volatilidad = periodo_volatilidad
+    def calcular(self, entradas):
+        """entradas: iterable de (simbolo, datos_mercado, num_velas)"""
+        grupos = {}
+        for simbolo, datos_mercado, num_velas in entradas:
+            largo = len(datos_mercado['cierres'])
+            if largo >= num_velas:
+                grupos.setdefault((largo, num_velas), []).append((simbolo, datos_mercado))
+        simbolos, timeframes, velas, bloques = [], [], [], []
+        for (largo, num_velas), miembros in grupos.items():
+            maximos = np.array([d['maximos'] for _, d in miembros], dtype=float)
+            minimos = np.array([d['minimos'] for _, d in miembros], dtype=float)
+            cierres = np.array([d['cierres'] for _, d in miembros], dtype=float)
+            bloques.append(self.calcular_grupo(maximos, minimos, cierres, num_velas))
+            simbolos.extend(simbolo for simbolo, _ in miembros)
+            timeframes.extend(d.get('timeframe', 'N/A') for _, d in miembros)
+            velas.extend([num_velas] * len(miembros))
+        columnas = {nombre: np.concatenate([b[nombre] for b in bloques]) for nombre in bloques[0]} if bloques else {}
+        return TablaIndicadores(simbolos, columnas, timeframes, velas)
+    @staticmethod
+    def _regresion(y, xc, sxx):
+        """Pendiente, intercepto (x = 0..n-1) y sumas por fila, con los datos centrados para no perder precisión"""
+        media = y.mean(axis=1)
+        yc = y - media[:, None]
+        sxy = yc @ xc
+        pendiente = sxy / sxx if sxx else np.zeros(len(y))
+        intercepto = media - pendiente * (len(xc) - 1) / 2
+        residuos = yc - pendiente[:, None] * xc
+        return pendiente, intercepto, np.einsum('ij,ij->i', residuos, residuos), np.einsum('ij,ij->i', yc, yc), sxy
+    def calcular_grupo(self, maximos, minimos, cierres, num_velas):
+        n = num_velas
+        xc = np.arange(n, dtype=float) - (n - 1) / 2
+        sxx = float(xc @ xc)
+        pend_max, inter_max, ss_res_max, _, _ = self._regresion(maximos[:, -n:], xc, sxx)
+        pend_min, inter_min, ss_res_min, _, _ = self._regresion(minimos[:, -n:], xc, sxx)
+        pend_cierre, inter_cierre, ss_res_cierre, ss_tot, sxy = self._regresion(cierres[:, -n:], xc, sxx)
+        tiempo_actual = n - 1
+        resistencia_media = pend_max * tiempo_actual + inter_max
+        soporte_media = pend_min * tiempo_actual + inter_min
+        resistencia = resistencia_media + np.sqrt(ss_res_max / n)
+        soporte = soporte_media - np.sqrt(ss_res_min / n)
+        ancho = resistencia - soporte
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominador = np.sqrt(sxx * ss_tot)
+            hay_varianza = denominador > 0
+            pearson = np.where(hay_varianza, sxy / denominador, 0.0)
+            rango = np.ptp(cierres[:, -n:], axis=1)
+            angulo = np.where(hay_varianza & (rango != 0), np.degrees(np.arctan(pend_cierre * n / rango)), 0.0)
+            r2 = np.where(ss_tot > 0, 1 - ss_res_cierre / ss_tot, 0.0)
+            ancho_porcentual = ancho / ((resistencia + soporte) / 2) * 100
+        stoch_k, stoch_d = self.calcular_stochastic(maximos, minimos, cierres)
+        return {
+            'resistencia': resistencia,
+            'soporte': soporte,
+            'resistencia_media': resistencia_media,
+            'soporte_media': soporte_media,
+            'linea_tendencia': pend_cierre * tiempo_actual + inter_cierre,
+            'pendiente_tendencia': pend_cierre,
+            'precio_actual': cierres[:, -1],
+            'ancho_canal': ancho,
+            'ancho_canal_porcentual': ancho_porcentual,
+            'angulo_tendencia': angulo,
+            'coeficiente_pearson': pearson,
+            'r2_score': r2,
+            'pendiente_resistencia': pend_max,
+            'pendiente_soporte': pend_min,
+            'stoch_k': stoch_k,
+            'stoch_d': stoch_d,
+            'volatilidad': self.calcular_volatilidad(cierres)
+        }
+    def calcular_stochastic(self, maximos, minimos, cierres):
+        """%K suavizado y %D de la última vela; mismas reglas que TradingBot.calcular_stochastic"""
+        filas, largo = cierres.shape
+        lecturas = self.k_stoch + self.d_stoch - 1
+        necesarias = self.periodo_stoch + lecturas - 1
+        if largo < necesarias:
+            return np.full(filas, 50.0), np.full(filas, 50.0)
+        ventanas = np.lib.stride_tricks.sliding_window_view
+        mas_alto = ventanas(maximos[:, -necesarias:], self.periodo_stoch, axis=1).max(axis=2)
+        mas_bajo = ventanas(minimos[:, -necesarias:], self.periodo_stoch, axis=1).min(axis=2)
+        rango = mas_alto - mas_bajo
+        plano = rango == 0
+        k = np.where(plano, 50.0, 100 * (cierres[:, -lecturas:] - mas_bajo) / np.where(plano, 1.0, rango))
+        k_suavizado = ventanas(k, self.k_stoch, axis=1).mean(axis=2)
+        return k_suavizado[:, -1], k_suavizado[:, -self.d_stoch:].mean(axis=1)
+    def calcular_volatilidad(self, cierres):
+        """Desviación estándar de los últimos retornos, en %; mismas reglas que TradingBot.calcular_volatilidad_reciente"""
+        if cierres.shape[1] < 3:
+            return np.zeros(len(cierres))
+        recientes = cierres[:, -(self.periodo_volatilidad + 1):]
+        return np.std(np.diff(recientes, axis=1) / recientes[:, :-1], axis=1) * 100
+# ---------------------------
+# COLA DE SALIDA Y COMANDOS DE TELEGRAM
+# ---------------------------
+COMANDOS_TELEGRAM = {
+    '/status': 'comando_estado',
+    '/positions': 'comando_posiciones',
+    '/report': 'comando_reporte',
+    '/channel': 'comando_canal',
+    '/pause': 'comando_pausa',
+    '/resume': 'comando_reanudar'
+}
+class ColaTelegram:
+    """Mensajes salientes: el hilo de trading y el webhook solo encolan; un hilo propio hace los POST"""
+    def __init__(self, enviar_fn, maximo=200):
+        self.enviar_fn = enviar_fn
+        self.cola = queue.Queue(maxsize=maximo)
+        self.descartados = 0
+        self._hilo = threading.Thread(target=self._bucle, daemon=True, name='telegram-salida')
+        self._hilo.start()
+    def encolar(self, mensaje, token, chat_ids):
+        try:
+            self.cola.put_nowait((mensaje, token, list(chat_ids)))
+            return True
+        except queue.Full:
+            self.descartados += 1
+            logger_telegram.warning("⚠️ Cola de Telegram llena: mensaje descartado (%s en total)", self.descartados, extra={'etapa': 'envio'})
+            return False
+    def _bucle(self):
+        while True:
+            mensaje, token, chat_ids = self.cola.get()
+            try:
+                self.enviar_fn(mensaje, token, chat_ids)
+            except Exception as e:
+                logger_telegram.error("❌ Error en el envío encolado a Telegram: %s", e, extra={'etapa': 'envio'})
+# ---------------------------
+# BOT PRINCIPAL - BREAKOUT + REENTRY (MEJORADO)
+# ---------------------------
+COLUMNAS_LOG_OBLIGATORIAS = (
+    'timestamp', 'symbol', 'tipo', 'precio_entrada',
+    'take_profit', 'stop_loss', 'precio_salida',
+    'resultado', 'pnl_percent', 'duracion_minutos',
+    'angulo_tendencia', 'pearson', 'r2_score'
+)
+COLUMNAS_LOG = list(COLUMNAS_LOG_OBLIGATORIAS) + [
+    'ancho_canal_relativo', 'ancho_canal_porcentual',
+    'nivel_fuerza', 'timeframe_utilizado', 'velas_utilizadas',
+    'stoch_k', 'stoch_d', 'breakout_usado',
+    'precio_entrada_real', 'comision_usdt', 'pnl_realizado_usdt', 'conciliado',
+    'precio_fill_entrada', 'slippage_entrada_bps', 'ms_config', 'ms_orden', 'ms_fill', 'ms_sl', 'ms_tp',
+    'slippage_salida_bps', 'ms_deteccion_cierre'
+]
+METRICAS_EJECUCION = ('ms_config', 'ms_orden', 'ms_fill', 'ms_sl', 'ms_tp', 'ms_deteccion_cierre',
+                      'slippage_entrada_bps', 'slippage_salida_bps')
+VALORES_DEFECTO_LOG = {
+    'ancho_canal_relativo': 0, 'ancho_canal_porcentual': 0, 'nivel_fuerza': 1,
+    'timeframe_utilizado': 'N/A', 'velas_utilizadas': 0, 'stoch_k': 0, 'stoch_d': 0,
+    'breakout_usado': False, 'conciliado': False
+}
+class TradingBot:
+    def __init__(self, config, sesion=None):
+        self.config = config
+        self.sesion = sesion
+        self.log_path = config.get('log_path', 'operaciones_log.csv')
+        self.auto_optimize = config.get('auto_optimize', True)
+        self.ultima_optimizacion = datetime.now()
+        self.operaciones_desde_optimizacion = 0
+        self.total_operaciones = 0
+        self.breakout_history = {}
+        self.config_optima_por_simbolo = {}
+        self.ultima_busqueda_config = {}
+        self.expiracion_config = {}
+        self.lock_config = threading.Lock()
+        self.servicio_config = ServicioConfigOptima(
+            self.refrescar_configuracion_optima,
+            ttl_segundos=config.get('ttl_config_optima_segundos', 7200),
+            jitter=config.get('jitter_config_optima', 0.2),
+            max_workers=config.get('workers_config_optima', 2)
+        )
+        self.breakouts_detectados = {}
+        self.esperando_reentry = {}
+        self.planificador = PlanificadorVelas(config.get('retraso_cierre_vela_segundos', 3))
+        self.canales_cache = {}
+        self.canales_incrementales = {}
+        self.buffers_velas = {}
+        self.locks_sincronizacion = {}
+        self.archivo_velas = None
+        if config.get('archivo_velas_activo', True):
+            try:
+                self.archivo_velas = ArchivoVelas(config.get('directorio_archivo_velas', 'archivo_velas'))
+            except OSError as e:
+                logger_estado.warning("⚠️ Archivo de velas deshabilitado: %s", e, extra={'etapa': 'archivo_velas'})
+        self.ultima_sincronizacion_base = {}
+        self.simbolos_forzados = set()
+        self.ultimo_intento_config = {}
+        self.simbolos_en_curso = []
+        self.ultimo_analisis_completo = 0
+        self.evento_despertar = threading.Event()
+        self.ultima_evaluacion = {}
+        self.ultimos_precios = {}
+        self.volatilidad_reciente = {}
+        self.priorizador = PriorizadorSimbolos(
+            peso_proximidad=config.get('peso_proximidad', 3.0),
+            peso_reentry=config.get('peso_reentry', 5.0),
+            peso_antiguedad=config.get('peso_antiguedad', 1.0),
+            peso_volatilidad=config.get('peso_volatilidad', 1.0),
+            espera_maxima_segundos=config.get('espera_maxima_simbolo_minutos', 30) * 60
+        )
+        self.criba_universo = None
+        if config.get('criba_universo_activa', False):
+            self.criba_universo = CribaUniverso(
+                top_n=config.get('criba_top_n', 40),
+                volumen_minimo_usdt=config.get('criba_volumen_minimo_usdt', 20_000_000),
+                refresco_segundos=config.get('criba_refresco_minutos', 60) * 60,
+                peso_liquidez=config.get('criba_peso_liquidez', 1.0),
+                peso_volatilidad=config.get('criba_peso_volatilidad', 1.0),
+                peso_rango=config.get('criba_peso_rango', 1.0)
+            )
+        self.motor_indicadores = MotorIndicadoresLote() if config.get('indicadores_lote', True) else None
+        self.matriz_correlacion = None
+        if config.get('correlacion_activa', True):
+            self.matriz_correlacion = MatrizCorrelacion(
+                ventana=config.get('correlacion_ventana', 96),
+                min_muestras=config.get('correlacion_min_muestras', 24)
+            )
+        self.ultimo_disparo_tick = {}
+        self.vigilante_reentry = None
+        if config.get('reentry_stream_activo', True):
+            self.vigilante_reentry = VigilanteReentry(
+                self.procesar_tick_reentry, config.get('reentry_stream_tipo', 'markPrice')
+            )
+        self.cola_telegram = ColaTelegram(self._enviar_telegram_simple)
+        self.pausado = threading.Event()
+        self.instantanea = {}
+        self.estado_file = config.get('estado_file', 'estado_bot.json')
+        self.checkpoint_conciliacion = None
+        self.ejecuciones_recientes = {}
+        self.operaciones_cuentas_guardadas = {}
+        self.cargar_estado()
+        self.coordinador = None
+        if config.get('shard_mode', False):
+            self.coordinador = CoordinadorShards(
+                db_path=config.get('shard_db_path', 'coordinacion_shards.db'),
+                instancia_id=config.get('shard_instance_id') or socket.gethostname(),
+                lease_segundos=config.get('shard_lease_segundos', 90),
+                max_posiciones_globales=config.get('max_posiciones_globales', 5)
+            )
+            self.coordinador.registrar_posiciones(
+                {simbolo: operacion.a_dict() for simbolo, operacion in self.operaciones_activas.items()}
+            )
+            self.coordinador.iniciar_latidos()
+            # Con gunicorn el bucle corre en run_bot_loop y nunca llega al KeyboardInterrupt de iniciar()
+            atexit.register(self.coordinador.retirar)
+            logger_coordinador.info("🧩 Modo shard activo: instancia %s", self.coordinador.instancia_id, extra={'etapa': 'arranque'})
+        self.trader = BinanceTrader(
+            api_key=config['binance_api_key'],
+            secret_key=config['binance_secret_key'],
+            testnet=config.get('binance_testnet', True),
+            ttl_exchange_info=config.get('ttl_exchange_info_segundos', 3600),
+            sesion=sesion
+        )
+        if not self.trader.check_connection():
+            logger_ordenes.error("❌ No se pudo conectar a Binance. El bot no operará.", extra={'cuenta': 'principal', 'etapa': 'arranque'})
+            self.trader = None
+        self.ejecutor = EjecutorCuenta('principal', self.trader, config, config.get('fraccion_balance', 0.03))
+        self.estado_cuenta = self.ejecutor.estado_cuenta
+        self.cuentas_adicionales = self.crear_cuentas_adicionales(config.get('cuentas_adicionales', []))
+        self.pool_cuentas = None
+        for cuenta in self.cuentas_adicionales:
+            cuenta.operaciones = {
+                simbolo: OperacionActiva.desde_dict(datos)
+                for simbolo, datos in self.operaciones_cuentas_guardadas.get(cuenta.nombre, {}).items()
+            }
+        if self.cuentas_adicionales:
+            self.pool_cuentas = ThreadPoolExecutor(
+                max_workers=len(self.cuentas_adicionales) + 1, thread_name_prefix='cuentas'
+            )
+            logger_ordenes.info("👥 Modo multicuenta: principal + %s cuentas adicionales", len(self.cuentas_adicionales), extra={'etapa': 'arranque'})
+        self.optimizador = ProcesoOptimizador(
+            timeout_segundos=config.get('timeout_optimizacion_segundos', 600),
+            espera_reintento_segundos=config.get('espera_reintento_optimizacion_minutos', 30) * 60,
+            min_operaciones_pliegue=config.get('min_operaciones_pliegue', 5)
+        )
+        if self.auto_optimize:
+            try:
+                self.optimizador.lanzar(
+                    self.log_path, config.get('min_samples_optimizacion', 15), self.parametros_optimizables()
+                )
+            except Exception as e:
+                logger_optimizador.error("❌ Error en optimización automática: %s", e, extra={'etapa': 'arranque'})
+        self.ultimos_datos = {}
+        self.operaciones_activas = getattr(self, 'operaciones_activas', {})
+        self.senales_enviadas = getattr(self, 'senales_enviadas', set())
+        self.archivo_log = self.log_path
+        self.inicializar_log()
+        self.lock_reporte = threading.Lock()
+        self.operaciones_recientes = deque()
+        self.cargar_operaciones_recientes()
+        self.publicar_instantanea()
+    def cargar_estado(self):
+        try:
+            if os.path.exists(self.estado_file):
+                with open(self.estado_file, 'r', encoding='utf-8') as f:
+                    estado = json.load(f)
+                if 'ultima_optimizacion' in estado:
                     estado['ultima_optimizacion'] = datetime.fromisoformat(estado['ultima_optimizacion'])
                 if 'ultima_busqueda_config' in estado:
                     for simbolo, fecha_str in estado['ultima_busqueda_config'].items():
                         estado['ultima_busqueda_config'][simbolo] = datetime.fromisoformat(fecha_str)
+                if 'expiracion_config' in estado:
+                    for simbolo, fecha_str in estado['expiracion_config'].items():
+                        estado['expiracion_config'][simbolo] = datetime.fromisoformat(fecha_str)
                 if 'breakout_history' in estado:
                     for simbolo, fecha_str in estado['breakout_history'].items():
                         estado['breakout_history'][simbolo] = datetime.fromisoformat(fecha_str)
@@ -446,22 +2699,37 @@ class TradingBot:
                 self.breakout_history = estado.get('breakout_history', {})
                 self.config_optima_por_simbolo = estado.get('config_optima_por_simbolo', {})
                 self.ultima_busqueda_config = estado.get('ultima_busqueda_config', {})
-                self.operaciones_activas = estado.get('operaciones_activas', {})
+                self.expiracion_config = estado.get('expiracion_config', {})
+                for simbolo, fecha in self.ultima_busqueda_config.items():
+                    if simbolo not in self.expiracion_config:
+                        self.expiracion_config[simbolo] = self.servicio_config.nueva_expiracion(desde=fecha)
+                self.operaciones_activas = {
+                    simbolo: OperacionActiva.desde_dict(datos)
+                    for simbolo, datos in estado.get('operaciones_activas', {}).items()
+                }
                 self.senales_enviadas = set(estado.get('senales_enviadas', []))
-                self.indice_simbolo_actual = estado.get('indice_simbolo_actual', 0)
-                print("✅ Estado anterior cargado correctamente")
+                self.checkpoint_conciliacion = estado.get('checkpoint_conciliacion')
+                self.operaciones_cuentas_guardadas = estado.get('operaciones_cuentas', {})
+                if estado.get('pausado'):
+                    self.pausado.set()
+                logger_estado.info("✅ Estado anterior cargado correctamente", extra={'etapa': 'carga'})
         except Exception as e:
-            print(f"⚠ Error cargando estado previo: {e}")
+            logger_estado.error("❌ Error cargando estado previo: %s", e, extra={'etapa': 'carga'})
     def guardar_estado(self):
         try:
+            with self.lock_config:
+                config_optima_por_simbolo = dict(self.config_optima_por_simbolo)
+                ultima_busqueda_config = {k: v.isoformat() for k, v in self.ultima_busqueda_config.items()}
+                expiracion_config = {k: v.isoformat() for k, v in self.expiracion_config.items()}
             estado = {
                 'ultima_optimizacion': self.ultima_optimizacion.isoformat(),
                 'operaciones_desde_optimizacion': self.operaciones_desde_optimizacion,
                 'total_operaciones': self.total_operaciones,
                 'breakout_history': {k: v.isoformat() for k, v in self.breakout_history.items()},
-                'config_optima_por_simbolo': self.config_optima_por_simbolo,
-                'ultima_busqueda_config': {k: v.isoformat() for k, v in self.ultima_busqueda_config.items()},
-                'operaciones_activas': self.operaciones_activas,
+                'config_optima_por_simbolo': config_optima_por_simbolo,
+                'ultima_busqueda_config': ultima_busqueda_config,
+                'expiracion_config': expiracion_config,
+                'operaciones_activas': {k: v.a_dict() for k, v in self.operaciones_activas.items()},
                 'senales_enviadas': list(self.senales_enviadas),
                 'esperando_reentry': {
                     k: {
@@ -478,20 +2746,42 @@ class TradingBot:
                         'precio_breakout': v.get('precio_breakout', 0)
                     } for k, v in self.breakouts_detectados.items()
                 },
-                'indice_simbolo_actual': self.indice_simbolo_actual,
+                'checkpoint_conciliacion': self.checkpoint_conciliacion,
+                'operaciones_cuentas': {
+                    cuenta.nombre: {k: v.a_dict() for k, v in cuenta.operaciones.items()}
+                    for cuenta in self.cuentas_adicionales
+                },
+                'pausado': self.pausado.is_set(),
                 'timestamp_guardado': datetime.now().isoformat()
             }
             with open(self.estado_file, 'w', encoding='utf-8') as f:
                 json.dump(estado, f, indent=2, ensure_ascii=False)
-            print("💾 Estado guardado correctamente")
+            logger_estado.debug("💾 Estado guardado correctamente", extra={'etapa': 'guardado'})
         except Exception as e:
-            print(f"⚠ Error guardando estado: {e}")
+            logger_estado.error("❌ Error guardando estado: %s", e, extra={'etapa': 'guardado'})
     def buscar_configuracion_optima_simbolo(self, simbolo):
-        if simbolo in self.config_optima_por_simbolo:
-            ultima_busqueda = self.ultima_busqueda_config.get(simbolo)
-            if ultima_busqueda and (datetime.now() - ultima_busqueda).total_seconds() < 7200:
-                return self.config_optima_por_simbolo[simbolo]
-        print(f"   🔍 Buscando configuración óptima para {simbolo}...")
+        config_cacheada = self.config_optima_por_simbolo.get(simbolo)
+        expiracion = self.expiracion_config.get(simbolo)
+        if config_cacheada is None or expiracion is None or datetime.now() >= expiracion:
+            self.servicio_config.solicitar_refresco(simbolo)
+        return config_cacheada
+    def refrescar_configuracion_optima(self, simbolo):
+        mejor_config = self.calcular_configuracion_optima(simbolo)
+        with self.lock_config:
+            if mejor_config:
+                self.config_optima_por_simbolo[simbolo] = mejor_config
+                self.ultima_busqueda_config[simbolo] = datetime.now()
+                self.expiracion_config[simbolo] = self.servicio_config.nueva_expiracion()
+            elif simbolo in self.config_optima_por_simbolo:
+                # Refresco fallido: se conserva la última config buena y se reintenta más adelante; el filtro de
+                # calidad del canal en analizar_simbolo sigue decidiendo si hay operación
+                self.expiracion_config[simbolo] = datetime.now() + timedelta(minutes=self.config.get('reintento_config_minutos', 30))
+                logger_escaneo.info("♻️ %s: refresco de configuración sin resultado, se mantiene la anterior", simbolo, extra={'simbolo': simbolo, 'etapa': 'config_optima'})
+            else:
+                self.expiracion_config.pop(simbolo, None)
+        return mejor_config
+    def calcular_configuracion_optima(self, simbolo):
+        logger_escaneo.debug("🔍 Buscando configuración óptima para %s", simbolo, extra={'simbolo': simbolo, 'etapa': 'config_optima'})
         timeframes = self.config.get('timeframes', ['5m', '15m', '30m', '1h', '4h'])
         velas_options = self.config.get('velas_options', [80, 100, 120, 150, 200])
         mejor_config = None
@@ -505,8 +2795,8 @@ class TradingBot:
                     canal_info = self.calcular_canal_regresion_config(datos, num_velas)
                     if not canal_info: continue
                     if (canal_info['nivel_fuerza'] >= 2 and 
-                        abs(canal_info['coeficiente_pearson']) >= 0.4 and 
-                        canal_info['r2_score'] >= 0.4):
+                        abs(canal_info['coeficiente_pearson']) >= self.config.get('min_pearson', 0.4) and 
+                        canal_info['r2_score'] >= self.config.get('min_r2', 0.4)):
                         ancho_actual = canal_info['ancho_canal_porcentual']
                         if ancho_actual >= self.config.get('min_channel_width_percent', 4.0):
                             puntaje_ancho = ancho_actual * 10
@@ -523,33 +2813,142 @@ class TradingBot:
                 except Exception:
                     continue
         if mejor_config:
-            self.config_optima_por_simbolo[simbolo] = mejor_config
-            self.ultima_busqueda_config[simbolo] = datetime.now()
-            print(f"   ✅ Config óptima: {mejor_config['timeframe']} - {mejor_config['num_velas']} velas - Ancho: {mejor_config['ancho_canal']:.1f}%")
+            logger_escaneo.info("✅ Config óptima %s: %s - %s velas - Ancho: %.1f%%", simbolo, mejor_config['timeframe'],
+                                mejor_config['num_velas'], mejor_config['ancho_canal'], extra={'simbolo': simbolo, 'etapa': 'config_optima'})
         return mejor_config
     def obtener_datos_mercado_config(self, simbolo, timeframe, num_velas):
-        url = "https://api.binance.com/api/v3/klines"
+        if self.timeframe_derivable(timeframe):
+            return self.obtener_datos_resampleados(simbolo, timeframe, num_velas)
         params = {'symbol': simbolo, 'interval': timeframe, 'limit': num_velas + 14}
         try:
-            respuesta = requests.get(url, params=params, timeout=10)
-            datos = respuesta.json()
-            if not isinstance(datos, list) or len(datos) == 0:
+            datos = self.descargar_klines(params)
+            if not datos:
                 return None
-            maximos = [float(vela[2]) for vela in datos]
-            minimos = [float(vela[3]) for vela in datos]
-            cierres = [float(vela[4]) for vela in datos]
-            tiempos = list(range(len(datos)))
-            return {
-                'maximos': maximos,
-                'minimos': minimos,
-                'cierres': cierres,
-                'tiempos': tiempos,
-                'precio_actual': cierres[-1] if cierres else 0,
-                'timeframe': timeframe,
-                'num_velas': num_velas
-            }
+            buffer = self.obtener_buffer_velas(simbolo, timeframe)
+            buffer.agregar(BufferVelas.desde_klines(datos))
+            return self.armar_datos_mercado(buffer.ventana(len(datos)), timeframe, num_velas)
         except Exception:
             return None
+    def descargar_klines(self, params):
+        respuesta = requests.get("https://api.binance.com/api/v3/klines", params=params, timeout=10)
+        datos = respuesta.json()
+        if not isinstance(datos, list) or len(datos) == 0:
+            return None
+        return datos
+    def obtener_buffer_velas(self, simbolo, timeframe, capacidad=None):
+        clave = (simbolo, timeframe)
+        buffer = self.buffers_velas.get(clave)
+        if buffer is None:
+            buffer = self.buffers_velas.setdefault(
+                clave, BufferVelas(capacidad or self.config.get('capacidad_buffer_velas', 512))
+            )
+        return buffer
+    def timeframe_derivable(self, timeframe):
+        if not self.config.get('resampleo_local', True):
+            return False
+        segundos_base = INTERVALOS_SEGUNDOS.get(self.config.get('timeframe_base', '5m'))
+        segundos = INTERVALOS_SEGUNDOS.get(timeframe)
+        if not (segundos_base and segundos and segundos >= segundos_base and segundos % segundos_base == 0):
+            return False
+        # Solo se deriva si las velas base necesarias caben en un buffer normal: 4h desde 5m pediría ~10k velas
+        # base por símbolo (11 descargas de 1000 en frío) contra una sola descarga nativa chica
+        velas_max = max(self.config.get('velas_options', [80, 100, 120, 150, 200])) + 14
+        return (velas_max + 1) * (segundos // segundos_base) <= self.config.get('capacidad_buffer_velas', 512)
+    def capacidad_buffer_base(self):
+        segundos_base = INTERVALOS_SEGUNDOS[self.config.get('timeframe_base', '5m')]
+        velas_max = max(self.config.get('velas_options', [80, 100, 120, 150, 200])) + 14
+        factores = [
+            INTERVALOS_SEGUNDOS[tf] // segundos_base
+            for tf in self.config.get('timeframes', ['5m', '15m', '30m', '1h', '4h']) if self.timeframe_derivable(tf)
+        ]
+        factor_max = max(factores) if factores else 1
+        return (velas_max + 1) * factor_max
+    def sincronizar_velas_base(self, simbolo):
+        """Descarga solo las velas base que faltan: relleno inicial hacia atrás y luego incremental"""
+        timeframe_base = self.config.get('timeframe_base', '5m')
+        base_ms = INTERVALOS_SEGUNDOS[timeframe_base] * 1000
+        lock = self.locks_sincronizacion.setdefault(simbolo, threading.Lock())
+        with lock:
+            buffer = self.obtener_buffer_velas(simbolo, timeframe_base, self.capacidad_buffer_base())
+            ahora = time.time()
+            ultima_sincronizacion = self.ultima_sincronizacion_base.get(simbolo, 0)
+            inicio_vela_actual = (ahora * 1000 // base_ms) * base_ms / 1000
+            if (ahora - ultima_sincronizacion < self.config.get('sincronizacion_base_min_segundos', 5)
+                    and ultima_sincronizacion >= inicio_vela_actual):
+                return buffer
+            ultima = buffer.ultima_apertura()
+            if ultima is None and self.archivo_velas:
+                archivadas = self.archivo_velas.ultimas(simbolo, timeframe_base, buffer.capacidad)
+                if archivadas is not None:
+                    buffer.agregar(archivadas)
+                    ultima = buffer.ultima_apertura()
+            if ultima is not None and (ahora * 1000 - ultima) / base_ms >= buffer.capacidad:
+                buffer = BufferVelas(buffer.capacidad)
+                self.buffers_velas[(simbolo, timeframe_base)] = buffer
+                ultima = None
+            if ultima is None:
+                bloques = []
+                faltan = buffer.capacidad
+                fin = None
+                while faltan > 0:
+                    params = {'symbol': simbolo, 'interval': timeframe_base, 'limit': min(1000, faltan)}
+                    if fin is not None:
+                        params['endTime'] = fin
+                    lote = self.descargar_klines(params)
+                    if not lote:
+                        break
+                    bloques.append(lote)
+                    faltan -= len(lote)
+                    fin = int(lote[0][0]) - 1
+                    if len(lote) < params['limit']:
+                        break
+                for lote in reversed(bloques):
+                    filas = BufferVelas.desde_klines(lote)
+                    buffer.agregar(filas)
+                    if self.archivo_velas:
+                        self.archivo_velas.agregar(simbolo, timeframe_base, filas)
+            else:
+                inicio = int(ultima)
+                while True:
+                    lote = self.descargar_klines(
+                        {'symbol': simbolo, 'interval': timeframe_base, 'startTime': inicio, 'limit': 1000}
+                    )
+                    if not lote:
+                        break
+                    filas = BufferVelas.desde_klines(lote)
+                    buffer.agregar(filas)
+                    if self.archivo_velas:
+                        self.archivo_velas.agregar(simbolo, timeframe_base, filas)
+                    if len(lote) < 1000:
+                        break
+                    inicio = int(lote[-1][0])
+            self.ultima_sincronizacion_base[simbolo] = ahora
+            return buffer
+    def obtener_datos_resampleados(self, simbolo, timeframe, num_velas):
+        try:
+            buffer = self.sincronizar_velas_base(simbolo)
+            segundos_base = INTERVALOS_SEGUNDOS[self.config.get('timeframe_base', '5m')]
+            factor = INTERVALOS_SEGUNDOS[timeframe] // segundos_base
+            limite = num_velas + 14
+            if factor == 1:
+                return self.armar_datos_mercado(buffer.ventana(limite), timeframe, num_velas)
+            velas = resamplear_velas(buffer.ventana((limite + 1) * factor), INTERVALOS_SEGUNDOS[timeframe])
+            return self.armar_datos_mercado(velas[:, -limite:], timeframe, num_velas)
+        except Exception:
+            return None
+    def armar_datos_mercado(self, ventana, timeframe, num_velas):
+        if ventana.shape[1] == 0:
+            return None
+        return {
+            'maximos': ventana[2],
+            'minimos': ventana[3],
+            'cierres': ventana[4],
+            'tiempos': range(ventana.shape[1]),
+            'tiempos_apertura': ventana[0],
+            'precio_actual': float(ventana[4, -1]),
+            'timeframe': timeframe,
+            'num_velas': num_velas
+        }
     def calcular_canal_regresion_config(self, datos_mercado, candle_period):
         if not datos_mercado or len(datos_mercado['maximos']) < candle_period:
             return None
@@ -568,45 +2967,92 @@ class TradingBot:
         pendiente_min, intercepto_min = reg_min
         pendiente_cierre, intercepto_cierre = reg_close
         tiempo_actual = tiempos_reg[-1]
-        resistencia_media = pendiente_max * tiempo_actual + intercepto_max
-        soporte_media = pendiente_min * tiempo_actual + intercepto_min
         diferencias_max = [maximos[i] - (pendiente_max * tiempos_reg[i] + intercepto_max) for i in range(len(tiempos_reg))]
         diferencias_min = [minimos[i] - (pendiente_min * tiempos_reg[i] + intercepto_min) for i in range(len(tiempos_reg))]
         desviacion_max = np.std(diferencias_max) if diferencias_max else 0
         desviacion_min = np.std(diferencias_min) if diferencias_min else 0
+        pearson, angulo_tendencia = self.calcular_pearson_y_angulo(tiempos_reg, cierres)
+        r2 = self.calcular_r2(cierres, tiempos_reg, pendiente_cierre, intercepto_cierre)
+        return self._armar_info_canal(
+            datos_mercado, candle_period, reg_max, reg_min, reg_close, tiempo_actual,
+            desviacion_max, desviacion_min, pearson, angulo_tendencia, r2
+        )
+    def _armar_info_canal(self, datos_mercado, candle_period, reg_max, reg_min, reg_close, tiempo_actual,
+                          desviacion_max, desviacion_min, pearson, angulo_tendencia, r2):
+        pendiente_max, intercepto_max = reg_max
+        pendiente_min, intercepto_min = reg_min
+        pendiente_cierre, intercepto_cierre = reg_close
+        resistencia_media = pendiente_max * tiempo_actual + intercepto_max
+        soporte_media = pendiente_min * tiempo_actual + intercepto_min
         resistencia_superior = resistencia_media + desviacion_max
         soporte_inferior = soporte_media - desviacion_min
-        precio_actual = datos_mercado['precio_actual']
-        pearson, angulo_tendencia = self.calcular_pearson_y_angulo(tiempos_reg, cierres)
-        fuerza_texto, nivel_fuerza = self.clasificar_fuerza_tendencia(angulo_tendencia)
-        direccion = self.determinar_direccion_tendencia(angulo_tendencia, 1)
         stoch_k, stoch_d = self.calcular_stochastic(datos_mercado)
         precio_medio = (resistencia_superior + soporte_inferior) / 2
         ancho_canal_absoluto = resistencia_superior - soporte_inferior
         ancho_canal_porcentual = (ancho_canal_absoluto / precio_medio) * 100
-        return {
-            'resistencia': resistencia_superior,
-            'soporte': soporte_inferior,
-            'resistencia_media': resistencia_media,
-            'soporte_media': soporte_media,
-            'linea_tendencia': pendiente_cierre * tiempo_actual + intercepto_cierre,
-            'pendiente_tendencia': pendiente_cierre,
-            'precio_actual': precio_actual,
-            'ancho_canal': ancho_canal_absoluto,
-            'ancho_canal_porcentual': ancho_canal_porcentual,
-            'angulo_tendencia': angulo_tendencia,
-            'coeficiente_pearson': pearson,
-            'fuerza_texto': fuerza_texto,
-            'nivel_fuerza': nivel_fuerza,
-            'direccion': direccion,
-            'r2_score': self.calcular_r2(cierres, tiempos_reg, pendiente_cierre, intercepto_cierre),
-            'pendiente_resistencia': pendiente_max,
-            'pendiente_soporte': pendiente_min,
-            'stoch_k': stoch_k,
-            'stoch_d': stoch_d,
-            'timeframe': datos_mercado.get('timeframe', 'N/A'),
-            'num_velas': candle_period
+        valores = {
+            'resistencia': float(resistencia_superior),
+            'soporte': float(soporte_inferior),
+            'resistencia_media': float(resistencia_media),
+            'soporte_media': float(soporte_media),
+            'linea_tendencia': float(pendiente_cierre * tiempo_actual + intercepto_cierre),
+            'pendiente_tendencia': float(pendiente_cierre),
+            'precio_actual': datos_mercado['precio_actual'],
+            'ancho_canal': float(ancho_canal_absoluto),
+            'ancho_canal_porcentual': float(ancho_canal_porcentual),
+            'angulo_tendencia': float(angulo_tendencia),
+            'coeficiente_pearson': float(pearson),
+            'r2_score': float(r2),
+            'pendiente_resistencia': float(pendiente_max),
+            'pendiente_soporte': float(pendiente_min),
+            'stoch_k': float(stoch_k),
+            'stoch_d': float(stoch_d)
         }
+        return self.crear_canal_info(valores, datos_mercado.get('timeframe', 'N/A'), candle_period)
+    def crear_canal_info(self, valores, timeframe, candle_period):
+        fuerza_texto, nivel_fuerza = self.clasificar_fuerza_tendencia(valores['angulo_tendencia'])
+        direccion = self.determinar_direccion_tendencia(valores['angulo_tendencia'], 1)
+        return CanalInfo(
+            resistencia=valores['resistencia'],
+            soporte=valores['soporte'],
+            resistencia_media=valores['resistencia_media'],
+            soporte_media=valores['soporte_media'],
+            linea_tendencia=valores['linea_tendencia'],
+            pendiente_tendencia=valores['pendiente_tendencia'],
+            precio_actual=valores['precio_actual'],
+            ancho_canal=valores['ancho_canal'],
+            ancho_canal_porcentual=valores['ancho_canal_porcentual'],
+            angulo_tendencia=valores['angulo_tendencia'],
+            coeficiente_pearson=valores['coeficiente_pearson'],
+            fuerza_texto=fuerza_texto,
+            nivel_fuerza=nivel_fuerza,
+            direccion=direccion,
+            r2_score=valores['r2_score'],
+            pendiente_resistencia=valores['pendiente_resistencia'],
+            pendiente_soporte=valores['pendiente_soporte'],
+            stoch_k=valores['stoch_k'],
+            stoch_d=valores['stoch_d'],
+            timeframe=timeframe,
+            num_velas=candle_period
+        )
+    def canal_desde_tabla(self, tabla, simbolo):
+        i = tabla.indice[simbolo]
+        return self.crear_canal_info(tabla.fila(simbolo), tabla.timeframes[i], tabla.num_velas[i])
+    def calcular_canal_incremental(self, simbolo, datos_mercado, candle_period):
+        if not datos_mercado or datos_mercado.get('tiempos_apertura') is None:
+            return self.calcular_canal_regresion_config(datos_mercado, candle_period)
+        clave = (simbolo, datos_mercado.get('timeframe'), candle_period)
+        estado = self.canales_incrementales.get(clave)
+        if estado is None:
+            estado = CanalIncremental(candle_period, self.config.get('resync_canal_cada', 288))
+            self.canales_incrementales[clave] = estado
+        if not estado.actualizar(datos_mercado):
+            return None
+        m = estado.metricas()
+        return self._armar_info_canal(
+            datos_mercado, candle_period, m['reg_max'], m['reg_min'], m['reg_close'], m['tiempo_actual'],
+            m['desviacion_max'], m['desviacion_min'], m['pearson'], m['angulo_tendencia'], m['r2']
+        )
     def enviar_alerta_breakout(self, simbolo, tipo_breakout, info_canal, datos_mercado, config_optima):
         precio_cierre = datos_mercado['cierres'][-1]
         resistencia = info_canal['resistencia']
@@ -632,10 +3078,10 @@ class TradingBot:
         chat_ids = self.config.get('telegram_chat_ids', [])
         if token and chat_ids:
             try:
-                self._enviar_telegram_simple(mensaje, token, chat_ids)
-                print(f"     ✅ Alerta de breakout enviada para {simbolo}")
+                self.cola_telegram.encolar(mensaje, token, chat_ids)
+                logger_telegram.info("✅ Alerta de breakout encolada para %s", simbolo, extra={'simbolo': simbolo, 'etapa': 'breakout'})
             except Exception as e:
-                print(f"     ❌ Error enviando alerta de breakout: {e}")
+                logger_telegram.error("❌ Error enviando alerta de breakout: %s", e, extra={'simbolo': simbolo, 'etapa': 'breakout'})
     def detectar_breakout(self, simbolo, info_canal, datos_mercado):
         if not info_canal:
             return None
@@ -651,7 +3097,7 @@ class TradingBot:
         pearson = info_canal['coeficiente_pearson']
         if abs(angulo) < self.config.get('min_trend_strength_degrees', 16):
             return None
-        if abs(pearson) < 0.4 or r2 < 0.4:
+        if abs(pearson) < self.config.get('min_pearson', 0.4) or r2 < self.config.get('min_r2', 0.4):
             return None
         if simbolo in self.breakouts_detectados:
             ultimo_breakout = self.breakouts_detectados[simbolo]
@@ -659,394 +3105,679 @@ class TradingBot:
             if tiempo_desde_ultimo < 115:
                 return None
         if direccion == "🟢 ALCISTA" and nivel_fuerza >= 2:
-            if precio_cierre < soporte:
-                return "BREAKOUT_LONG"
-        elif direccion == "🔴 BAJISTA" and nivel_fuerza >= 2:
-            if precio_cierre > resistencia:
-                return "BREAKOUT_SHORT"
-        return None
-    def detectar_reentry(self, simbolo, info_canal, datos_mercado):
-        if simbolo not in self.esperando_reentry:
-            return None
-        breakout_info = self.esperando_reentry[simbolo]
-        timestamp_breakout = breakout_info['timestamp']
-        tiempo_desde_breakout = (datetime.now() - timestamp_breakout).total_seconds() / 60
-        if tiempo_desde_breakout > 120:
-            print(f"     ⏰ {simbolo} - Timeout de reentry (>30 min), cancelando espera")
-            del self.esperando_reentry[simbolo]
-            if simbolo in self.breakouts_detectados:
-                del self.breakouts_detectados[simbolo]
-            return None
-        precio_actual = datos_mercado['precio_actual']
-        resistencia = info_canal['resistencia']
-        soporte = info_canal['soporte']
-        stoch_k = info_canal['stoch_k']
-        stoch_d = info_canal['stoch_d']
-        tolerancia = 0.001 * precio_actual
-        if breakout_info['tipo'] == "BREAKOUT_LONG":
-            if soporte <= precio_actual <= resistencia:
-                distancia_soporte = abs(precio_actual - soporte)
-                if distancia_soporte <= tolerancia and stoch_k <= 30 and stoch_d <= 30:
-                    if simbolo in self.breakouts_detectados:
-                        del self.breakouts_detectados[simbolo]
-                    return "LONG"
-        elif breakout_info['tipo'] == "BREAKOUT_SHORT":
-            if soporte <= precio_actual <= resistencia:
-                distancia_resistencia = abs(precio_actual - resistencia)
-                if distancia_resistencia <= tolerancia and stoch_k >= 70 and stoch_d >= 70:
-                    if simbolo in self.breakouts_detectados:
-                        del self.breakouts_detectados[simbolo]
-                    return "SHORT"
-        return None
-    def calcular_niveles_entrada(self, tipo_operacion, info_canal, precio_actual):
-        if not info_canal:
-            return None, None, None
-        resistencia = info_canal['resistencia']
-        soporte = info_canal['soporte']
-        ancho_canal = resistencia - soporte
-        sl_porcentaje = 0.02
-        if tipo_operacion == "LONG":
-            precio_entrada = precio_actual
-            stop_loss = precio_entrada * (1 - sl_porcentaje)
-            take_profit = precio_entrada + ancho_canal 
-        else:
-            precio_entrada = precio_actual
-            stop_loss = resistencia * (1 + sl_porcentaje)
-            take_profit = precio_entrada - ancho_canal
-        riesgo = abs(precio_entrada - stop_loss)
-        beneficio = abs(take_profit - precio_entrada)
-        ratio_rr = beneficio / riesgo if riesgo > 0 else 0
-        if ratio_rr < self.config.get('min_rr_ratio', 1.2):
-            if tipo_operacion == "LONG":
-                take_profit = precio_entrada + (riesgo * self.config['min_rr_ratio'])
-            else:
-                take_profit = precio_entrada - (riesgo * self.config['min_rr_ratio'])
-        return precio_entrada, take_profit, stop_loss
-    def calcular_tamaño_posicion(self, symbol, precio_entrada):
-        if not self.trader:
-            return None
-        try:
-            info_cuenta = self.trader.get_account_info()
-            if not info_cuenta:
-                return None
-            balance = float(info_cuenta['availableBalance'])
-            monto_usdt_deseado = balance * 0.03
-            notional_minimo = 5.0
-            if monto_usdt_deseado < notional_minimo:
-                if balance < notional_minimo:
-                    logger_binance.warning(f"⚠️ Saldo insuficiente ({balance:.2f} USDT) para abrir posición en {symbol} (mínimo: {notional_minimo} USDT)")
-                    return None
-                monto_usdt = notional_minimo
-            else:
-                monto_usdt = monto_usdt_deseado
-            symbol_info = self.trader.get_symbol_info(symbol)
-            if not symbol_info:
-                return None
-            step_size = None
-            min_qty = None
-            max_qty = None
-            for f in symbol_info['filters']:
-                if f['filterType'] == 'LOT_SIZE':
-                    step_size = float(f['stepSize'])
-                    min_qty = float(f['minQty'])
-                    max_qty = float(f['maxQty']) if 'maxQty' in f else None
-                    break
-            if step_size is None:
-                logger_binance.error(f"❌ No se pudo obtener LOT_SIZE para {symbol}")
-                return None
-            cantidad_base = monto_usdt / precio_entrada
-            if step_size < 1.0:
-                precision = int(round(-math.log10(step_size), 0))
-                cantidad_ajustada = math.floor(cantidad_base / step_size) * step_size
-                cantidad_ajustada = round(cantidad_ajustada, precision)
-            else:
-                cantidad_ajustada = math.floor(cantidad_base)
-            if min_qty and cantidad_ajustada < min_qty:
-                cantidad_ajustada = min_qty
-            if max_qty and cantidad_ajustada > max_qty:
-                cantidad_ajustada = max_qty
-            notional_final = cantidad_ajustada * precio_entrada
-            if notional_final < notional_minimo:
-                cantidad_minima_necesaria = notional_minimo / precio_entrada
-                if step_size < 1.0:
-                    precision = int(round(-math.log10(step_size), 0))
-                    cantidad_minima_ajustada = math.ceil(cantidad_minima_necesaria / step_size) * step_size
-                    cantidad_minima_ajustada = round(cantidad_minima_ajustada, precision)
-                else:
-                    cantidad_minima_ajustada = math.ceil(cantidad_minima_necesaria)
-                if cantidad_minima_ajustada * precio_entrada > balance:
-                    logger_binance.warning(f"⚠️ Saldo insuficiente para cumplir notional mínimo en {symbol}")
-                    return None
-                if max_qty and cantidad_minima_ajustada > max_qty:
-                    logger_binance.warning(f"⚠️ Cantidad mínima requerida excede maxQty en {symbol}")
-                    return None
-                cantidad_ajustada = cantidad_minima_ajustada
-            if cantidad_ajustada <= 0:
-                logger_binance.error(f"❌ Cantidad ajustada es 0 o negativa para {symbol}")
-                return None
-            logger_binance.info(f"✅ Tamaño posición calculado: {cantidad_ajustada} {symbol} (Notional: {cantidad_ajustada * precio_entrada:.2f} USDT)")
-            return cantidad_ajustada
-        except Exception as e:
-            logger_binance.error(f"❌ Error calculando tamaño posición para {symbol}: {e}")
+            if precio_cierre < soporte:
+                return "BREAKOUT_LONG"
+        elif direccion == "🔴 BAJISTA" and nivel_fuerza >= 2:
+            if precio_cierre > resistencia:
+                return "BREAKOUT_SHORT"
+        return None
+    def detectar_reentry(self, simbolo, info_canal, datos_mercado):
+        if simbolo not in self.esperando_reentry:
+            return None
+        breakout_info = self.esperando_reentry[simbolo]
+        timestamp_breakout = breakout_info['timestamp']
+        tiempo_desde_breakout = (datetime.now() - timestamp_breakout).total_seconds() / 60
+        if tiempo_desde_breakout > 120:
+            logger_escaneo.info("⏰ %s - Timeout de reentry, cancelando espera", simbolo, extra={'simbolo': simbolo, 'etapa': 'reentry'})
+            del self.esperando_reentry[simbolo]
+            if simbolo in self.breakouts_detectados:
+                del self.breakouts_detectados[simbolo]
             return None
+        precio_actual = datos_mercado['precio_actual']
+        resistencia = info_canal['resistencia']
+        soporte = info_canal['soporte']
+        stoch_k = info_canal['stoch_k']
+        stoch_d = info_canal['stoch_d']
+        sobreventa = self.config.get('stoch_sobreventa', 30)
+        sobrecompra = self.config.get('stoch_sobrecompra', 70)
+        tolerancia = 0.001 * precio_actual
+        if breakout_info['tipo'] == "BREAKOUT_LONG":
+            if soporte <= precio_actual <= resistencia:
+                distancia_soporte = abs(precio_actual - soporte)
+                if distancia_soporte <= tolerancia and stoch_k <= sobreventa and stoch_d <= sobreventa:
+                    if simbolo in self.breakouts_detectados:
+                        del self.breakouts_detectados[simbolo]
+                    return "LONG"
+        elif breakout_info['tipo'] == "BREAKOUT_SHORT":
+            if soporte <= precio_actual <= resistencia:
+                distancia_resistencia = abs(precio_actual - resistencia)
+                if distancia_resistencia <= tolerancia and stoch_k >= sobrecompra and stoch_d >= sobrecompra:
+                    if simbolo in self.breakouts_detectados:
+                        del self.breakouts_detectados[simbolo]
+                    return "SHORT"
+        return None
+    def calcular_niveles_entrada(self, tipo_operacion, info_canal, precio_actual):
+        if not info_canal:
+            return None, None, None
+        resistencia = info_canal['resistencia']
+        soporte = info_canal['soporte']
+        ancho_canal = resistencia - soporte
+        sl_porcentaje = 0.02
+        if tipo_operacion == "LONG":
+            precio_entrada = precio_actual
+            stop_loss = precio_entrada * (1 - sl_porcentaje)
+            take_profit = precio_entrada + ancho_canal 
+        else:
+            precio_entrada = precio_actual
+            stop_loss = resistencia * (1 + sl_porcentaje)
+            take_profit = precio_entrada - ancho_canal
+        riesgo = abs(precio_entrada - stop_loss)
+        beneficio = abs(take_profit - precio_entrada)
+        ratio_rr = beneficio / riesgo if riesgo > 0 else 0
+        if ratio_rr < self.config.get('min_rr_ratio', 1.2):
+            if tipo_operacion == "LONG":
+                take_profit = precio_entrada + (riesgo * self.config['min_rr_ratio'])
+            else:
+                take_profit = precio_entrada - (riesgo * self.config['min_rr_ratio'])
+        return precio_entrada, take_profit, stop_loss
+    def crear_cuentas_adicionales(self, definiciones):
+        cuentas = []
+        for definicion in definiciones:
+            nombre = definicion.get('nombre', f"cuenta{len(cuentas) + 1}")
+            trader = BinanceTrader(
+                api_key=definicion['api_key'],
+                secret_key=definicion['secret_key'],
+                testnet=definicion.get('testnet', self.config.get('binance_testnet', True)),
+                ttl_exchange_info=self.config.get('ttl_exchange_info_segundos', 3600),
+                sesion=self.sesion
+            )
+            if not trader.check_connection():
+                logger_ordenes.error("❌ Cuenta %s: no se pudo conectar a Binance, se omite", nombre, extra={'cuenta': nombre, 'etapa': 'arranque'})
+                continue
+            cuentas.append(EjecutorCuenta(
+                nombre, trader, self.config, definicion.get('fraccion_balance', self.config.get('fraccion_balance', 0.03))
+            ))
+        return cuentas
+    def refrescar_estado_cuenta(self):
+        return self.ejecutor.refrescar_estado_cuenta()
+    def calcular_tamaño_posicion(self, symbol, precio_entrada):
+        return self.ejecutor.calcular_tamaño_posicion(symbol, precio_entrada)
+    def ejecutar_operacion_binance(self, simbolo, tipo_operacion, precio_entrada, sl, tp, t_senal=None):
+        """Ejecuta la señal en la cuenta principal y, en paralelo, en las cuentas adicionales"""
+        t_senal = t_senal or time.time()
+        if not self.cuentas_adicionales:
+            ejecucion = self.ejecutor.abrir_operacion(simbolo, tipo_operacion, precio_entrada, sl, tp, t_senal)
+        else:
+            futuros = {
+                cuenta.nombre: self.pool_cuentas.submit(
+                    cuenta.abrir_operacion, simbolo, tipo_operacion, precio_entrada, sl, tp, t_senal
+                )
+                for cuenta in [self.ejecutor] + self.cuentas_adicionales
+                if simbolo not in cuenta.operaciones
+            }
+            for cuenta in self.cuentas_adicionales:
+                futuro = futuros.get(cuenta.nombre)
+                resultado = futuro.result() if futuro else None
+                if resultado:
+                    cuenta.operaciones[simbolo] = OperacionActiva(
+                        tipo=tipo_operacion, precio_entrada=precio_entrada, take_profit=tp, stop_loss=sl,
+                        timestamp_entrada=datetime.now().isoformat(), **resultado
+                    )
+            ejecucion = futuros['principal'].result() if 'principal' in futuros else None
+        if ejecucion:
+            self.ejecuciones_recientes[simbolo] = ejecucion
+        return bool(ejecucion)
+    def mantener_cuentas_adicionales(self):
+        if not self.cuentas_adicionales:
+            return
+        for cuenta, futuro in [(c, self.pool_cuentas.submit(c.ciclo)) for c in self.cuentas_adicionales]:
+            try:
+                futuro.result()
+            except Exception as e:
+                logger_ordenes.warning("⚠️ Error en el ciclo de la cuenta %s: %s", cuenta.nombre, e,
+                                       extra={'cuenta': cuenta.nombre, 'etapa': 'cuenta'})
+    def monitorear_ordenes_activas(self):
+        self.ordenes_cierre_ciclo = self.ejecutor.monitorear(self.operaciones_activas)
     def simbolo_tiene_operacion_activa(self, symbol):
         posicion_en_bot = symbol in self.operaciones_activas
         posiciones_cache = getattr(self, 'posiciones_cache', {})
         posicion_en_broker = float(posiciones_cache.get(symbol, 0)) != 0.0
         if posicion_en_bot and not posicion_en_broker:
-            print(f"🧹 {symbol}: Inconsistencia detectada → posición cerrada en exchange pero activa en bot. Limpiando estado.")
+            logger_ordenes.warning("🧹 %s: posición cerrada en exchange pero activa en bot. Limpiando estado.", symbol, extra={'simbolo': symbol, 'etapa': 'sincronizacion'})
             if symbol in self.operaciones_activas:
                 del self.operaciones_activas[symbol]
             if symbol in self.senales_enviadas:
                 self.senales_enviadas.remove(symbol)
+            self.liberar_posicion_global(symbol)
             return False
         elif not posicion_en_bot and posicion_en_broker:
-            print(f"⚠️ {symbol}: Posición activa en Binance pero no registrada en el bot. Bloqueando nuevas operaciones.")
+            logger_ordenes.warning("⚠️ %s: posición activa en Binance pero no registrada en el bot. Bloqueando nuevas operaciones.", symbol, extra={'simbolo': symbol, 'etapa': 'sincronizacion'})
             return True
         return posicion_en_bot or posicion_en_broker
-    def ejecutar_operacion_binance(self, simbolo, tipo_operacion, precio_entrada, sl, tp):
-        if not self.trader:
-            print("❌ Trader no disponible. Operación omitida.")
-            return False
-        orden_principal = None
-        posicion_abierta = False
-        sl_order = None
-        tp_order = None
-        try:
-            if not self.trader.set_leverage(simbolo, 10):
-                print(f"❌ Falló al establecer apalancamiento 10x para {simbolo}")
-                return False
-            if not self.trader.set_margin_isolated(simbolo):
-                print(f"❌ Falló al configurar margen AISLADO para {simbolo}")
-                return False
-            cantidad = self.calcular_tamaño_posicion(simbolo, precio_entrada)
-            if not cantidad:
-                print(f"❌ No se pudo calcular cantidad válida para {simbolo}")
-                return False
-            side = 'BUY' if tipo_operacion == 'LONG' else 'SELL'
-            sl_side = 'SELL' if tipo_operacion == 'LONG' else 'BUY'
-            ticker = self.trader.client.futures_symbol_ticker(symbol=simbolo)
-            precio_actual = float(ticker['price'])
-            sl_ajustado, tp_ajustado = self.trader.validar_niveles_sl_tp(simbolo, sl_side, sl, tp)
-            sl_ajustado, tp_ajustado = self.trader.verificar_distancia_ordenes(
-                simbolo, precio_actual, sl_ajustado, tp_ajustado, sl_side
-            )
-            orden_principal = self.trader.place_market_order(simbolo, side, cantidad)
-            if not orden_principal:
-                print(f"❌ Falló al abrir posición {tipo_operacion} en {simbolo}")
-                return False
-            posicion_abierta = True
-            time.sleep(1.5)
-            max_retries = 3
-            for attempt in range(max_retries):
-                sl_order = self.trader.place_stop_loss_order(simbolo, sl_side, sl_ajustado)
-                tp_order = self.trader.place_take_profit_order(simbolo, sl_side, tp_ajustado)
-                if sl_order and tp_order:
-                    print(f"✅ Operación {tipo_operacion} en {simbolo} completamente protegida (SL + TP)")
-                    return True
-                if attempt < max_retries - 1:
-                    logger_binance.warning(f"🔄 Reintentando órdenes de cierre ({attempt + 1}/{max_retries}) en {simbolo}")
-                    if tipo_operacion == 'LONG':
-                        sl_ajustado *= 0.995
-                        tp_ajustado *= 1.005
-                    else:
-                        sl_ajustado *= 1.005
-                        tp_ajustado *= 0.995
-                    time.sleep(2)
-                else:
-                    logger_binance.error(f"❌ No se pudieron colocar ambas órdenes de cierre en {simbolo} tras {max_retries} intentos")
-            print(f"⚠️ Cancelando posición en {simbolo} por falta de protección (SL/TP)")
-            self.trader.client.futures_create_order(
-                symbol=simbolo,
-                side='SELL' if side == 'BUY' else 'BUY',
-                type='MARKET',
-                quantity=cantidad
-            )
-            logger_binance.info(f"CloseOperation: Posición cerrada por falta de SL/TP en {simbolo}")
-            return False
-        except Exception as e:
-            logger_binance.error(f"❌ Error crítico en ejecutar_operacion_binance({simbolo}): {e}")
-            if posicion_abierta:
-                try:
-                    logger_binance.warning(f"CloseOperation tras error: cerrando posición en {simbolo}")
-                    self.trader.client.futures_create_order(
-                        symbol=simbolo,
-                        side='SELL' if tipo_operacion == 'LONG' else 'BUY',
-                        type='MARKET',
-                        quantity=cantidad
-                    )
-                except Exception as close_err:
-                    logger_binance.error(f"❌ Error al cerrar posición tras fallo: {close_err}")
-            return False
-    def monitorear_ordenes_activas(self):
-        if not self.trader or not self.operaciones_activas:
-            return
-        for simbolo, operacion in list(self.operaciones_activas.items()):
+    def universo_simbolos(self):
+        """Símbolos candidatos: los N mejores de la criba (si está activa) más los que tienen posición o reentry"""
+        if not self.criba_universo:
+            return self.config.get('symbols', [])
+        if self.criba_universo.vencida():
             try:
-                side_cierre = 'SELL' if operacion['tipo'] == 'LONG' else 'BUY'
-                ordenes_ok = self.trader.recolocar_ordenes_cierre(
-                    simbolo,
-                    side_cierre,
-                    operacion['stop_loss'],
-                    operacion['take_profit']
-                )
-                if not ordenes_ok:
-                    logger_binance.error(f"🚨 CRÍTICO: No se pudieron mantener órdenes de cierre en {simbolo}")
+                seleccion = self.criba_universo.actualizar()
+                logger_escaneo.info("🌐 Criba de universo: %s perpetuos USDT seleccionados", len(seleccion), extra={'etapa': 'universo'})
             except Exception as e:
-                print(f"⚠️ Error monitoreando órdenes para {simbolo}: {e}")
+                self.criba_universo.ultima_actualizacion = time.time()
+                logger_escaneo.error("❌ Error en la criba de universo (se mantiene la lista anterior): %s", e, extra={'etapa': 'universo'})
+        base = self.criba_universo.seleccion or self.config.get('symbols', [])
+        retenidos = [s for s in list(self.operaciones_activas) + list(self.esperando_reentry) if s not in base]
+        return list(base) + list(dict.fromkeys(retenidos))
+    def simbolos_asignados(self):
+        symbols = self.universo_simbolos()
+        if not self.coordinador:
+            return symbols
+        propios = self.coordinador.filtrar_simbolos(symbols)
+        adoptadas = self.coordinador.adoptar_posiciones_huerfanas(set(propios))
+        for simbolo, operacion in adoptadas.items():
+            if not operacion:
+                self.coordinador.liberar_posicion(simbolo)
+                continue
+            if simbolo not in self.operaciones_activas:
+                self.operaciones_activas[simbolo] = OperacionActiva.desde_dict(operacion)
+                self.senales_enviadas.add(simbolo)
+                logger_coordinador.info("🤝 %s: posición adoptada de una instancia caída", simbolo, extra={'simbolo': simbolo, 'etapa': 'adopcion'})
+        return propios
+    def liberar_posicion_global(self, simbolo):
+        if self.coordinador:
+            self.coordinador.liberar_posicion(simbolo)
     def verificar_cierre_operaciones(self):
         if not self.operaciones_activas:
             return []
         operaciones_cerradas = []
         posiciones_dict = getattr(self, 'posiciones_cache', {})
-        for simbolo, operacion in list(self.operaciones_activas.items()):
-            posicion_actual = posiciones_dict.get(simbolo, 0.0)
-            if posicion_actual == 0.0:
-                # ✅ Cancelar órdenes huérfanas antes de limpiar estado
-                if self.trader:
-                    self.trader.cancelar_ordenes_cierre(simbolo)
-                    print(f"     🧹 Órdenes de cierre huérfanas canceladas para {simbolo}")
-
-                datos_mercado = self.obtener_datos_mercado_config(
-                    simbolo,
-                    operacion.get('timeframe_utilizado', '5m'),
-                    operacion.get('velas_utilizadas', 100)
-                )
-                if not datos_mercado:
+        cerradas = {
+            simbolo: operacion for simbolo, operacion in self.operaciones_activas.items()
+            if posiciones_dict.get(simbolo, 0.0) == 0.0
+        }
+        if not cerradas:
+            return []
+        # ✅ Paso crítico primero: cancelar en paralelo las órdenes huérfanas antes de conciliar: un SL/TP que quede vivo
+        # en un símbolo ya plano puede dispararse y abrir otra posición mientras se paginan los trades
+        if self.trader:
+            try:
+                self.ejecutor.cancelar_huerfanas(list(cerradas), getattr(self, 'ordenes_cierre_ciclo', None))
+                logger_ordenes.info("🧹 Órdenes de cierre huérfanas canceladas para %s", ', '.join(cerradas), extra={'etapa': 'cierre'})
+            except Exception as e:
+                logger_ordenes.warning("⚠️ Error cancelando órdenes huérfanas: %s", e, extra={'etapa': 'cierre'})
+        conciliacion = self.conciliar_cierres(cerradas)
+        precios_salida = self.obtener_precios_actuales([s for s in cerradas if s not in conciliacion])
+        filas_log = []
+        for simbolo, operacion in cerradas.items():
+            cierre = conciliacion.get(simbolo)
+            if cierre:
+                precio_salida = cierre['precio_salida']
+                precio_entrada_real = cierre['precio_entrada_real'] or operacion['precio_entrada']
+            else:
+                precio_salida = precios_salida.get(simbolo)
+                precio_entrada_real = operacion['precio_entrada']
+                if precio_salida is None:
                     continue
-                precio_salida = datos_mercado['precio_actual']
-                if operacion['tipo'] == "LONG":
-                    pnl_percent = ((precio_salida - operacion['precio_entrada']) / operacion['precio_entrada']) * 100
-                else:
-                    pnl_percent = ((operacion['precio_entrada'] - precio_salida) / operacion['precio_entrada']) * 100
-                tp = operacion['take_profit']
-                sl = operacion['stop_loss']
+            if operacion['tipo'] == "LONG":
+                pnl_percent = ((precio_salida - precio_entrada_real) / precio_entrada_real) * 100
+            else:
+                pnl_percent = ((precio_entrada_real - precio_salida) / precio_entrada_real) * 100
+            tp = operacion['take_profit']
+            sl = operacion['stop_loss']
+            if cierre and cierre['resultado']:
+                resultado = cierre['resultado']
+            else:
                 resultado = "TP" if (
                     (operacion['tipo'] == "LONG" and precio_salida >= tp * 0.995) or
                     (operacion['tipo'] == "SHORT" and precio_salida <= tp * 1.005)
                 ) else "SL"
-                duracion_minutos = (datetime.now() - datetime.fromisoformat(operacion['timestamp_entrada'])).total_seconds() / 60
-                datos_operacion = {
-                    'timestamp': datetime.now().isoformat(),
-                    'symbol': simbolo,
-                    'tipo': operacion['tipo'],
-                    'precio_entrada': operacion['precio_entrada'],
-                    'take_profit': tp,
-                    'stop_loss': sl,
-                    'precio_salida': precio_salida,
-                    'resultado': resultado,
-                    'pnl_percent': pnl_percent,
-                    'duracion_minutos': duracion_minutos,
-                    'angulo_tendencia': operacion.get('angulo_tendencia', 0),
-                    'pearson': operacion.get('pearson', 0),
-                    'r2_score': operacion.get('r2_score', 0),
-                    'ancho_canal_relativo': operacion.get('ancho_canal_relativo', 0),
-                    'ancho_canal_porcentual': operacion.get('ancho_canal_porcentual', 0),
-                    'nivel_fuerza': operacion.get('nivel_fuerza', 1),
-                    'timeframe_utilizado': operacion.get('timeframe_utilizado', 'N/A'),
-                    'velas_utilizadas': operacion.get('velas_utilizadas', 0),
-                    'stoch_k': operacion.get('stoch_k', 0),
-                    'stoch_d': operacion.get('stoch_d', 0),
-                    'breakout_usado': operacion.get('breakout_usado', False)
-                }
-                mensaje_cierre = self.generar_mensaje_cierre(datos_operacion)
-                token = self.config.get('telegram_token')
-                chats = self.config.get('telegram_chat_ids', [])
-                if token and chats:
-                    try:
-                        self._enviar_telegram_simple(mensaje_cierre, token, chats)
-                    except Exception:
-                        pass
-                self.registrar_operacion(datos_operacion)
-                operaciones_cerradas.append(simbolo)
-                del self.operaciones_activas[simbolo]
-                if simbolo in self.senales_enviadas:
-                    self.senales_enviadas.remove(simbolo)
-                self.operaciones_desde_optimizacion += 1
-                print(f"     📊 {simbolo} Cierre detectado (posición cerrada en Binance) - PnL: {pnl_percent:.2f}%")
+            duracion_minutos = (datetime.now() - datetime.fromisoformat(operacion['timestamp_entrada'])).total_seconds() / 60
+            slippage_salida_bps = ''
+            ms_deteccion_cierre = ''
+            if cierre:
+                objetivo = tp if resultado == "TP" else sl
+                desvio = (objetivo - precio_salida) if operacion['tipo'] == "LONG" else (precio_salida - objetivo)
+                slippage_salida_bps = desvio / objetivo * 10000
+                if cierre['tiempo_salida_ms']:
+                    ms_deteccion_cierre = time.time() * 1000 - cierre['tiempo_salida_ms']
+            datos_operacion = {
+                'timestamp': datetime.now().isoformat(),
+                'symbol': simbolo,
+                'tipo': operacion['tipo'],
+                'precio_entrada': operacion['precio_entrada'],
+                'take_profit': tp,
+                'stop_loss': sl,
+                'precio_salida': precio_salida,
+                'resultado': resultado,
+                'pnl_percent': pnl_percent,
+                'duracion_minutos': duracion_minutos,
+                'angulo_tendencia': operacion.get('angulo_tendencia', 0),
+                'pearson': operacion.get('pearson', 0),
+                'r2_score': operacion.get('r2_score', 0),
+                'ancho_canal_relativo': operacion.get('ancho_canal_relativo', 0),
+                'ancho_canal_porcentual': operacion.get('ancho_canal_porcentual', 0),
+                'nivel_fuerza': operacion.get('nivel_fuerza', 1),
+                'timeframe_utilizado': operacion.get('timeframe_utilizado', 'N/A'),
+                'velas_utilizadas': operacion.get('velas_utilizadas', 0),
+                'stoch_k': operacion.get('stoch_k', 0),
+                'stoch_d': operacion.get('stoch_d', 0),
+                'breakout_usado': operacion.get('breakout_usado', False),
+                'precio_entrada_real': precio_entrada_real,
+                'comision_usdt': cierre['comision'] if cierre else '',
+                'pnl_realizado_usdt': cierre['pnl_realizado'] if cierre else '',
+                'conciliado': bool(cierre),
+                'precio_fill_entrada': operacion.get('precio_fill_entrada', ''),
+                'slippage_entrada_bps': operacion.get('slippage_entrada_bps', ''),
+                'ms_config': operacion.get('ms_config', ''),
+                'ms_orden': operacion.get('ms_orden', ''),
+                'ms_fill': operacion.get('ms_fill', ''),
+                'ms_sl': operacion.get('ms_sl', ''),
+                'ms_tp': operacion.get('ms_tp', ''),
+                'slippage_salida_bps': slippage_salida_bps,
+                'ms_deteccion_cierre': ms_deteccion_cierre
+            }
+            mensaje_cierre = self.generar_mensaje_cierre(datos_operacion)
+            token = self.config.get('telegram_token')
+            chats = self.config.get('telegram_chat_ids', [])
+            if token and chats:
+                try:
+                    self.cola_telegram.encolar(mensaje_cierre, token, chats)
+                except Exception:
+                    pass
+            filas_log.append(datos_operacion)
+            operaciones_cerradas.append(simbolo)
+            del self.operaciones_activas[simbolo]
+            if simbolo in self.senales_enviadas:
+                self.senales_enviadas.remove(simbolo)
+            self.liberar_posicion_global(simbolo)
+            self.operaciones_desde_optimizacion += 1
+            logger_ordenes.info("📊 %s Cierre detectado (posición cerrada en Binance) - PnL: %.2f%%", simbolo, pnl_percent, extra={'simbolo': simbolo, 'etapa': 'cierre'})
+        self.registrar_operaciones(filas_log)
         return operaciones_cerradas
+    def conciliar_cierres(self, cerradas):
+        """Obtiene precio de salida, comisiones y PnL realizado reales de las posiciones cerradas.
+        Una llamada de income (todas las monedas) desde el checkpoint + una de trades por símbolo cerrado,
+        estas últimas en paralelo mientras se pagina el income."""
+        if not self.trader or not cerradas:
+            return {}
+        entradas_ms = {
+            simbolo: int(datetime.fromisoformat(op['timestamp_entrada']).timestamp() * 1000) - 60000
+            for simbolo, op in cerradas.items()
+        }
+        desde = max(self.checkpoint_conciliacion or 0, min(entradas_ms.values()))
+        trades_por_simbolo = {
+            simbolo: self.ejecutor.pool.submit(
+                self.trader.client.futures_account_trades, symbol=simbolo, startTime=entradas_ms[simbolo]
+            ) for simbolo in cerradas
+        }
+        pnl_por_simbolo = {}
+        ultimo_income = None
+        try:
+            inicio = desde
+            while True:
+                registros = self.trader.client.futures_income_history(
+                    incomeType='REALIZED_PNL', startTime=inicio, limit=1000
+                )
+                for registro in registros:
+                    simbolo = registro.get('symbol')
+                    if simbolo in cerradas and registro['time'] >= entradas_ms[simbolo]:
+                        pnl_por_simbolo[simbolo] = pnl_por_simbolo.get(simbolo, 0.0) + float(registro['income'])
+                        ultimo_income = max(ultimo_income or 0, registro['time'])
+                if len(registros) < 1000:
+                    break
+                inicio = registros[-1]['time'] + 1
+        except Exception as e:
+            logger_ordenes.warning("⚠️ Error obteniendo income de PnL realizado: %s", e, extra={'etapa': 'conciliacion'})
+        resultados = {}
+        for simbolo, operacion in cerradas.items():
+            try:
+                trades = trades_por_simbolo[simbolo].result()
+            except Exception as e:
+                logger_ordenes.warning("⚠️ Error obteniendo trades de %s: %s", simbolo, e, extra={'simbolo': simbolo, 'etapa': 'conciliacion'})
+                continue
+            lado_entrada = 'BUY' if operacion['tipo'] == 'LONG' else 'SELL'
+            entradas = [t for t in trades if t['side'] == lado_entrada]
+            salidas = [t for t in trades if t['side'] != lado_entrada]
+            if not salidas:
+                continue
+            cantidad_salida = sum(float(t['qty']) for t in salidas)
+            if cantidad_salida <= 0:
+                continue
+            precio_salida = sum(float(t['price']) * float(t['qty']) for t in salidas) / cantidad_salida
+            cantidad_entrada = sum(float(t['qty']) for t in entradas)
+            precio_entrada_real = (
+                sum(float(t['price']) * float(t['qty']) for t in entradas) / cantidad_entrada
+                if cantidad_entrada > 0 else None
+            )
+            comision = sum(float(t['commission']) for t in trades if t.get('commissionAsset') == 'USDT')
+            pnl_realizado = pnl_por_simbolo.get(simbolo)
+            if pnl_realizado is None:
+                pnl_realizado = sum(float(t.get('realizedPnl', 0)) for t in salidas)
+            ordenes_salida = {t['orderId'] for t in salidas}
+            tiempo_salida_ms = max(int(t.get('time', 0)) for t in salidas)
+            resultado = None
+            if operacion.get('orden_tp_id') in ordenes_salida:
+                resultado = "TP"
+            elif operacion.get('orden_sl_id') in ordenes_salida:
+                resultado = "SL"
+            resultados[simbolo] = {
+                'precio_salida': precio_salida,
+                'precio_entrada_real': precio_entrada_real,
+                'comision': comision,
+                'pnl_realizado': pnl_realizado,
+                'resultado': resultado,
+                'tiempo_salida_ms': tiempo_salida_ms
+            }
+        if ultimo_income is not None:
+            self.checkpoint_conciliacion = ultimo_income + 1
+        return resultados
+    def obtener_precios_actuales(self, simbolos):
+        """Precios de varios símbolos en una sola llamada de tickers"""
+        if not simbolos:
+            return {}
+        try:
+            if self.trader:
+                tickers = self.trader.client.futures_symbol_ticker()
+            else:
+                tickers = requests.get(
+                    "https://api.binance.com/api/v3/ticker/price",
+                    params={'symbols': json.dumps(simbolos, separators=(',', ':'))},
+                    timeout=10
+                ).json()
+            precios = {t['symbol']: float(t['price']) for t in tickers}
+            return {s: precios[s] for s in simbolos if s in precios}
+        except Exception as e:
+            logger_escaneo.warning("⚠️ Error obteniendo precios actuales de %s: %s", ', '.join(simbolos), e, extra={'etapa': 'precio'})
+            return {}
     # ==========================================
-    # ✅ MODIFICACIÓN PRINCIPAL: 5 símbolos por ciclo
+    # ✅ MODIFICACIÓN PRINCIPAL: análisis alineado al cierre de vela
     # ==========================================
+    def seleccionar_simbolos_ciclo(self, symbols):
+        ahora = time.time()
+        max_simbolos = self.config.get('max_simbolos_por_ciclo', 10)
+        reintento_config = self.config.get('reintento_config_minutos', 30) * 60
+        forzados = [s for s in symbols if s in self.simbolos_forzados]
+        candidatos = []
+        for simbolo in symbols:
+            if simbolo in forzados:
+                continue
+            config_optima = self.config_optima_por_simbolo.get(simbolo)
+            if not config_optima:
+                if ahora - self.ultimo_intento_config.get(simbolo, 0) >= reintento_config:
+                    self.ultimo_intento_config[simbolo] = ahora
+                    self.servicio_config.solicitar_refresco(simbolo)
+            elif self.planificador.vela_pendiente(simbolo, config_optima['timeframe'], ahora):
+                canal = self.canales_cache.get(simbolo)
+                precio = self.ultimos_precios.get(simbolo, canal['precio_actual'] if canal else None)
+                segundos_sin_evaluar = ahora - self.ultima_evaluacion.get(simbolo, 0)
+                puntaje = self.priorizador.puntuar(
+                    canal, precio, simbolo in self.esperando_reentry, segundos_sin_evaluar,
+                    INTERVALOS_SEGUNDOS.get(config_optima['timeframe'], 300),
+                    self.volatilidad_reciente.get(simbolo, 0.0)
+                )
+                espera = self.planificador.segundos_esperando(simbolo, config_optima['timeframe'], ahora)
+                candidatos.append((simbolo, puntaje, espera))
+        presupuesto = max(0, max_simbolos - len(forzados))
+        return forzados + self.priorizador.seleccionar(candidatos, presupuesto)
     def escanear_mercado(self):
-        symbols = self.config.get('symbols', [])
+        symbols = self.simbolos_asignados()
         if not symbols:
-            print("❌ No se han definido símbolos para escanear.")
+            logger_escaneo.error("❌ No se han definido símbolos para escanear.", extra={'etapa': 'escaneo'})
             return 0
-        total_symbols = len(symbols)
-        simbolos_a_analizar = 5
+        self.simbolos_en_curso = symbols
+        self.actualizar_correlaciones(symbols)
+        simbolos_ciclo = self.seleccionar_simbolos_ciclo(symbols)
         senales_encontradas = 0
-        print(f"\n🔍 Ciclo de análisis: procesando hasta {simbolos_a_analizar} símbolos de {total_symbols} disponibles")
-        for i in range(simbolos_a_analizar):
-            idx = (self.indice_simbolo_actual + i) % total_symbols
-            simbolo = symbols[idx]
-            print(f"   ➤ Analizando {i+1}/{simbolos_a_analizar}: {simbolo}")
+        logger_escaneo.info("🔍 Ciclo de análisis: %s símbolos con vela nueva de %s disponibles", len(simbolos_ciclo), len(symbols), extra={'etapa': 'escaneo'})
+        preparados, tabla = {}, None
+        if self.motor_indicadores:
+            for simbolo in simbolos_ciclo:
+                try:
+                    preparados[simbolo] = self.preparar_simbolo(simbolo)
+                except Exception as e:
+                    logger_escaneo.warning("⚠️ Error obteniendo datos de %s: %s", simbolo, e, extra={'simbolo': simbolo, 'etapa': 'escaneo'})
+            listos = {simbolo: preparado for simbolo, preparado in preparados.items() if preparado}
+            tabla = self.motor_indicadores.calcular(
+                (simbolo, datos_mercado, config_optima['num_velas'])
+                for simbolo, (config_optima, datos_mercado) in listos.items()
+            )
+        for i, simbolo in enumerate(simbolos_ciclo):
+            logger_escaneo.debug("➤ Analizando %s/%s: %s", i + 1, len(simbolos_ciclo), simbolo, extra={'simbolo': simbolo, 'etapa': 'escaneo'})
             try:
-                if not self.simbolo_tiene_operacion_activa(simbolo) and simbolo not in self.operaciones_activas:
-                    config_optima = self.buscar_configuracion_optima_simbolo(simbolo)
-                    if config_optima:
-                        datos_mercado = self.obtener_datos_mercado_config(
-                            simbolo, config_optima['timeframe'], config_optima['num_velas']
-                        )
-                        if datos_mercado:
-                            info_canal = self.calcular_canal_regresion_config(datos_mercado, config_optima['num_velas'])
-                            if info_canal and info_canal['nivel_fuerza'] >= 2 and abs(info_canal['coeficiente_pearson']) >= 0.4 and info_canal['r2_score'] >= 0.4:
-                                if simbolo not in self.esperando_reentry:
-                                    tipo_breakout = self.detectar_breakout(simbolo, info_canal, datos_mercado)
-                                    if tipo_breakout:
-                                        self.esperando_reentry[simbolo] = {
-                                            'tipo': tipo_breakout,
-                                            'timestamp': datetime.now(),
-                                            'precio_breakout': datos_mercado['precio_actual'],
-                                            'config': config_optima
-                                        }
-                                        self.breakouts_detectados[simbolo] = {
-                                            'tipo': tipo_breakout,
-                                            'timestamp': datetime.now(),
-                                            'precio_breakout': datos_mercado['precio_actual']
-                                        }
-                                        self.enviar_alerta_breakout(simbolo, tipo_breakout, info_canal, datos_mercado, config_optima)
-                                else:
-                                    tipo_operacion = self.detectar_reentry(simbolo, info_canal, datos_mercado)
-                                    if tipo_operacion:
-                                        precio_entrada, tp, sl = self.calcular_niveles_entrada(
-                                            tipo_operacion, info_canal, datos_mercado['precio_actual']
-                                        )
-                                        if precio_entrada and tp and sl:
-                                            if self.ejecutar_operacion_binance(simbolo, tipo_operacion, precio_entrada, sl, tp):
-                                                self.generar_senal_operacion(
-                                                    simbolo, tipo_operacion, precio_entrada, tp, sl,
-                                                    info_canal, datos_mercado, config_optima, self.esperando_reentry[simbolo]
-                                                )
-                                                senales_encontradas += 1
-                                                self.breakout_history[simbolo] = datetime.now()
-                                            else:
-                                                print(f"❌ Operación en {simbolo} no ejecutada en Binance")
-                                            del self.esperando_reentry[simbolo]
+                senales_encontradas += self.analizar_simbolo(simbolo, preparados.get(simbolo), tabla)
             except Exception as e:
-                print(f"⚠️ Error analizando {simbolo}: {e}")
-        self.indice_simbolo_actual = (self.indice_simbolo_actual + simbolos_a_analizar) % total_symbols
+                logger_escaneo.warning("⚠️ Error analizando %s: %s", simbolo, e, extra={'simbolo': simbolo, 'etapa': 'escaneo'})
+            finally:
+                self.simbolos_forzados.discard(simbolo)
+                self.ultima_evaluacion[simbolo] = time.time()
+                config_optima = self.config_optima_por_simbolo.get(simbolo)
+                if config_optima:
+                    self.planificador.marcar_evaluado(simbolo, config_optima['timeframe'])
+        self.ultimo_analisis_completo = time.time()
         if senales_encontradas > 0:
-            print(f"✅ Se encontraron {senales_encontradas} señales de trading en este ciclo")
+            logger_escaneo.info("✅ Se encontraron %s señales de trading en este ciclo", senales_encontradas, extra={'etapa': 'escaneo'})
         else:
-            print(f"❌ No se encontraron señales en este ciclo de {simbolos_a_analizar} símbolos")
+            logger_escaneo.info("❌ No se encontraron señales en este ciclo de %s símbolos", len(simbolos_ciclo), extra={'etapa': 'escaneo'})
         return senales_encontradas
+    def preparar_simbolo(self, simbolo):
+        """Configuración óptima y ventana de mercado del símbolo, o None si no corresponde evaluarlo"""
+        if self.simbolo_tiene_operacion_activa(simbolo) or simbolo in self.operaciones_activas:
+            return None
+        config_optima = self.buscar_configuracion_optima_simbolo(simbolo)
+        if not config_optima:
+            return None
+        datos_mercado = self.obtener_datos_mercado_config(
+            simbolo, config_optima['timeframe'], config_optima['num_velas']
+        )
+        if not datos_mercado:
+            return None
+        self.ultimos_precios[simbolo] = datos_mercado['precio_actual']
+        return config_optima, datos_mercado
+    def analizar_simbolo(self, simbolo, preparado=None, tabla=None):
+        """Sin tabla prepara y calcula el canal del símbolo por su cuenta; con tabla usa la fila del motor por lotes"""
+        if tabla is None:
+            preparado = self.preparar_simbolo(simbolo)
+        if not preparado:
+            return 0
+        config_optima, datos_mercado = preparado
+        if tabla is not None and simbolo in tabla:
+            info_canal = self.canal_desde_tabla(tabla, simbolo)
+            self.volatilidad_reciente[simbolo] = float(tabla.columnas['volatilidad'][tabla.indice[simbolo]])
+        else:
+            info_canal = self.calcular_canal_incremental(simbolo, datos_mercado, config_optima['num_velas'])
+            self.volatilidad_reciente[simbolo] = self.calcular_volatilidad_reciente(datos_mercado['cierres'])
+        if info_canal:
+            self.canales_cache[simbolo] = info_canal
+        if not (info_canal and info_canal['nivel_fuerza'] >= 2
+                and abs(info_canal['coeficiente_pearson']) >= self.config.get('min_pearson', 0.4)
+                and info_canal['r2_score'] >= self.config.get('min_r2', 0.4)):
+            return 0
+        if simbolo not in self.esperando_reentry:
+            tipo_breakout = self.detectar_breakout(simbolo, info_canal, datos_mercado)
+            if tipo_breakout:
+                self.esperando_reentry[simbolo] = {
+                    'tipo': tipo_breakout,
+                    'timestamp': datetime.now(),
+                    'precio_breakout': datos_mercado['precio_actual'],
+                    'config': config_optima
+                }
+                self.breakouts_detectados[simbolo] = {
+                    'tipo': tipo_breakout,
+                    'timestamp': datetime.now(),
+                    'precio_breakout': datos_mercado['precio_actual']
+                }
+                self.enviar_alerta_breakout(simbolo, tipo_breakout, info_canal, datos_mercado, config_optima)
+            return 0
+        tipo_operacion = self.detectar_reentry(simbolo, info_canal, datos_mercado)
+        if not tipo_operacion:
+            return 0
+        t_senal = time.time()
+        senales = 0
+        precio_entrada, tp, sl = self.calcular_niveles_entrada(
+            tipo_operacion, info_canal, datos_mercado['precio_actual']
+        )
+        if precio_entrada and tp and sl:
+            if self.pausado.is_set():
+                logger_ordenes.warning("⏸️ %s: señal %s omitida, bot en pausa", simbolo, tipo_operacion, extra={'simbolo': simbolo, 'etapa': 'senal'})
+            elif not self.permitir_por_correlacion(simbolo, tipo_operacion):
+                logger_ordenes.warning("⛔ %s: operación omitida por riesgo de cluster correlacionado", simbolo, extra={'simbolo': simbolo, 'etapa': 'senal'})
+            elif self.coordinador and not self.coordinador.reservar_posicion(simbolo):
+                logger_ordenes.warning("⛔ %s: límite global de posiciones alcanzado, operación omitida", simbolo, extra={'simbolo': simbolo, 'etapa': 'senal'})
+            elif self.ejecutar_operacion_binance(simbolo, tipo_operacion, precio_entrada, sl, tp, t_senal):
+                self.generar_senal_operacion(
+                    simbolo, tipo_operacion, precio_entrada, tp, sl,
+                    info_canal, datos_mercado, config_optima, self.esperando_reentry[simbolo]
+                )
+                senales = 1
+                self.breakout_history[simbolo] = datetime.now()
+                if self.coordinador and simbolo in self.operaciones_activas:
+                    self.coordinador.actualizar_posicion(simbolo, self.operaciones_activas[simbolo].a_dict())
+            else:
+                logger_ordenes.error("❌ Operación en %s no ejecutada en Binance", simbolo, extra={'simbolo': simbolo, 'etapa': 'senal'})
+                self.liberar_posicion_global(simbolo)
+        del self.esperando_reentry[simbolo]
+        return senales
+    def actualizar_correlaciones(self, symbols):
+        """Una vez por vela base cerrada: un ticker de todo el mercado aporta la columna de retornos"""
+        if not self.matriz_correlacion:
+            return
+        apertura = self.planificador.apertura_ultima_vela_cerrada(self.config.get('timeframe_base', '5m'))
+        if self.matriz_correlacion.ultima_apertura is not None and apertura <= self.matriz_correlacion.ultima_apertura:
+            return
+        universo = set(symbols) | set(self.operaciones_activas)
+        try:
+            respuesta = requests.get("https://api.binance.com/api/v3/ticker/price", timeout=10)
+            precios = {t['symbol']: float(t['price']) for t in respuesta.json() if t['symbol'] in universo}
+        except Exception as e:
+            logger_escaneo.warning("⚠️ Error actualizando la matriz de correlación: %s", e, extra={'etapa': 'correlacion'})
+            return
+        self.matriz_correlacion.agregar_vela(apertura, precios)
+    def permitir_por_correlacion(self, simbolo, tipo_operacion):
+        """Rechaza la entrada si la exposición del cluster correlacionado (la nueva posición más las abiertas
+        con |ρ| >= umbral, con signo según dirección) supera el límite"""
+        if not self.matriz_correlacion or not self.operaciones_activas:
+            return True
+        abiertas = {
+            s: 1 if op['tipo'] == 'LONG' else -1 for s, op in self.operaciones_activas.items() if s != simbolo
+        }
+        rho = self.matriz_correlacion.correlaciones(simbolo, list(abiertas))
+        umbral = self.config.get('correlacion_umbral', 0.7)
+        direccion = 1 if tipo_operacion == 'LONG' else -1
+        cluster = {s: r for s, r in rho.items() if abs(r) >= umbral}
+        exposicion = 1.0 + sum(r * abiertas[s] * direccion for s, r in cluster.items())
+        limite = self.config.get('correlacion_max_exposicion', 2.5)
+        if exposicion > limite:
+            logger_ordenes.info("🔗 %s %s: exposición de cluster %.2f > %.2f (%s)", simbolo, tipo_operacion,
+                                exposicion, limite, ', '.join(f"{s} ρ={r:.2f}" for s, r in cluster.items()),
+                                extra={'simbolo': simbolo, 'etapa': 'correlacion'})
+            return False
+        return True
+    def verificar_precios_reentry(self):
+        """Chequeo ligero entre cierres: un ticker por lote contra el canal cacheado de cada símbolo en espera"""
+        candidatos = [s for s in self.esperando_reentry if s in self.canales_cache]
+        if not candidatos:
+            return []
+        try:
+            respuesta = requests.get(
+                "https://api.binance.com/api/v3/ticker/price",
+                params={'symbols': json.dumps(candidatos, separators=(',', ':'))},
+                timeout=10
+            )
+            precios = {t['symbol']: float(t['price']) for t in respuesta.json()}
+        except Exception as e:
+            logger_escaneo.warning("⚠️ Error en chequeo ligero de precios: %s", e, extra={'etapa': 'precio'})
+            return []
+        self.ultimos_precios.update(precios)
+        forzados = []
+        for simbolo in candidatos:
+            precio = precios.get(simbolo)
+            if precio is None:
+                continue
+            if self.precio_en_zona_reentry(self.esperando_reentry[simbolo]['tipo'], self.canales_cache[simbolo], precio):
+                forzados.append(simbolo)
+        if forzados:
+            logger_escaneo.info("⚡ Precio cerca del borde del canal, evaluación inmediata: %s", ', '.join(forzados), extra={'etapa': 'precio'})
+            self.simbolos_forzados.update(forzados)
+        return forzados
+    def calcular_volatilidad_reciente(self, cierres, periodo=20):
+        """Desviación estándar de los últimos retornos, en %"""
+        if len(cierres) < 3:
+            return 0.0
+        recientes = np.asarray(cierres[-(periodo + 1):], dtype=float)
+        retornos = np.diff(recientes) / recientes[:-1]
+        return float(np.std(retornos) * 100)
+    def precio_en_zona_reentry(self, tipo_breakout, canal, precio, confirmar_stoch=False):
+        tolerancia = 0.001 * precio
+        if not (canal['soporte'] <= precio <= canal['resistencia']):
+            return False
+        if tipo_breakout == "BREAKOUT_LONG":
+            cerca = abs(precio - canal['soporte']) <= tolerancia
+            sobreventa = self.config.get('stoch_sobreventa', 30)
+            stoch_ok = canal['stoch_k'] <= sobreventa and canal['stoch_d'] <= sobreventa
+        else:
+            cerca = abs(precio - canal['resistencia']) <= tolerancia
+            sobrecompra = self.config.get('stoch_sobrecompra', 70)
+            stoch_ok = canal['stoch_k'] >= sobrecompra and canal['stoch_d'] >= sobrecompra
+        return cerca and (stoch_ok or not confirmar_stoch)
+    def procesar_tick_reentry(self, simbolo, precio):
+        """Se ejecuta en el hilo del websocket: solo marca el símbolo y despierta el bucle principal"""
+        breakout_info = self.esperando_reentry.get(simbolo)
+        canal = self.canales_cache.get(simbolo)
+        if not breakout_info or not canal:
+            return False
+        self.ultimos_precios[simbolo] = precio
+        ahora = time.time()
+        if ahora - self.ultimo_disparo_tick.get(simbolo, 0) < self.config.get('reentry_tick_cooldown_segundos', 15):
+            return False
+        if not self.precio_en_zona_reentry(breakout_info['tipo'], canal, precio, confirmar_stoch=True):
+            return False
+        self.ultimo_disparo_tick[simbolo] = ahora
+        self.simbolos_forzados.add(simbolo)
+        self.evento_despertar.set()
+        logger_escaneo.info("⚡ %s: tick %.8f en zona de reentry, evaluando de inmediato", simbolo, precio, extra={'simbolo': simbolo, 'etapa': 'reentry'})
+        return True
+    def sincronizar_vigilante_reentry(self):
+        if self.vigilante_reentry:
+            self.vigilante_reentry.sincronizar([s for s in self.esperando_reentry if s in self.canales_cache])
+    def esperar_proximo_ciclo(self, segundos=None):
+        if segundos is None:
+            segundos = self.segundos_hasta_proximo_ciclo()
+        if self.evento_despertar.wait(segundos):
+            self.evento_despertar.clear()
+    def hay_evaluaciones_pendientes(self):
+        if self.simbolos_forzados:
+            return True
+        for simbolo in self.simbolos_en_curso:
+            config_optima = self.config_optima_por_simbolo.get(simbolo)
+            if config_optima and self.planificador.vela_pendiente(simbolo, config_optima['timeframe']):
+                return True
+        return False
+    def segundos_hasta_proximo_ciclo(self):
+        espera = self.config.get('scan_interval_minutes', 1) * 60 - (time.time() - self.ultimo_analisis_completo)
+        timeframes = {
+            self.config_optima_por_simbolo[s]['timeframe']
+            for s in self.simbolos_en_curso if s in self.config_optima_por_simbolo
+        }
+        hasta_cierre = self.planificador.segundos_hasta_proximo_cierre(timeframes)
+        if hasta_cierre is not None:
+            espera = min(espera, hasta_cierre)
+        if self.esperando_reentry:
+            espera = min(espera, self.config.get('intervalo_chequeo_precio_segundos', 60))
+        return max(1, espera)
+    def ejecutar_ciclo_programado(self):
+        maximo = self.config.get('scan_interval_minutes', 1) * 60
+        self.verificar_precios_reentry()
+        senales = 0
+        if self.hay_evaluaciones_pendientes() or time.time() - self.ultimo_analisis_completo >= maximo:
+            senales = self.ejecutar_analisis()
+        self.sincronizar_vigilante_reentry()
+        self.publicar_instantanea()
+        return senales
     def ejecutar_analisis(self):
         self.posiciones_cache = {}
+        self.ordenes_cierre_ciclo = None
         if self.trader:
-            try:
-                posiciones = self.trader.client.futures_position_information()
-                self.posiciones_cache = {p['symbol']: float(p['positionAmt']) for p in posiciones}
-            except Exception as e:
-                print(f"⚠️ Error obteniendo posiciones reales (uso cache vacío): {e}")
-                self.posiciones_cache = {}
-        if random.random() < 0.1:
-            self.reoptimizar_periodicamente()
-            self.verificar_envio_reporte_automatico()
+            if self.refrescar_estado_cuenta():
+                self.posiciones_cache = dict(self.estado_cuenta.posiciones)
+            else:
+                logger_ordenes.warning("⚠️ Error obteniendo posiciones reales (uso cache vacío)", extra={'etapa': 'cuenta'})
+        self.reoptimizar_periodicamente()
+        self.verificar_envio_reporte_automatico()
         self.monitorear_ordenes_activas()
+        self.mantener_cuentas_adicionales()
         cierres = self.verificar_cierre_operaciones()
         if cierres:
-            print(f"     📊 Operaciones cerradas: {', '.join(cierres)}")
+            logger_ordenes.info("📊 Operaciones cerradas: %s", ', '.join(cierres), extra={'etapa': 'cierre'})
         self.guardar_estado()
         return self.escanear_mercado()
     def generar_senal_operacion(self, simbolo, tipo_operacion, precio_entrada, tp, sl,
@@ -1096,72 +3827,115 @@ class TradingBot:
         chat_ids = self.config.get('telegram_chat_ids', [])
         if token and chat_ids:
             try:
-                self._enviar_telegram_simple(mensaje, token, chat_ids)
-                print(f"     ✅ Señal {tipo_operacion} para {simbolo} enviada")
+                self.cola_telegram.encolar(mensaje, token, chat_ids)
+                logger_telegram.info("✅ Señal %s para %s encolada", tipo_operacion, simbolo, extra={'simbolo': simbolo, 'etapa': 'senal'})
             except Exception as e:
-                print(f"     ❌ Error enviando señal: {e}")
-        self.operaciones_activas[simbolo] = {
-            'tipo': tipo_operacion,
-            'precio_entrada': precio_entrada,
-            'take_profit': tp,
-            'stop_loss': sl,
-            'timestamp_entrada': datetime.now().isoformat(),
-            'angulo_tendencia': info_canal['angulo_tendencia'],
-            'pearson': info_canal['coeficiente_pearson'],
-            'r2_score': info_canal['r2_score'],
-            'ancho_canal_relativo': info_canal['ancho_canal'] / precio_entrada,
-            'ancho_canal_porcentual': info_canal['ancho_canal_porcentual'],
-            'nivel_fuerza': info_canal['nivel_fuerza'],
-            'timeframe_utilizado': config_optima['timeframe'],
-            'velas_utilizadas': config_optima['num_velas'],
-            'stoch_k': info_canal['stoch_k'],
-            'stoch_d': info_canal['stoch_d'],
-            'breakout_usado': breakout_info is not None
-        }
+                logger_telegram.error("❌ Error enviando señal: %s", e, extra={'simbolo': simbolo, 'etapa': 'senal'})
+        self.operaciones_activas[simbolo] = OperacionActiva(
+            tipo=tipo_operacion,
+            precio_entrada=precio_entrada,
+            take_profit=tp,
+            stop_loss=sl,
+            timestamp_entrada=datetime.now().isoformat(),
+            angulo_tendencia=info_canal['angulo_tendencia'],
+            pearson=info_canal['coeficiente_pearson'],
+            r2_score=info_canal['r2_score'],
+            ancho_canal_relativo=info_canal['ancho_canal'] / precio_entrada,
+            ancho_canal_porcentual=info_canal['ancho_canal_porcentual'],
+            nivel_fuerza=info_canal['nivel_fuerza'],
+            timeframe_utilizado=config_optima['timeframe'],
+            velas_utilizadas=config_optima['num_velas'],
+            stoch_k=info_canal['stoch_k'],
+            stoch_d=info_canal['stoch_d'],
+            breakout_usado=breakout_info is not None,
+            **self.ejecuciones_recientes.pop(simbolo, {})
+        )
         self.senales_enviadas.add(simbolo)
         self.total_operaciones += 1
     def inicializar_log(self):
         if not os.path.exists(self.archivo_log):
             with open(self.archivo_log, 'w', newline='', encoding='utf-8') as f:
                 writer = csv.writer(f)
-                writer.writerow([
-                    'timestamp', 'symbol', 'tipo', 'precio_entrada',
-                    'take_profit', 'stop_loss', 'precio_salida',
-                    'resultado', 'pnl_percent', 'duracion_minutos',
-                    'angulo_tendencia', 'pearson', 'r2_score',
-                    'ancho_canal_relativo', 'ancho_canal_porcentual',
-                    'nivel_fuerza', 'timeframe_utilizado', 'velas_utilizadas',
-                    'stoch_k', 'stoch_d', 'breakout_usado'
-                ])
+                writer.writerow(COLUMNAS_LOG)
+            return
+        self.migrar_columnas_log()
+    def migrar_columnas_log(self):
+        """Reescribe el log con la cabecera actual si le faltan columnas nuevas (las filas viejas quedan vacías)"""
+        try:
+            with open(self.archivo_log, 'r', newline='', encoding='utf-8') as f:
+                reader = csv.DictReader(f)
+                cabecera = reader.fieldnames or []
+                if all(columna in cabecera for columna in COLUMNAS_LOG):
+                    return
+                filas = list(reader)
+            with open(self.archivo_log, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=COLUMNAS_LOG, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(filas)
+            logger_estado.info("🗂️ Log de operaciones migrado a %s columnas", len(COLUMNAS_LOG), extra={'etapa': 'log_operaciones'})
+        except Exception as e:
+            logger_estado.error("❌ Error migrando columnas del log: %s", e, extra={'etapa': 'log_operaciones'})
+    def resumen_ejecucion(self):
+        """Percentiles de latencia por etapa y de slippage (bps, positivo = en contra) por símbolo y total"""
+        muestras = {}
+        try:
+            with open(self.archivo_log, 'r', newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    for grupo in (row.get('symbol', '?'), 'TOTAL'):
+                        destino = muestras.setdefault(grupo, {m: [] for m in METRICAS_EJECUCION})
+                        for metrica in METRICAS_EJECUCION:
+                            try:
+                                destino[metrica].append(float(row.get(metrica) or 'nan'))
+                            except ValueError:
+                                continue
+        except FileNotFoundError:
+            return {}
+        resumen = {}
+        for grupo, metricas in muestras.items():
+            resumen[grupo] = {}
+            for metrica, valores in metricas.items():
+                valores = np.array(valores, dtype=float)
+                valores = valores[~np.isnan(valores)]
+                if not len(valores):
+                    continue
+                p50, p90, p99 = np.percentile(valores, [50, 90, 99])
+                resumen[grupo][metrica] = {
+                    'n': int(len(valores)), 'media': float(valores.mean()),
+                    'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(valores.max())
+                }
+        return resumen
     def registrar_operacion(self, datos_operacion):
+        self.registrar_operaciones([datos_operacion])
+    def registrar_operaciones(self, filas):
+        """Agrega las operaciones cerradas del ciclo al CSV con una sola apertura del archivo"""
+        if not filas:
+            return
         with open(self.archivo_log, 'a', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
-            writer.writerow([
-                datos_operacion['timestamp'],
-                datos_operacion['symbol'],
-                datos_operacion['tipo'],
-                datos_operacion['precio_entrada'],
-                datos_operacion['take_profit'],
-                datos_operacion['stop_loss'],
-                datos_operacion['precio_salida'],
-                datos_operacion['resultado'],
-                datos_operacion['pnl_percent'],
-                datos_operacion['duracion_minutos'],
-                datos_operacion['angulo_tendencia'],
-                datos_operacion['pearson'],
-                datos_operacion['r2_score'],
-                datos_operacion.get('ancho_canal_relativo', 0),
-                datos_operacion.get('ancho_canal_porcentual', 0),
-                datos_operacion.get('nivel_fuerza', 1),
-                datos_operacion.get('timeframe_utilizado', 'N/A'),
-                datos_operacion.get('velas_utilizadas', 0),
-                datos_operacion.get('stoch_k', 0),
-                datos_operacion.get('stoch_d', 0),
-                datos_operacion.get('breakout_usado', False)
-            ])
+            writer.writerows([
+                datos_operacion[columna] if columna in COLUMNAS_LOG_OBLIGATORIAS
+                else datos_operacion.get(columna, VALORES_DEFECTO_LOG.get(columna, ''))
+                for columna in COLUMNAS_LOG
+            ] for datos_operacion in filas)
+        with self.lock_reporte:
+            self.operaciones_recientes.extend({
+                'timestamp': datetime.fromisoformat(datos_operacion['timestamp']),
+                'symbol': datos_operacion['symbol'],
+                'resultado': datos_operacion['resultado'],
+                'pnl_percent': float(datos_operacion['pnl_percent']),
+                'tipo': datos_operacion['tipo'],
+                'breakout_usado': bool(datos_operacion.get('breakout_usado', False))
+            } for datos_operacion in filas)
     def filtrar_operaciones_ultima_semana(self):
+        """Ventana de 7 días en memoria: el CSV solo se lee una vez al arrancar"""
+        fecha_limite = datetime.now() - timedelta(days=7)
+        with self.lock_reporte:
+            while self.operaciones_recientes and self.operaciones_recientes[0]['timestamp'] < fecha_limite:
+                self.operaciones_recientes.popleft()
+            return list(self.operaciones_recientes)
+    def cargar_operaciones_recientes(self):
         if not os.path.exists(self.archivo_log):
-            return []
+            return
         try:
             ops_recientes = []
             fecha_limite = datetime.now() - timedelta(days=7)
@@ -1181,10 +3955,11 @@ class TradingBot:
                             })
                     except Exception:
                         continue
-            return ops_recientes
+            ops_recientes.sort(key=lambda op: op['timestamp'])
+            with self.lock_reporte:
+                self.operaciones_recientes = deque(ops_recientes)
         except Exception as e:
-            print(f"⚠️ Error filtrando operaciones: {e}")
-            return []
+            logger_estado.error("❌ Error cargando operaciones recientes: %s", e, extra={'etapa': 'log_operaciones'})
     def generar_reporte_semanal(self):
         ops_ultima_semana = self.filtrar_operaciones_ultima_semana()
         if not ops_ultima_semana:
@@ -1239,11 +4014,12 @@ class TradingBot:
         chat_ids = self.config.get('telegram_chat_ids', [])
         if token and chat_ids:
             try:
-                self._enviar_telegram_simple(mensaje, token, chat_ids)
-                print("✅ Reporte semanal enviado correctamente")
-                return True
+                if self.cola_telegram.encolar(mensaje, token, chat_ids):
+                    logger_telegram.info("✅ Reporte semanal encolado correctamente", extra={'etapa': 'reporte'})
+                    return True
+                return False
             except Exception as e:
-                print(f"❌ Error enviando reporte: {e}")
+                logger_telegram.error("❌ Error enviando reporte: %s", e, extra={'etapa': 'reporte'})
                 return False
         return False
     def verificar_envio_reporte_automatico(self):
@@ -1261,7 +4037,7 @@ class TradingBot:
                         f.write(ahora.strftime('%Y-%m-%d'))
                     return True
             except Exception as e:
-                print(f"⚠️ Error en envío automático: {e}")
+                logger_telegram.error("❌ Error en envío automático: %s", e, extra={'etapa': 'reporte'})
         return False
     def generar_mensaje_cierre(self, datos_operacion):
         emoji = "🟢" if datos_operacion['resultado'] == "TP" else "🔴"
@@ -1297,7 +4073,9 @@ class TradingBot:
         maximos = datos_mercado['maximos']
         minimos = datos_mercado['minimos']
         k_values = []
-        for i in range(period-1, len(cierres)):
+        # Solo las últimas k_period + d_period - 1 lecturas de %K influyen en el resultado
+        inicio = max(period - 1, len(cierres) - (k_period + d_period - 1))
+        for i in range(inicio, len(cierres)):
             highest_high = max(maximos[i-period+1:i+1])
             lowest_low = min(minimos[i-period+1:i+1])
             if highest_high == lowest_low:
@@ -1384,12 +4162,12 @@ class TradingBot:
         return 1 - (ss_res / ss_tot)
     def _enviar_telegram_simple(self, mensaje, token, chat_ids):
         if not token:
-            print("⚠️ TELEGRAM_TOKEN no está definido en las variables de entorno.")
+            logger_telegram.warning("⚠️ TELEGRAM_TOKEN no está definido en las variables de entorno.")
             return False
         if not chat_ids:
-            print("⚠️ TELEGRAM_CHAT_ID no está definido en las variables de entorno.")
+            logger_telegram.warning("⚠️ TELEGRAM_CHAT_ID no está definido en las variables de entorno.")
             return False
-        print(f"📡 Enviando mensaje a Telegram (Chat IDs: {chat_ids})...")
+        logger_telegram.debug("📡 Enviando mensaje a Telegram (Chat IDs: %s)", chat_ids, extra={'etapa': 'envio'})
         resultados = []
         for chat_id in chat_ids:
             url = f"https://api.telegram.org/bot{token}/sendMessage"
@@ -1397,76 +4175,159 @@ class TradingBot:
             try:
                 r = requests.post(url, json=payload, timeout=10)
                 if r.status_code == 200:
-                    print(f"✅ Mensaje enviado exitosamente al chat {chat_id}.")
+                    logger_telegram.debug("✅ Mensaje enviado al chat %s", chat_id, extra={'etapa': 'envio'})
                     resultados.append(True)
                 else:
-                    print(f"❌ Error al enviar a {chat_id}: {r.status_code} - {r.text}")
+                    logger_telegram.error("❌ Error al enviar a %s: %s - %s", chat_id, r.status_code, r.text, extra={'etapa': 'envio'})
                     resultados.append(False)
             except Exception as e:
-                print(f"❌ Excepción al enviar a {chat_id}: {e}")
+                logger_telegram.error("❌ Excepción al enviar a %s: %s", chat_id, e, extra={'etapa': 'envio'})
                 resultados.append(False)
         return any(resultados)
+    def publicar_instantanea(self):
+        """Foto del estado armada en el hilo de trading; los comandos de Telegram solo leen esta foto"""
+        self.instantanea = {
+            'generada': time.time(),
+            'ultimo_analisis': self.ultimo_analisis_completo,
+            'simbolos': len(self.simbolos_en_curso),
+            'configs': dict(self.config_optima_por_simbolo),
+            'balance': self.estado_cuenta.balance_disponible if self.trader and self.estado_cuenta.actualizado else None,
+            'operaciones': {simbolo: op.a_dict() for simbolo, op in self.operaciones_activas.items()},
+            'operaciones_cuentas': {cuenta.nombre: sorted(cuenta.operaciones) for cuenta in self.cuentas_adicionales},
+            'esperando_reentry': {simbolo: info['tipo'] for simbolo, info in self.esperando_reentry.items()},
+            'canales': dict(self.canales_cache),
+            'precios': dict(self.ultimos_precios)
+        }
+    def atender_comando_telegram(self, update):
+        """Responde un comando del webhook desde la foto publicada; la respuesta sale por la cola de Telegram"""
+        mensaje = update.get('message') or update.get('edited_message') or {}
+        texto = (mensaje.get('text') or '').strip()
+        chat_id = str(mensaje.get('chat', {}).get('id', ''))
+        if not texto.startswith('/'):
+            return False
+        token = self.config.get('telegram_token')
+        if not token or chat_id not in [str(c) for c in self.config.get('telegram_chat_ids', [])]:
+            logger_telegram.warning("⛔ Comando ignorado de chat no autorizado %s", chat_id, extra={'etapa': 'comando'})
+            return False
+        partes = texto.split()
+        comando = partes[0].split('@')[0].lower()
+        manejador = COMANDOS_TELEGRAM.get(comando)
+        if manejador:
+            respuesta = getattr(self, manejador)(partes[1:], self.instantanea)
+        else:
+            respuesta = "🤖 Comandos: " + ", ".join(COMANDOS_TELEGRAM) + " (/channel SYMBOL)"
+        logger_telegram.info("💬 Comando %s de %s", comando, chat_id, extra={'etapa': 'comando'})
+        return self.cola_telegram.encolar(respuesta, token, [chat_id])
+    def comando_estado(self, argumentos, foto):
+        ahora = time.time()
+        balance = f"{foto['balance']:.2f} USDT" if foto.get('balance') is not None else "N/D"
+        ultimo = f"hace {ahora - foto['ultimo_analisis']:.0f}s" if foto.get('ultimo_analisis') else "sin análisis aún"
+        cuentas = ''.join(f"\n👥 {nombre}: {len(ops)} operaciones" for nombre, ops in foto.get('operaciones_cuentas', {}).items())
+        return f"""
+<b>ESTADO DEL BOT</b>
+{'⏸️ EN PAUSA (no abre operaciones)' if self.pausado.is_set() else '▶️ ACTIVO'}
+🔍 Símbolos: {foto.get('simbolos', 0)} | Configs óptimas: {len(foto.get('configs', {}))}
+📊 Operaciones activas: {len(foto.get('operaciones', {}))}{cuentas}
+⏳ Esperando reentry: {len(foto.get('esperando_reentry', {}))}
+💰 Saldo disponible: {balance}
+🕐 Último análisis: {ultimo}
+📸 Foto de hace {ahora - foto.get('generada', ahora):.0f}s
+        """
+    def comando_posiciones(self, argumentos, foto):
+        operaciones = foto.get('operaciones', {})
+        if not operaciones:
+            return "📭 Sin operaciones activas"
+        lineas = ["<b>OPERACIONES ACTIVAS</b>"]
+        for simbolo, op in sorted(operaciones.items()):
+            precio = foto.get('precios', {}).get(simbolo)
+            pnl = ''
+            if precio and op['precio_entrada']:
+                signo = 1 if op['tipo'] == 'LONG' else -1
+                pnl = f" | PnL {signo * (precio - op['precio_entrada']) / op['precio_entrada'] * 100:+.2f}%"
+            lineas.append(
+                f"{'🟢' if op['tipo'] == 'LONG' else '🔴'} <b>{simbolo}</b> {op['tipo']} @ {op['precio_entrada']:.8f}"
+                f"\n   🎯 TP {op['take_profit']:.8f} | 🛑 SL {op['stop_loss']:.8f}{pnl}"
+            )
+        return "\n".join(lineas)
+    def comando_reporte(self, argumentos, foto):
+        return self.generar_reporte_semanal() or "📭 Sin operaciones cerradas en los últimos 7 días"
+    def comando_canal(self, argumentos, foto):
+        if not argumentos:
+            return "Uso: /channel SYMBOL"
+        simbolo = argumentos[0].upper()
+        canal = foto.get('canales', {}).get(simbolo)
+        if not canal:
+            return f"📭 Sin canal calculado para {simbolo}"
+        config_optima = foto.get('configs', {}).get(simbolo, {})
+        reentry = foto.get('esperando_reentry', {}).get(simbolo)
+        return f"""
+<b>CANAL {simbolo}</b>
+⏱️ {config_optima.get('timeframe', canal['timeframe'])} - {config_optima.get('num_velas', canal['num_velas'])} velas
+💰 Precio: {foto.get('precios', {}).get(simbolo, canal['precio_actual']):.8f}
+📈 Resistencia: {canal['resistencia']:.8f}
+📉 Soporte: {canal['soporte']:.8f}
+📏 Ancho: {canal['ancho_canal_porcentual']:.1f}% | Ángulo: {canal['angulo_tendencia']:.1f}°
+📊 Pearson: {canal['coeficiente_pearson']:.3f} | R²: {canal['r2_score']:.3f}
+🎰 Stoch K/D: {canal['stoch_k']:.1f} / {canal['stoch_d']:.1f}
+{'⏳ Esperando reentry tras ' + reentry if reentry else '👁️ Sin breakout pendiente'}
+        """
+    def comando_pausa(self, argumentos, foto):
+        self.pausado.set()
+        return "⏸️ Bot en pausa: sigue vigilando posiciones pero no abre operaciones nuevas (/resume para reanudar)"
+    def comando_reanudar(self, argumentos, foto):
+        self.pausado.clear()
+        return "▶️ Bot reanudado: vuelve a abrir operaciones"
     def reoptimizar_periodicamente(self):
         try:
-            horas_desde_opt = (datetime.now() - self.ultima_optimizacion).total_seconds() / 7200
-            if self.operaciones_desde_optimizacion >= 8 or horas_desde_opt >= self.config.get('reevaluacion_horas', 24):
-                print("🔄 Iniciando re-optimización automática...")
-                ia = OptimizadorIA(log_path=self.log_path, min_samples=self.config.get('min_samples_optimizacion', 30))
-                nuevos_parametros = ia.buscar_mejores_parametros()
-                if nuevos_parametros:
+            if self.optimizador.en_curso():
+                terminado, nuevos_parametros = self.optimizador.recoger()
+                if terminado and nuevos_parametros:
                     self.actualizar_parametros(nuevos_parametros)
                     self.ultima_optimizacion = datetime.now()
                     self.operaciones_desde_optimizacion = 0
-                    print("✅ Parámetros actualizados en tiempo real")
+                    logger_optimizador.info("✅ Parámetros actualizados en tiempo real", extra={'etapa': 'aplicacion'})
+                return
+            horas_desde_opt = (datetime.now() - self.ultima_optimizacion).total_seconds() / 7200
+            if self.operaciones_desde_optimizacion >= 8 or horas_desde_opt >= self.config.get('reevaluacion_horas', 24):
+                if self.optimizador.lanzar(self.log_path, self.config.get('min_samples_optimizacion', 30),
+                                          self.parametros_optimizables()):
+                    logger_optimizador.info("🔄 Re-optimización automática iniciada en proceso separado", extra={'etapa': 'proceso'})
         except Exception as e:
-            print(f"⚠ Error en re-optimización automática: {e}")
+            logger_optimizador.error("❌ Error en re-optimización automática: %s", e, extra={'etapa': 'proceso'})
+    def parametros_optimizables(self):
+        return {clave: self.config[clave] for clave in ESPACIO_OPTIMIZACION if clave in self.config}
     def actualizar_parametros(self, nuevos_parametros):
-        self.config['trend_threshold_degrees'] = nuevos_parametros.get('trend_threshold_degrees',
-                                                                        self.config.get('trend_threshold_degrees', 16))
-        self.config['min_trend_strength_degrees'] = nuevos_parametros.get('min_trend_strength_degrees',
-                                                                           self.config.get('min_trend_strength_degrees', 16))
-        self.config['entry_margin'] = nuevos_parametros.get('entry_margin',
-                                                             self.config.get('entry_margin', 0.001))
+        cambios = {
+            clave: nuevos_parametros[clave] for clave in ESPACIO_OPTIMIZACION if clave in nuevos_parametros
+        }
+        self.config.update(cambios)
     def mostrar_resumen_operaciones(self):
-        print(f"\n📊 RESUMEN OPERACIONES:")
-        print(f"   Activas: {len(self.operaciones_activas)}")
-        print(f"   Esperando reentry: {len(self.esperando_reentry)}")
-        print(f"   Total ejecutadas: {self.total_operaciones}")
+        logger_escaneo.info("📊 Resumen operaciones: activas %s, esperando reentry %s, total ejecutadas %s",
+                            len(self.operaciones_activas), len(self.esperando_reentry), self.total_operaciones,
+                            extra={'etapa': 'resumen'})
     def iniciar(self):
-        print("\n" + "=" * 70)
-        print("🤖 BOT DE TRADING - ESTRATEGIA BREAKOUT + REENTRY")
-        print("🎯 CORRECCIONES APLICADAS: Errores -2021, -1111 y -4164 SOLUCIONADOS")
-        print("💾 PERSISTENCIA: ACTIVADA")
-        print("🔄 REEVALUACIÓN: CADA 2 HORAS")
-        print("📌 MODO MARGEN: AISLADO")
-        print("🛡️  STOP LOSS PERSISTENTE: ACTIVADO")
-        print("=" * 70)
-        print(f"💱 Símbolos: {len(self.config.get('symbols', []))} monedas")
-        print(f"📏 ANCHO MÍNIMO: {self.config.get('min_channel_width_percent', 4)}%")
-        print(f"🚀 Estrategia: 1) Detectar Breakout → 2) Esperar Reentry → 3) Confirmar con Stoch")
-        print("=" * 70)
-        print("\n🚀 INICIANDO BOT...")
+        if self.criba_universo:
+            simbolos = f"criba de perpetuos USDT, top {self.criba_universo.top_n} por liquidez/volatilidad/rango"
+        else:
+            simbolos = f"{len(self.config.get('symbols', []))} monedas"
+        logger_escaneo.info("🤖 Iniciando bot Breakout + Reentry (margen aislado, SL persistente). Símbolos: %s. "
+                            "Ancho mínimo: %s%%", simbolos, self.config.get('min_channel_width_percent', 4),
+                            extra={'etapa': 'arranque'})
         try:
             while True:
-                nuevas_senales = self.ejecutar_analisis()
+                nuevas_senales = self.ejecutar_ciclo_programado()
                 self.mostrar_resumen_operaciones()
-                minutos_espera = self.config.get('scan_interval_minutes', 1)
-                print(f"\n✅ Análisis completado. Señales nuevas: {nuevas_senales}")
-                print(f"⏳ Próximo análisis en {minutos_espera} minutos...")
-                print("-" * 60)
-                for minuto in range(minutos_espera):
-                    time.sleep(60)
-                    restantes = minutos_espera - (minuto + 1)
-                    if restantes > 0 and restantes % 5 == 0:
-                        print(f"   ⏰ {restantes} minutos restantes...")
+                segundos_espera = self.segundos_hasta_proximo_ciclo()
+                logger_escaneo.info("✅ Análisis completado. Señales nuevas: %s. Próximo evento en %.0f segundos",
+                                    nuevas_senales, segundos_espera, extra={'etapa': 'ciclo'})
+                self.esperar_proximo_ciclo(segundos_espera)
         except KeyboardInterrupt:
-            print("\n🛑 Bot detenido por el usuario")
-            print("💾 Guardando estado final...")
+            logger_estado.info("🛑 Bot detenido por el usuario, guardando estado final", extra={'etapa': 'guardado'})
             self.guardar_estado()
-            print("👋 ¡Hasta pronto!")
+            if self.vigilante_reentry:
+                self.vigilante_reentry.detener()
         except Exception as e:
-            print(f"\n❌ Error en el bot: {e}")
-            print("💾 Intentando guardar estado...")
+            logger_escaneo.error("❌ Error en el bot: %s. Intentando guardar estado", e, extra={'etapa': 'ciclo'})
             try:
                 self.guardar_estado()
             except:
@@ -1478,15 +4339,59 @@ def crear_config_desde_entorno():
     directorio_actual = os.path.dirname(os.path.abspath(__file__))
     telegram_chat_ids_str = os.environ.get('TELEGRAM_CHAT_ID', '-1002272872445')
     telegram_chat_ids = [cid.strip() for cid in telegram_chat_ids_str.split(',') if cid.strip()]
+    shard_mode = os.environ.get('SHARD_MODE', 'false').lower() == 'true'
+    shard_instance_id = os.environ.get('SHARD_INSTANCE_ID', socket.gethostname())
+    sufijo_estado = f"_{shard_instance_id}" if shard_mode else ""
     return {
         'min_channel_width_percent': 4.0,
         'trend_threshold_degrees': 16.0,
         'min_trend_strength_degrees': 16.0,
         'entry_margin': 0.001,
         'min_rr_ratio': 1.2,
+        'apalancamiento': int(os.environ.get('APALANCAMIENTO', '10')),
+        'ttl_exchange_info_segundos': 3600,
+        'max_edad_estado_cuenta_segundos': 300,
+        'fraccion_balance': 0.03,
+        'cuentas_adicionales': json.loads(os.environ.get('CUENTAS_ADICIONALES', '[]')),
+        'limite_peticiones_cuenta_por_segundo': 5.0,
+        'rafaga_peticiones_cuenta': 10,
+        'min_pearson': 0.4,
+        'min_r2': 0.4,
+        'stoch_sobreventa': 30,
+        'stoch_sobrecompra': 70,
         'scan_interval_minutes': 4,
+        'max_simbolos_por_ciclo': 10,
+        'peso_proximidad': 3.0,
+        'peso_reentry': 5.0,
+        'peso_antiguedad': 1.0,
+        'peso_volatilidad': 1.0,
+        'espera_maxima_simbolo_minutos': 30,
+        'reintento_config_minutos': 30,
+        'ttl_config_optima_segundos': 7200,
+        'jitter_config_optima': 0.2,
+        'workers_config_optima': 2,
+        'retraso_cierre_vela_segundos': 3,
+        'intervalo_chequeo_precio_segundos': 60,
+        'resync_canal_cada': 288,
+        'indicadores_lote': os.environ.get('INDICADORES_LOTE', 'true').lower() == 'true',
+        'capacidad_buffer_velas': 512,
+        'resampleo_local': True,
+        'timeframe_base': '5m',
+        'sincronizacion_base_min_segundos': 5,
+        'archivo_velas_activo': os.environ.get('ARCHIVO_VELAS', 'true').lower() == 'true',
+        'directorio_archivo_velas': os.environ.get('ARCHIVO_VELAS_DIR', os.path.join(directorio_actual, 'archivo_velas')),
+        'reentry_stream_activo': os.environ.get('REENTRY_STREAM', 'true').lower() == 'true',
+        'reentry_stream_tipo': os.environ.get('REENTRY_STREAM_TIPO', 'markPrice'),
+        'reentry_tick_cooldown_segundos': 15,
         'timeframes': ['5m', '15m', '30m', '1h', '4h'],
         'velas_options': [80, 100, 120, 150, 200],
+        'criba_universo_activa': os.environ.get('CRIBA_UNIVERSO', 'false').lower() == 'true',
+        'criba_top_n': int(os.environ.get('CRIBA_TOP_N', '40')),
+        'criba_volumen_minimo_usdt': 20_000_000,
+        'criba_refresco_minutos': 60,
+        'criba_peso_liquidez': 1.0,
+        'criba_peso_volatilidad': 1.0,
+        'criba_peso_rango': 1.0,
         'symbols': [
             'XMRUSDT','AAVEUSDT','DOTUSDT','LINKUSDT','BNBUSDT','XRPUSDT','SOLUSDT','AVAXUSDT',
             'DOGEUSDT','LTCUSDT','ATOMUSDT','XLMUSDT','ALGOUSDT','VETUSDT','ICPUSDT','FILUSDT',
@@ -1495,41 +4400,58 @@ def crear_config_desde_entorno():
         ],
         'telegram_token': os.environ.get('TELEGRAM_TOKEN'),
         'telegram_chat_ids': telegram_chat_ids,
+        'telegram_webhook_secret': os.environ.get('TELEGRAM_WEBHOOK_SECRET') or (
+            hashlib.sha256(f"webhook|{os.environ['TELEGRAM_TOKEN']}".encode()).hexdigest()
+            if os.environ.get('TELEGRAM_TOKEN') else None
+        ),
         'auto_optimize': True,
         'min_samples_optimizacion': 30,
+        'min_operaciones_pliegue': 5,
         'reevaluacion_horas': 24,
+        'timeout_optimizacion_segundos': 600,
+        'workers_posiciones': int(os.environ.get('WORKERS_POSICIONES', '4')),
+        'espera_reintento_optimizacion_minutos': 30,
         'log_path': os.path.join(directorio_actual, 'operaciones_log_v23.csv'),
-        'estado_file': os.path.join(directorio_actual, 'estado_bot_v23.json'),
+        'estado_file': os.path.join(directorio_actual, f'estado_bot_v23{sufijo_estado}.json'),
+        'shard_mode': shard_mode,
+        'shard_instance_id': shard_instance_id,
+        'shard_db_path': os.environ.get('SHARD_DB_PATH', os.path.join(directorio_actual, 'coordinacion_shards.db')),
+        'shard_lease_segundos': int(os.environ.get('SHARD_LEASE_SEGUNDOS', '90')),
+        'max_posiciones_globales': int(os.environ.get('MAX_POSICIONES_GLOBALES', '5')),
+        'correlacion_activa': os.environ.get('CORRELACION_ACTIVA', 'true').lower() == 'true',
+        'correlacion_ventana': 96,
+        'correlacion_min_muestras': 24,
+        'correlacion_umbral': 0.7,
+        'correlacion_max_exposicion': float(os.environ.get('CORRELACION_MAX_EXPOSICION', '2.5')),
+        'log_formato': os.environ.get('LOG_FORMATO', 'json'),
+        'log_nivel': os.environ.get('LOG_NIVEL', 'INFO'),
+        'log_niveles_categoria': dict(
+            par.split('=', 1) for par in os.environ.get('LOG_NIVELES', '').split(',') if '=' in par
+        ),
+        'log_ventana_segundos': 60,
+        'log_rafaga': 20,
+        'log_muestreo': 50,
         'binance_api_key': os.environ.get('BINANCE_API_KEY'),
         'binance_secret_key': os.environ.get('BINANCE_SECRET_KEY'),
-        'binance_testnet': os.environ.get('BINANCE_TESTNET', 'true').lower() == 'true'
+        'binance_testnet': os.environ.get('BINANCE_TESTNET', 'true').lower() == 'true',
+        'sesion_modo': os.environ.get('SESION_MODO', '').lower(),
+        'sesion_archivo': os.environ.get('SESION_ARCHIVO', os.path.join(directorio_actual, 'sesion_grabada.jsonl.gz')),
+        'sesion_velocidad': os.environ.get('SESION_VELOCIDAD', 'real').lower(),
+        'arrancar_bot': os.environ.get('ARRANCAR_BOT', 'true').lower() == 'true'
     }
 # ---------------------------
 # FLASK APP Y RENDER
 # ---------------------------
 app = Flask(__name__)
 config = crear_config_desde_entorno()
-bot = TradingBot(config)
 def run_bot_loop():
     while True:
         try:
-            bot.ejecutar_analisis()
-            time.sleep(bot.config.get('scan_interval_minutes', 1) * 60)
+            bot.ejecutar_ciclo_programado()
+            bot.esperar_proximo_ciclo()
         except Exception as e:
-            print(f"Error en el hilo del bot: {e}", file=sys.stderr)
+            logger_escaneo.error("❌ Error en el hilo del bot: %s", e, extra={'etapa': 'ciclo'})
             time.sleep(60)
-bot_thread = threading.Thread(target=run_bot_loop, daemon=True)
-bot_thread.start()
-@app.route('/')
-def index():
-    return "Bot Breakout + Reentry está en línea.", 200
-@app.route('/webhook', methods=['POST'])
-def telegram_webhook():
-    if request.is_json:
-        update = request.get_json()
-        print(f"Update recibido: {json.dumps(update)}", file=sys.stdout)
-        return jsonify({"status": "ok"}), 200
-    return jsonify({"error": "Request must be JSON"}), 400
 def setup_telegram_webhook():
     token = os.environ.get('TELEGRAM_TOKEN')
     if not token:
@@ -1543,9 +4465,54 @@ def setup_telegram_webhook():
             return
     try:
         requests.get(f"https://api.telegram.org/bot{token}/deleteWebhook")
-        requests.get(f"https://api.telegram.org/bot{token}/setWebhook?url={webhook_url}")
+        requests.get(
+            f"https://api.telegram.org/bot{token}/setWebhook",
+            params={'url': webhook_url, 'secret_token': config.get('telegram_webhook_secret')}
+        )
     except Exception as e:
-        print(f"Error configurando webhook: {e}", file=sys.stderr)
+        logger_telegram.error("❌ Error configurando webhook: %s", e, extra={'etapa': 'webhook'})
+# Los procesos hijos (optimizador) y las herramientas como prueba_carga.py importan este módulo:
+# solo el proceso principal del servicio arranca el bot
+bot = None
+sesion = None
+if multiprocessing.parent_process() is None and config['arrancar_bot']:
+    configurar_logging(config)
+    sesion = activar_sesion(config)
+    bot = TradingBot(config, sesion=sesion)
+    # Al reproducir, los ciclos los conduce reproducir_sesion desde __main__
+    if sesion is None or sesion.modo == 'grabar':
+        # Bajo gunicorn __main__ no se ejecuta: el secreto que valida /webhook se registra aquí
+        setup_telegram_webhook()
+        bot_thread = threading.Thread(target=run_bot_loop, daemon=True)
+        bot_thread.start()
+@app.route('/')
+def index():
+    return "Bot Breakout + Reentry está en línea.", 200
+@app.route('/ejecucion')
+def resumen_ejecucion():
+    if bot is None:
+        return jsonify({"error": "bot no iniciado"}), 503
+    return jsonify(bot.resumen_ejecucion()), 200
+@app.route('/webhook', methods=['POST'])
+def telegram_webhook():
+    # /pause y /resume cambian el estado de trading: solo Telegram conoce el secreto registrado en setWebhook
+    secreto = config.get('telegram_webhook_secret')
+    recibido = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secreto or not hmac.compare_digest(recibido, secreto):
+        logger_telegram.warning("⛔ Webhook rechazado: token secreto ausente o inválido", extra={'etapa': 'comando'})
+        return jsonify({"error": "forbidden"}), 403
+    if bot is None:
+        return jsonify({"error": "bot no iniciado"}), 503
+    if request.is_json:
+        update = request.get_json()
+        try:
+            bot.atender_comando_telegram(update)
+        except Exception as e:
+            logger_telegram.error("❌ Error atendiendo comando de Telegram: %s", e, extra={'etapa': 'comando'})
+        return jsonify({"status": "ok"}), 200
+    return jsonify({"error": "Request must be JSON"}), 400
 if __name__ == '__main__':
-    setup_telegram_webhook()
+    if sesion is not None and sesion.modo == 'reproducir':
+        print(json.dumps(reproducir_sesion(bot, sesion), indent=2))
+        sys.exit(0)
     app.run(debug=True, port=5000)
@@ -0,0 +1,314 @@
+# prueba_carga.py
+# Curva de escalado del bot contra un Binance sintético en memoria, con reloj acelerado.
+# Uso: PRUEBA_CARGA=100,300,1000 [PRUEBA_CARGA_POSICIONES=0,10,50] [PRUEBA_CARGA_CICLOS=3] python prueba_carga.py
+import os
+# Importar el servicio no debe arrancar el bot ni registrar el webhook
+os.environ.setdefault('ARRANCAR_BOT', 'false')
+import json
+import logging
+import math
+import multiprocessing
+import resource
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+import numpy as np
+import requests
+from binance.exceptions import BinanceAPIException
+import bot_web_service as bws
+logger_carga = logging.getLogger("bot.carga")
+class ExchangeSintetico:
+    """Binance local para pruebas de carga: velas deterministas por símbolo (tendencia, canal y ruptura
+    configurables), cuenta de futuros en memoria y conteo de peticiones por endpoint"""
+    def __init__(self, simbolos, semilla=0, fraccion_tendencia=0.7, fraccion_ruptura=0.1,
+                 velas_hasta_ruptura=12, balance=100000.0, reloj=time):
+        self._requests = requests
+        self.reloj = reloj
+        rng = np.random.default_rng(semilla)
+        self.origen = self.reloj.time() - 30 * 86400
+        # La tendencia se ancla en el momento de creación: 'base' es el precio actual y la deriva por vela
+        # de 5m se mantiene chica para que 30 días de historia no lleven el precio a 0 ni a valores absurdos
+        self.ancla = self.reloj.time()
+        self.perfiles = {}
+        for simbolo in simbolos:
+            direccion = rng.choice((-1, 1)) if rng.random() < fraccion_tendencia else 0
+            ruptura = None
+            if rng.random() < fraccion_ruptura:
+                ruptura = self.reloj.time() + rng.integers(1, velas_hasta_ruptura + 1) * 300
+            self.perfiles[simbolo] = {
+                'base': 10 ** rng.uniform(-1, 4),
+                'pendiente': direccion * rng.uniform(2e-5, 1.5e-4),
+                'ancho': rng.uniform(0.01, 0.03),
+                'periodo': rng.uniform(20, 60),
+                'ruptura': ruptura,
+                'semilla': rng.uniform(0, 1000)
+            }
+        self.balance = balance
+        self.posiciones = {}
+        self.ordenes = {}
+        self.ordenes_por_id_cliente = {}
+        self.id_orden = 0
+        self.entradas = 0
+        self.peticiones = {}
+        self.lock = threading.Lock()
+    def __getattr__(self, nombre):
+        return getattr(self._requests, nombre)
+    def contar(self, endpoint):
+        with self.lock:
+            self.peticiones[endpoint] = self.peticiones.get(endpoint, 0) + 1
+    def reiniciar_conteo(self):
+        with self.lock:
+            conteo, self.peticiones = self.peticiones, {}
+        return conteo
+    def precios(self, simbolo, instantes):
+        perfil = self.perfiles[simbolo]
+        velas = (np.asarray(instantes, dtype=float) - self.origen) / 300
+        ruido = np.modf(np.abs(np.sin(velas * 12.9898 + perfil['semilla'])) * 43758.5453)[0] - 0.5
+        precio = perfil['base'] * np.exp(perfil['pendiente'] * (velas - (self.ancla - self.origen) / 300)) * (
+            1 + perfil['ancho'] * np.sin(2 * np.pi * velas / perfil['periodo']) + 0.004 * ruido
+        )
+        if perfil['ruptura'] is not None:
+            signo = -1 if perfil['pendiente'] > 0 else 1
+            precio = np.where(np.asarray(instantes) >= perfil['ruptura'], precio * (1 + signo * 3 * perfil['ancho']), precio)
+        return precio
+    def klines(self, simbolo, intervalo, limit=500, startTime=None, endTime=None):
+        paso = bws.INTERVALOS_SEGUNDOS[intervalo] * 1000
+        ahora_ms = self.reloj.time() * 1000
+        ultima = int(ahora_ms // paso) * paso
+        if startTime is not None:
+            primera = -(-int(startTime) // paso) * paso
+            ultima = min(ultima, primera + (int(limit) - 1) * paso)
+        else:
+            if endTime is not None:
+                ultima = min(ultima, int(endTime) // paso * paso)
+            primera = ultima - (int(limit) - 1) * paso
+        aperturas = np.arange(primera, ultima + 1, paso, dtype=np.int64)
+        if len(aperturas) == 0:
+            return []
+        cierres_ms = np.minimum(aperturas + paso, ahora_ms)
+        o = self.precios(simbolo, aperturas / 1000)
+        c = self.precios(simbolo, cierres_ms / 1000)
+        h = np.maximum(o, c) * 1.001
+        l = np.minimum(o, c) * 0.999
+        return [
+            [int(a), f"{o[i]:.8f}", f"{h[i]:.8f}", f"{l[i]:.8f}", f"{c[i]:.8f}", "1000", int(a) + paso - 1, "0", 100, "0", "0", "0"]
+            for i, a in enumerate(aperturas)
+        ]
+    def precio_actual(self, simbolo):
+        return float(self.precios(simbolo, [self.reloj.time()])[0])
+    def get(self, url, params=None, **kwargs):
+        params = params or {}
+        endpoint = url.split('.com', 1)[-1]
+        self.contar(f"GET {endpoint}")
+        if endpoint.endswith('/klines'):
+            datos = self.klines(params['symbol'], params['interval'], params.get('limit', 500),
+                                params.get('startTime'), params.get('endTime'))
+        elif endpoint.endswith('/ticker/price'):
+            if 'symbol' in params:
+                datos = {'symbol': params['symbol'], 'price': str(self.precio_actual(params['symbol']))}
+            else:
+                simbolos = json.loads(params['symbols']) if 'symbols' in params else list(self.perfiles)
+                datos = [{'symbol': s, 'price': str(self.precio_actual(s))} for s in simbolos]
+        else:
+            return bws.RespuestaGrabada(404, '{"msg": "endpoint no simulado"}')
+        return bws.RespuestaGrabada(200, json.dumps(datos))
+    def post(self, url, params=None, **kwargs):
+        self.contar('POST telegram' if 'telegram' in url else f"POST {url}")
+        return bws.RespuestaGrabada(200, '{"ok": true}')
+    def crear_cliente(self, *args, **kwargs):
+        return ClienteSintetico(self)
+    def abrir_posicion(self, simbolo, cantidad, tipo='LONG'):
+        """Posición ya protegida (SL + TP abiertos), como la dejaría una apertura completa"""
+        self.posiciones[simbolo] = cantidad if tipo == 'LONG' else -cantidad
+        self.api_futures_create_order(symbol=simbolo, type='STOP_MARKET')
+        self.api_futures_create_order(symbol=simbolo, type='TAKE_PROFIT_MARKET')
+    def api_ping(self):
+        return {}
+    def api_get_system_status(self):
+        return {'status': 0, 'msg': 'normal'}
+    def api_futures_account(self):
+        return {
+            'availableBalance': str(self.balance),
+            'positions': [{'symbol': s, 'positionAmt': str(self.posiciones.get(s, 0.0))} for s in self.perfiles]
+        }
+    def api_futures_exchange_info(self):
+        simbolos = []
+        for simbolo in self.perfiles:
+            tick = 10.0 ** (math.floor(math.log10(self.perfiles[simbolo]['base'])) - 4)
+            simbolos.append({'symbol': simbolo, 'filters': [
+                {'filterType': 'PRICE_FILTER', 'minPrice': f"{tick:.10f}", 'tickSize': f"{tick:.10f}"},
+                {'filterType': 'LOT_SIZE', 'stepSize': '0.001', 'minQty': '0.001', 'maxQty': '1000000'}
+            ]})
+        return {'symbols': simbolos}
+    def api_futures_change_leverage(self, symbol, leverage):
+        return {'symbol': symbol, 'leverage': leverage}
+    def api_futures_change_margin_type(self, symbol, marginType):
+        return {}
+    def api_futures_symbol_ticker(self, symbol=None):
+        if symbol is None:
+            return [{'symbol': s, 'price': str(self.precio_actual(s))} for s in self.perfiles]
+        return {'symbol': symbol, 'price': str(self.precio_actual(symbol))}
+    def api_futures_create_order(self, symbol, type, side=None, quantity=None, newClientOrderId=None, **kwargs):
+        with self.lock:
+            previa = self.ordenes_por_id_cliente.get(newClientOrderId)
+            if previa and previa['orderId'] in self.ordenes.get(symbol, {}):
+                raise BinanceAPIException(None, 400, json.dumps({'code': bws.CODIGO_ID_CLIENTE_DUPLICADO, 'msg': 'ClientOrderId is duplicated.'}))
+            self.id_orden += 1
+            orden = {'orderId': self.id_orden, 'clientOrderId': newClientOrderId, 'symbol': symbol, 'type': type,
+                     'side': side, 'status': 'NEW'}
+            if newClientOrderId:
+                self.ordenes_por_id_cliente[newClientOrderId] = orden
+            if type == 'MARKET':
+                if not kwargs.get('reduceOnly'):
+                    self.entradas += 1
+                cantidad = float(quantity) if side == 'BUY' else -float(quantity)
+                self.posiciones[symbol] = self.posiciones.get(symbol, 0.0) + cantidad
+                orden.update(status='FILLED', avgPrice=str(self.precio_actual(symbol)), executedQty=str(quantity))
+            else:
+                self.ordenes.setdefault(symbol, {})[orden['orderId']] = orden
+        return orden
+    def api_futures_get_open_orders(self, symbol=None):
+        with self.lock:
+            if symbol is not None:
+                return list(self.ordenes.get(symbol, {}).values())
+            return [orden for ordenes in self.ordenes.values() for orden in ordenes.values()]
+    def api_futures_cancel_order(self, symbol, orderId):
+        with self.lock:
+            orden = self.ordenes.get(symbol, {}).pop(orderId, {'orderId': orderId})
+            orden['status'] = 'CANCELED'
+            return orden
+    def api_futures_get_order(self, symbol, orderId=None, origClientOrderId=None):
+        if origClientOrderId is not None:
+            orden = self.ordenes_por_id_cliente.get(origClientOrderId)
+            if orden is None:
+                raise BinanceAPIException(None, 400, json.dumps({'code': bws.CODIGO_ORDEN_INEXISTENTE, 'msg': 'Order does not exist.'}))
+            return orden
+        return {'orderId': orderId, 'status': 'FILLED', 'avgPrice': str(self.precio_actual(symbol))}
+    def api_futures_income_history(self, **kwargs):
+        return []
+    def api_futures_account_trades(self, **kwargs):
+        return []
+class ClienteSintetico:
+    """Sustituto del Client de python-binance que delega en los métodos api_* del exchange sintético"""
+    def __init__(self, exchange):
+        self._exchange = exchange
+    def __getattr__(self, nombre):
+        implementacion = getattr(self._exchange, 'api_' + nombre, None)
+        if implementacion is None:
+            raise AttributeError(nombre)
+        def llamada(*args, **kwargs):
+            self._exchange.contar(nombre)
+            return implementacion(*args, **kwargs)
+        return llamada
+def medir_punto_carga(config, num_simbolos, num_posiciones, ciclos=3, directorio=None):
+    """Un punto de la curva de escalado: bot completo contra el exchange sintético con reloj acelerado.
+    Se ejecuta en un proceso propio para que el pico de RSS sea el de este punto."""
+    directorio = directorio or tempfile.mkdtemp(prefix='prueba_carga_')
+    simbolos = [f"SIN{i:04d}USDT" for i in range(num_simbolos)]
+    reloj = bws.RelojSesion(time.time(), acelerado=True)
+    exchange = ExchangeSintetico(simbolos, velas_hasta_ruptura=max(1, ciclos), reloj=reloj)
+    cfg = dict(config)
+    cfg.update({
+        'symbols': simbolos, 'max_simbolos_por_ciclo': num_simbolos, 'criba_universo_activa': False,
+        'reentry_stream_activo': False, 'auto_optimize': False, 'shard_mode': False, 'archivo_velas_activo': False,
+        'telegram_token': None, 'cuentas_adicionales': [], 'binance_api_key': 'carga', 'binance_secret_key': 'carga',
+        'limite_peticiones_cuenta_por_segundo': 1e9, 'rafaga_peticiones_cuenta': 1e9,
+        'estado_file': os.path.join(directorio, 'estado.json'), 'log_path': os.path.join(directorio, 'operaciones_log.csv')
+    })
+    # El bot resuelve requests, Client y time en el módulo del servicio: ahí se inyectan los sustitutos
+    originales = (bws.requests, bws.Client, bws.time)
+    bws.requests, bws.Client, bws.time = exchange, exchange.crear_cliente, reloj
+    try:
+        bot = bws.TradingBot(cfg)
+        for simbolo in simbolos:
+            bot.refrescar_configuracion_optima(simbolo)
+        for simbolo in simbolos[:num_posiciones]:
+            precio = exchange.precio_actual(simbolo)
+            exchange.abrir_posicion(simbolo, 1.0)
+            bot.operaciones_activas[simbolo] = bws.OperacionActiva(
+                tipo='LONG', precio_entrada=precio, take_profit=precio * 1.05, stop_loss=precio * 0.95,
+                timestamp_entrada=datetime.now().isoformat(), timeframe_utilizado='5m', velas_utilizadas=100, cantidad=1.0
+            )
+            bot.senales_enviadas.add(simbolo)
+        tiempos = []
+        peticiones = []
+        senales = 0
+        breakouts = set()
+        for _ in range(ciclos):
+            reloj.sleep(bws.INTERVALOS_SEGUNDOS[cfg.get('timeframe_base', '5m')])
+            exchange.reiniciar_conteo()
+            t0 = reloj.perf_counter()
+            senales += bot.ejecutar_analisis()
+            tiempos.append((reloj.perf_counter() - t0) * 1000)
+            peticiones.append(exchange.reiniciar_conteo())
+            breakouts.update(bot.esperando_reentry)
+        tiempos_estado = []
+        for _ in range(ciclos):
+            t0 = reloj.perf_counter()
+            bot.guardar_estado()
+            tiempos_estado.append((reloj.perf_counter() - t0) * 1000)
+        bot.servicio_config.executor.shutdown(wait=False)
+        por_endpoint = {}
+        for conteo in peticiones:
+            for endpoint, n in conteo.items():
+                por_endpoint[endpoint] = por_endpoint.get(endpoint, 0) + n / ciclos
+        return {
+            'simbolos': num_simbolos,
+            'posiciones': len(bot.operaciones_activas),
+            'configs_optimas': len(bot.config_optima_por_simbolo),
+            'canales_validos': sum(
+                1 for c in bot.canales_cache.values()
+                if np.isfinite(c['ancho_canal_porcentual']) and c['nivel_fuerza'] >= 2
+            ),
+            'breakouts': len(breakouts),
+            'senales': senales,
+            'entradas': exchange.entradas,
+            'ms_ciclo_medio': round(statistics.mean(tiempos), 1),
+            'ms_ciclo_max': round(max(tiempos), 1),
+            'peticiones_por_ciclo': round(sum(por_endpoint.values()), 1),
+            'peticiones_por_endpoint': {k: round(v, 1) for k, v in sorted(por_endpoint.items(), key=lambda x: -x[1])},
+            'mb_buffers_velas': round(sum(b._datos.nbytes for b in bot.buffers_velas.values()) / 2 ** 20, 2),
+            'mb_rss_pico': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'ms_guardar_estado': round(statistics.mean(tiempos_estado), 2),
+            'kb_estado': round(os.path.getsize(cfg['estado_file']) / 1024, 1)
+        }
+    finally:
+        bws.requests, bws.Client, bws.time = originales
+def _ejecutar_punto_carga(config, num_simbolos, num_posiciones, ciclos, cola):
+    try:
+        cola.put(medir_punto_carga(config, num_simbolos, num_posiciones, ciclos))
+    except Exception as e:
+        logger_carga.error("❌ Error en punto de prueba de carga (%s símbolos): %s", num_simbolos, e, extra={'etapa': 'carga'})
+        cola.put(None)
+def prueba_de_carga(config):
+    """PRUEBA_CARGA=100,300,1000 [PRUEBA_CARGA_POSICIONES=0,10,50]: curva de escalado por cantidad de símbolos y posiciones"""
+    contexto = multiprocessing.get_context('spawn')
+    resultados = []
+    for num_simbolos in config['prueba_carga']:
+        for num_posiciones in config.get('prueba_carga_posiciones', [0]):
+            if num_posiciones > num_simbolos:
+                continue
+            logger_carga.info("🏋️ Prueba de carga: %s símbolos, %s posiciones", num_simbolos, num_posiciones, extra={'etapa': 'carga'})
+            cola = contexto.Queue(maxsize=1)
+            proceso = contexto.Process(
+                target=_ejecutar_punto_carga,
+                args=(config, num_simbolos, num_posiciones, config.get('prueba_carga_ciclos', 3), cola),
+                daemon=True
+            )
+            proceso.start()
+            resultado = cola.get()
+            proceso.join()
+            if resultado:
+                resultados.append(resultado)
+    return resultados
+if __name__ == '__main__':
+    config = bws.crear_config_desde_entorno()
+    config.update({
+        'prueba_carga': [int(n) for n in os.environ.get('PRUEBA_CARGA', '100').split(',') if n.strip()],
+        'prueba_carga_posiciones': [int(n) for n in os.environ.get('PRUEBA_CARGA_POSICIONES', '0,10,50').split(',') if n.strip()],
+        'prueba_carga_ciclos': int(os.environ.get('PRUEBA_CARGA_CICLOS', '3'))
+    })
+    bws.configurar_logging(config)
+    print(json.dumps(prueba_de_carga(config), indent=2))
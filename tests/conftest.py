@@ -0,0 +1,5 @@
+import os
+import sys
+# Importar el servicio en las pruebas no debe arrancar el bot ni registrar el webhook
+os.environ.setdefault('ARRANCAR_BOT', 'false')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
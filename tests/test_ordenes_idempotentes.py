@@ -0,0 +1,64 @@
+import json
+import pytest
+from binance.exceptions import BinanceAPIException
+import bot_web_service as bws
+def error_binance(codigo, mensaje='error'):
+    return BinanceAPIException(None, 400, json.dumps({'code': codigo, 'msg': mensaje}))
+class ClienteStub:
+    """futures_create_order/futures_get_order en memoria. `guion` fija qué pasa en cada envío:
+    'timeout' (no llega), 'timeout_aplicada' (llega pero la respuesta se pierde) u 'ok'"""
+    def __init__(self, guion=()):
+        self.guion = list(guion)
+        self.ordenes = {}
+        self.envios = 0
+        self.consultas = 0
+        self.id_orden = 0
+    def futures_create_order(self, symbol, newClientOrderId, **params):
+        self.envios += 1
+        accion = self.guion.pop(0) if self.guion else 'ok'
+        if accion == 'timeout':
+            raise error_binance(-1007, 'Timeout waiting for response from backend server.')
+        previa = self.ordenes.get(newClientOrderId)
+        if previa and previa['status'] == 'NEW':
+            raise error_binance(bws.CODIGO_ID_CLIENTE_DUPLICADO, 'ClientOrderId is duplicated.')
+        self.id_orden += 1
+        estado = 'FILLED' if params.get('type') == 'MARKET' else 'NEW'
+        orden = {'orderId': self.id_orden, 'clientOrderId': newClientOrderId, 'symbol': symbol, 'status': estado}
+        self.ordenes[newClientOrderId] = orden
+        if accion == 'timeout_aplicada':
+            raise error_binance(-1007, 'Timeout waiting for response from backend server.')
+        return orden
+    def futures_get_order(self, symbol, origClientOrderId):
+        self.consultas += 1
+        if origClientOrderId not in self.ordenes:
+            raise error_binance(bws.CODIGO_ORDEN_INEXISTENTE, 'Order does not exist.')
+        return self.ordenes[origClientOrderId]
+def nuevo_trader(cliente):
+    trader = bws.BinanceTrader.__new__(bws.BinanceTrader)
+    trader.client = cliente
+    trader.libro_ordenes = bws.LibroOrdenes()
+    return trader
+def test_stop_loss_timeout_reintento_duplicado_y_consulta():
+    cliente = ClienteStub(['timeout', 'timeout_aplicada'])
+    trader = nuevo_trader(cliente)
+    orden = trader.enviar_orden('BTCUSDT', 'cbabcS', side='SELL', type='STOP_MARKET', stopPrice=1.0, closePosition=True)
+    # timeout sin efecto, reintento aplicado sin respuesta, tercer envío rechazado por duplicado y consulta por ID
+    assert cliente.envios == 3
+    assert cliente.consultas == 1
+    assert orden['orderId'] == 1
+    assert len(cliente.ordenes) == 1
+    assert trader.libro_ordenes.confirmada('cbabcS') is orden
+def test_market_timeout_aplicada_no_duplica_la_entrada():
+    cliente = ClienteStub(['timeout_aplicada'])
+    trader = nuevo_trader(cliente)
+    orden = trader.enviar_orden('BTCUSDT', 'cbabcE', side='BUY', type='MARKET', quantity=1.0)
+    assert cliente.envios == 1
+    assert orden['status'] == 'FILLED'
+def test_orden_cancelada_con_el_mismo_id_no_cuenta_como_colocada():
+    cliente = ClienteStub(['timeout', 'timeout', 'timeout'])
+    cliente.ordenes['cbabcS'] = {'orderId': 99, 'clientOrderId': 'cbabcS', 'symbol': 'BTCUSDT', 'status': 'CANCELED'}
+    trader = nuevo_trader(cliente)
+    with pytest.raises(BinanceAPIException):
+        trader.enviar_orden('BTCUSDT', 'cbabcS', side='SELL', type='STOP_MARKET', stopPrice=1.0, closePosition=True)
+    assert trader.libro_ordenes.confirmada('cbabcS') is None
+    assert trader.libro_ordenes.ordenes['cbabcS']['estado'] == 'DESCONOCIDA'